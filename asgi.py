@@ -0,0 +1,44 @@
+"""
+    Async entry point, for ASGI servers:
+
+        uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+    The routes are the ones of server.py, served through AsgiBridge: connections are held by the
+    event loop, and only the handling of a request runs on a thread, from a bounded pool. Password
+    hashing, the slowest step of logins and signups, runs on a pool of processes.
+
+    Configuration, from the environment (on top of the one described in wsgi.py):
+
+        ASGI_THREADS                -   the number of threads handling requests (default: 32)
+        ASGI_MAX_PENDING            -   the maximum number of requests read and queued for those threads (default: 1024)
+        WEB_CONCURRENCY             -   the number of worker processes, as given to the ASGI server (default: 1)
+        PASSWORD_HASH_PROCESSES     -   the number of password hashing processes (default: one per core)
+"""
+import os
+
+
+def create_app():
+    """
+        Function that creates the app for an ASGI server
+
+    :return:    The ASGI app
+    """
+    os.environ.setdefault("PASSWORD_HASH_PROCESSES", str(os.cpu_count() or 1))
+
+    # Several ASGI workers may serve the same database
+    os.environ.setdefault("DATABASE_SHARED_GENERATIONS", "1")
+
+    import server
+    from asgi_bridge import AsgiBridge
+
+    # Only one of the workers serving the database runs the background jobs
+    server.start_jobs()
+
+    return AsgiBridge(server.app,
+                      max_threads=int(os.environ.get("ASGI_THREADS", 32)),
+                      max_pending=int(os.environ.get("ASGI_MAX_PENDING", 1024)),
+                      on_shutdown=server.dh.close,
+                      multiprocess=int(os.environ.get("WEB_CONCURRENCY", 1)) > 1)
+
+
+application = create_app()
@@ -0,0 +1,215 @@
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsgiBridge:
+    """
+        Serves a WSGI app (the Flask app) from an ASGI server's event loop.
+
+        Connections, keep-alives and request bodies are handled by the event loop, so idle or slow
+    clients cost a coroutine each instead of a thread. Only the WSGI call itself - where the
+    DatabaseHandler queries run - and the reading of each response chunk are run on a bounded pool
+    of threads. Requests waiting for a thread are bounded too: past max_pending, new requests wait
+    on the loop before their body is read, which keeps the backlog (and its memory, at most
+    max_pending bodies) in check.
+    """
+
+    def __init__(self, wsgi_app, max_threads=32, max_pending=1024, max_body_size=10 * 2 ** 20, on_shutdown=None,
+                 multiprocess=False):
+        """
+        :param wsgi_app:        The WSGI application
+        :param max_threads:     The number of threads running WSGI calls
+        :param max_pending:     The maximum number of requests read, queued for or running on those threads
+        :param max_body_size:   Larger request bodies are refused with a 413
+        :param on_shutdown:     Called (on a thread) when the ASGI server shuts down
+        :param multiprocess:    Whether other processes serve the same app (wsgi.multiprocess)
+        """
+        self._wsgi_app = wsgi_app
+        self._executor = ThreadPoolExecutor(max_threads, thread_name_prefix="wsgi")
+        self._max_pending = max_pending
+        self._pending = None
+        self._max_body_size = max_body_size
+        self._on_shutdown = on_shutdown
+        self._multiprocess = multiprocess
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                loop = asyncio.get_running_loop()
+                if self._on_shutdown is not None:
+                    await loop.run_in_executor(self._executor, self._on_shutdown)
+                self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _read_body(self, receive):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+
+            body += message.get("body", b"")
+            if len(body) > self._max_body_size:
+                return False
+
+            if not message.get("more_body", False):
+                return bytes(body)
+
+    async def _http(self, scope, receive, send):
+        if self._pending is None:
+            # Created here, on the server's loop
+            self._pending = asyncio.Semaphore(self._max_pending)
+
+        loop = asyncio.get_running_loop()
+        # Taken before the body is read, so that the bodies held in memory are bounded as well
+        async with self._pending:
+            body = await self._read_body(receive)
+            if body is None:
+                return
+
+            if body is False:
+                await send({"type": "http.response.start", "status": 413,
+                            "headers": [(b"content-type", b"text/plain"), (b"content-length", b"17")]})
+                await send({"type": "http.response.body", "body": b"Payload too large"})
+                return
+
+            response = _WsgiResponse()
+            chunks = await loop.run_in_executor(self._executor, self._call,
+                                                _environ(scope, body, self._multiprocess), response)
+
+            try:
+                started = False
+                while True:
+                    chunk = await loop.run_in_executor(self._executor, next, chunks, None)
+                    if chunk is None:
+                        break
+                    if not chunk:
+                        continue
+
+                    if not started:
+                        await send(response.start_message())
+                        started = True
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+                if not started:
+                    await send(response.start_message())
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+            finally:
+                close = getattr(chunks, "close", None)
+                if close is not None:
+                    await loop.run_in_executor(self._executor, close)
+
+    def _call(self, environ, response):
+        # Iterated through iter(), so that chunks written through the legacy write() come first
+        result = self._wsgi_app(environ, response.start_response)
+        return _ResponseIterator(response, result)
+
+
+class _WsgiResponse:
+    """
+        The status and headers given to start_response
+    """
+
+    def __init__(self):
+        self.status = None
+        self.headers = None
+        self.written = list()
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self.status is not None:
+            raise exc_info[1].with_traceback(exc_info[2])
+
+        self.status = int(status.split(" ", 1)[0])
+        self.headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        return self.written.append
+
+    def start_message(self):
+        return {"type": "http.response.start", "status": self.status, "headers": self.headers}
+
+
+class _ResponseIterator:
+    """
+        Iterates over what the WSGI app wrote through write(), then over what it returned
+    """
+
+    def __init__(self, response, result):
+        self._response = response
+        self._result = result
+        self._iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._response.written:
+            return self._response.written.pop(0)
+
+        if self._iterator is None:
+            self._iterator = iter(self._result)
+
+        return next(self._iterator)
+
+    def close(self):
+        close = getattr(self._result, "close", None)
+        if close is not None:
+            close()
+
+
+def _environ(scope, body, multiprocess=False):
+    """
+        Function that builds the WSGI environ of an ASGI HTTP request (PEP 3333)
+
+    :param multiprocess:    Whether other processes serve the same app
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": multiprocess,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if name == "CONTENT_TYPE":
+            key = "CONTENT_TYPE"
+        elif name == "CONTENT_LENGTH":
+            continue
+        else:
+            key = "HTTP_" + name
+
+        if key in environ and key != "CONTENT_TYPE":
+            environ[key] += ("; " if key == "HTTP_COOKIE" else ",") + value
+        else:
+            environ[key] = value
+
+    return environ
@@ -0,0 +1,222 @@
+"""
+    Times every public DatabaseHandler method on synthetic databases of several sizes.
+
+    Usage (from the repository root):
+
+        python -m benchmarks.handler_benchmark --scales small,medium --output results.json
+        python -m benchmarks.handler_benchmark --scales small --compare results.json
+        python -m benchmarks.handler_benchmark --scales small --backend memory
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sqlite3 as sql
+import tempfile
+import time
+from database.database_handler import DatabaseHandler
+from database.memory_backend import MemoryBackend
+from database.dataset_generator import generate, DEFAULT_PASSWORD
+
+# Keyword arguments for dataset_generator.generate
+SCALES = {
+    "small": {"users": 100, "courses": 20, "months": 3, "working": 10, "logged_in": 20},
+    "medium": {"users": 1000, "courses": 50, "months": 12, "working": 50, "logged_in": 200},
+    "large": {"users": 5000, "courses": 100, "months": 24, "working": 250, "logged_in": 1000},
+}
+
+# Password hashing dominates these, so they are timed a few times only
+SLOW_ITERATIONS = 3
+
+
+def _hash(email):
+    return hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+
+class _Dataset:
+    """
+        The users and courses the benchmark cases work with, read from a generated database
+    """
+
+    def __init__(self, db_path):
+        con = sql.connect(db_path)
+        self.emails = [row[0] for row in con.execute("SELECT email FROM users ORDER BY id")]
+        self.admin_emails = [row[0] for row in con.execute("SELECT email FROM users WHERE admin=1 ORDER BY id")]
+        working = {row[0] for row in con.execute("SELECT uid FROM working")}
+        self.idle_emails = [row[1] for row in con.execute("SELECT id, email FROM users ORDER BY id")
+                            if row[0] not in working]
+        self.courses = [row[0] for row in con.execute("SELECT name FROM courses ORDER BY id")]
+        self.tokens = [row[0] for row in con.execute("SELECT token FROM logged_in")]
+        con.close()
+
+    def user(self, i):
+        return _hash(self.emails[i % len(self.emails)])
+
+    def admin(self, i):
+        return _hash(self.admin_emails[i % len(self.admin_emails)])
+
+    def idle(self, i):
+        return _hash(self.idle_emails[i % len(self.idle_emails)])
+
+
+def _cases(dh, data):
+    """
+        The benchmark cases, as (name, iterations, function) tuples, where function(i) runs the i-th
+    iteration. Cases with iterations None are run the number of times given on the command line.
+
+        The write cases are ordered so that every iteration is valid: start_work, update_time and
+    stop_work work on the same idle users, in turn.
+    """
+    admin = data.admin(0)
+    user = data.user(len(data.emails) // 2)
+
+    return [
+        ("get_courses_list", None, lambda i: dh.get_courses_list()),
+        ("get_courses_list_with_details", None, lambda i: dh.get_courses_list_with_details()),
+        ("get_working_users", None, lambda i: dh.get_working_users()),
+        ("get_logs", None, lambda i: dh.get_logs()),
+        ("get_leaderboard", None, lambda i: dh.get_leaderboard()),
+        ("get_history_for_user", None, lambda i: dh.get_history_for_user(admin, data.user(i))),
+        ("get_stats_for_user", None, lambda i: dh.get_stats_for_user(admin, data.user(i))),
+        ("get_user_details", None, lambda i: dh.get_user_details(admin, data.user(i))),
+        ("user_is_working", None, lambda i: dh.user_is_working(data.user(i))),
+        ("is_admin", None, lambda i: dh.is_admin(data.user(i))),
+        ("resolve_identity", None, lambda i: dh.resolve_identity(data.user(i))),
+        ("is_token_still_valid", None, lambda i: dh.is_token_still_valid(data.tokens[i % len(data.tokens)])),
+        ("get_version_token", None, lambda i: dh.get_version_token("users", "logs")),
+        ("start_work", None, lambda i: dh.start_work(data.idle(i), data.courses[i % len(data.courses)])),
+        ("update_time", None, lambda i: dh.update_time(data.idle(i), 60)),
+        ("stop_work", None, lambda i: dh.stop_work(data.idle(i), 60)),
+        ("update_user_name", None, lambda i: dh.update_user_name(admin, data.user(i), "Renamed " + str(i))),
+        ("add_user", None,
+            lambda i: dh.add_user(admin, "new" + str(i) + "@example.com", "New User", 0)),
+        ("logout_user", None, lambda i: dh.logout_user(data.user(i))),
+        ("verify_user", SLOW_ITERATIONS,
+            lambda i: dh.verify_user(data.emails[i % len(data.emails)], DEFAULT_PASSWORD)),
+        ("validate_user", SLOW_ITERATIONS,
+            lambda i: dh.validate_user(_hash("new" + str(i) + "@example.com"), DEFAULT_PASSWORD)),
+        ("signup", SLOW_ITERATIONS,
+            lambda i: dh.signup("signup" + str(i) + "@example.com", "Signed Up", DEFAULT_PASSWORD, False)),
+        ("update_user_password", SLOW_ITERATIONS,
+            lambda i: dh.update_user_password(user, DEFAULT_PASSWORD, DEFAULT_PASSWORD)),
+        ("update_user_password_as_admin", SLOW_ITERATIONS,
+            lambda i: dh.update_user_password_as_admin(admin, user, DEFAULT_PASSWORD)),
+    ]
+
+
+def _summarize(samples):
+    samples = sorted(samples)
+    return {
+        "iterations": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "min_ms": samples[0] * 1000,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+    }
+
+
+def run_scale(scale, iterations, cache_size, workdir, backend="sqlite"):
+    """
+        Function that generates a database for a scale and times every case on it
+
+    :param scale:           The name of the scale (a key of SCALES)
+    :param iterations:      How many times each (fast) case is run
+    :param cache_size:      The DatabaseHandler query cache size (0 times the uncached read paths)
+    :param workdir:         The directory the database is generated in
+    :param backend:         "sqlite" - the handler works on the database file
+                            "memory" - the handler works on a MemoryBackend loaded from it
+    :return:                A dictionary of the format {<method>: <timings>}
+    """
+    db_path = os.path.join(workdir, scale + ".db")
+    generate(db_path, **SCALES[scale])
+
+    data = _Dataset(db_path)
+    dh = DatabaseHandler(db_path, cache_size=cache_size, scan_threshold=None,
+                         backend=MemoryBackend(db_path) if backend == "memory" else None)
+
+    results = dict()
+    for name, case_iterations, function in _cases(dh, data):
+        samples = list()
+        for i in range(case_iterations or iterations):
+            start = time.perf_counter()
+            function(i)
+            samples.append(time.perf_counter() - start)
+
+        results[name] = _summarize(samples)
+        print("%-8s %-32s %10.3f ms" % (scale, name, results[name]["mean_ms"]))
+
+    return results
+
+
+def compare(old, new, threshold):
+    """
+        Function that compares two benchmark results
+
+    :param old:         The baseline results (as saved by this script)
+    :param new:         The new results
+    :param threshold:   The relative slowdown (e.g. 0.2 for 20%) above which a method counts as a regression
+    :return:            The list of regressions, as (scale, method, old_ms, new_ms) tuples
+    """
+    regressions = list()
+
+    for scale, methods in new["results"].items():
+        for method, timings in methods.items():
+            baseline = old["results"].get(scale, {}).get(method)
+            if baseline is None:
+                continue
+
+            ratio = timings["p50_ms"] / baseline["p50_ms"] if baseline["p50_ms"] > 0 else 1.0
+            print("%-8s %-32s %10.3f -> %10.3f ms (%+.0f%%)"
+                  % (scale, method, baseline["p50_ms"], timings["p50_ms"], (ratio - 1) * 100))
+
+            if ratio > 1 + threshold:
+                regressions.append((scale, method, baseline["p50_ms"], timings["p50_ms"]))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the DatabaseHandler methods")
+    parser.add_argument("--scales", default="small,medium", help="Comma-separated, among: " + ", ".join(SCALES))
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="Query cache size of the handler (default 0: time the uncached paths)")
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite",
+                        help="The storage of the handler (memory: the floor of the request path, without I/O)")
+    parser.add_argument("--output", help="Where to save the results, as JSON")
+    parser.add_argument("--compare", help="Results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative p50 slowdown reported as a regression when comparing")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "sqlite": sql.sqlite_version,
+            "iterations": args.iterations,
+            "cache_size": args.cache_size,
+            "backend": args.backend
+        },
+        "results": dict()
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for scale in args.scales.split(","):
+            results["results"][scale] = run_scale(scale, args.iterations, args.cache_size, workdir, args.backend)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+        regressions = compare(baseline, results, args.threshold)
+        for scale, method, old_ms, new_ms in regressions:
+            print("REGRESSION: %s %s %.3f -> %.3f ms" % (scale, method, old_ms, new_ms))
+
+        if regressions:
+            raise SystemExit(1)
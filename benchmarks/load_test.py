@@ -0,0 +1,392 @@
+"""
+    Replays a realistic traffic mix against the API and reports throughput and latency percentiles per route.
+
+    Usage (from the repository root):
+
+        # In-process, through the Flask test client, on a freshly generated database
+        python -m benchmarks.load_test --generate medium --concurrency 16 --duration 60
+
+        # Against a running server, using the users of the database it serves
+        python -m benchmarks.load_test --url http://127.0.0.1:5000 --db database/SMU-logs.db
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import random
+import sqlite3 as sql
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Relative weight of each scenario in the traffic mix
+DEFAULT_MIX = {
+    "work_session": 2,      # login, start-work, a few update-time heartbeats, stop-work
+    "heartbeat": 10,        # a single update-time, as sent every few seconds by working clients
+    "dashboard": 6,         # leaderboard, working-users and logs polling, with ETags
+    "login_burst": 1,       # several logins back to back, as at the start of a class
+    "check_session": 3,     # valid-session checks
+}
+
+DEFAULT_PASSWORD = "password"
+
+
+def _hash(email):
+    return hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+
+class FlaskClient:
+    """
+        Sends the requests to the Flask app in-process, through its test client
+    """
+
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._app.test_client()
+            self._local.client = client
+
+        response = client.open(path, method=method, json=body, headers=headers or {})
+        return response.status_code, response.headers, response.get_data()
+
+
+class HttpClient:
+    """
+        Sends the requests to a running server, over one keep-alive connection per thread
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self._host = parts.hostname
+        self._port = parts.port or 80
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        for attempt in range(2):
+            con = getattr(self._local, "con", None)
+            if con is None:
+                con = http.client.HTTPConnection(self._host, self._port, timeout=30)
+                self._local.con = con
+            try:
+                con.request(method, path, body=payload, headers=headers)
+                response = con.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, OSError):
+                # The server closed the connection: reconnect once
+                con.close()
+                self._local.con = None
+                if attempt == 1:
+                    raise
+
+
+class _Recorder:
+    """
+        Collects the latency of every request, per route. Each thread records into its own lists.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._per_thread = list()
+        self._local = threading.local()
+
+    def _own(self):
+        own = getattr(self._local, "samples", None)
+        if own is None:
+            own = dict()
+            self._local.samples = own
+            with self._lock:
+                self._per_thread.append(own)
+        return own
+
+    def record(self, route, seconds, status):
+        samples = self._own().setdefault(route, ([], []))
+        samples[0].append(seconds)
+        samples[1].append(status)
+
+    def merged(self, drain=False):
+        """
+        :param drain:   Whether to start over afterwards, so that long runs don't keep every sample
+        :return:        A dictionary of the format {<route>: ([<latency>, ...], [<status>, ...])}
+        """
+        merged = dict()
+        with self._lock:
+            for own in self._per_thread:
+                for route in list(own):
+                    latencies, statuses = own.pop(route) if drain else own[route]
+                    into = merged.setdefault(route, ([], []))
+                    into[0].extend(latencies)
+                    into[1].extend(statuses)
+        return merged
+
+
+class LoadTest:
+    """
+        A pool of virtual users, each picking scenarios from the traffic mix until the deadline
+    """
+
+    def __init__(self, client, users, courses, mix=None, think_time=0.0, seed=0):
+        """
+        :param client:          A FlaskClient or an HttpClient
+        :param users:           The emails of the users the virtual users log in as
+        :param courses:         The names of the courses they work on
+        :param mix:             The weight of each scenario (see DEFAULT_MIX)
+        :param think_time:      The pause between two requests of the same virtual user, in seconds
+        :param seed:            The seed of the random generators
+        """
+        self._client = client
+        self._users = users
+        self._courses = courses
+        self._mix = mix or DEFAULT_MIX
+        self._think_time = think_time
+        self._seed = seed
+        self._recorder = _Recorder()
+
+    def _send(self, route, method, path, body=None, headers=None):
+        start = time.perf_counter()
+        try:
+            status, response_headers, data = self._client.request(method, path, body, headers)
+        except Exception:
+            status, response_headers, data = 0, {}, b""
+        self._recorder.record(route, time.perf_counter() - start, status)
+
+        if self._think_time:
+            time.sleep(self._think_time)
+
+        return status, response_headers, data
+
+    def _login(self, worker, email):
+        status, headers, data = self._send("/user/login", "POST", "/user/login",
+                                           {"email": email, "password": DEFAULT_PASSWORD})
+        if status == 200:
+            try:
+                token = json.loads(data.decode("utf-8")).get("token")
+            except ValueError:
+                token = None
+            if token:
+                worker["tokens"] = (worker["tokens"] + [token])[-20:]
+
+    def _work_session(self, worker, rng):
+        email = worker["users"][rng.randrange(len(worker["users"]))]
+        user = _hash(email)
+
+        self._login(worker, email)
+        self._send("/start-work", "POST", "/start-work",
+                   {"id": user, "course": self._courses[rng.randrange(len(self._courses))]})
+        for beat in range(rng.randint(1, 5)):
+            self._send("/working/update-time", "PUT", "/working/update-time?id=%s&time=%d" % (user, 30 * (beat + 1)))
+        self._send("/stop-work", "POST", "/stop-work", {"id": user, "time": rng.randint(60, 3600)})
+
+    def _heartbeat(self, worker, rng):
+        user = _hash(worker["users"][rng.randrange(len(worker["users"]))])
+        self._send("/working/update-time", "PUT", "/working/update-time?id=%s&time=%d" % (user, rng.randint(1, 3600)))
+
+    def _dashboard(self, worker, rng):
+        for path in ("/stats/leaderboard", "/working-users", "/logs"):
+            headers = {"Accept-Encoding": "gzip"}
+            etag = worker["etags"].get(path)
+            if etag is not None:
+                headers["If-None-Match"] = etag
+
+            status, response_headers, data = self._send(path, "GET", path, headers=headers)
+            if status == 200 and response_headers.get("ETag"):
+                worker["etags"][path] = response_headers.get("ETag")
+
+    def _login_burst(self, worker, rng):
+        for _ in range(rng.randint(3, 8)):
+            self._login(worker, self._users[rng.randrange(len(self._users))])
+
+    def _check_session(self, worker, rng):
+        # Tokens from earlier logins, or an unknown one if this virtual user hasn't logged in yet
+        tokens = worker["tokens"]
+        token = tokens[rng.randrange(len(tokens))] if tokens else "%0128x" % rng.getrandbits(512)
+        self._send("/user/valid-session", "POST", "/user/valid-session", {"token": token})
+
+    def _run_worker(self, index, concurrency, deadline):
+        rng = random.Random(self._seed * 1000 + index)
+        scenarios = [getattr(self, "_" + name) for name in self._mix]
+        weights = list(self._mix.values())
+
+        # Every virtual user works with its own users, so that start/stop sequences don't collide
+        worker = {
+            "users": self._users[index::concurrency] or self._users,
+            "etags": dict(),
+            "tokens": list()
+        }
+
+        while time.monotonic() < deadline:
+            rng.choices(scenarios, weights)[0](worker, rng)
+
+    def run(self, concurrency, duration):
+        """
+            Method that runs the load test
+
+        :param concurrency:     The number of virtual users (threads)
+        :param duration:        How long to run for, in seconds
+        :return:                The report (see report())
+        """
+        deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=self._run_worker, args=(i, concurrency, deadline))
+                   for i in range(concurrency)]
+
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return self.report(time.monotonic() - start)
+
+    def report(self, elapsed, drain=False):
+        """
+        :param elapsed:     The wall-clock duration of the run, in seconds
+        :param drain:       Whether to only report on the requests since the last drained report
+        :return:            A dictionary of the format:
+                            {
+                                "duration_s": <elapsed>,
+                                "requests": <total_no_of_requests>,
+                                "throughput_rps": <requests_per_second>,
+                                "routes": {
+                                    <route>: {
+                                        "requests": ..., "throughput_rps": ..., "errors": <no_of_5xx_or_failed>,
+                                        "statuses": {<status>: <count>, ...},
+                                        "p50_ms": ..., "p95_ms": ..., "p99_ms": ..., "max_ms": ...
+                                    },
+                                    ...
+                                }
+                            }
+        """
+        routes = dict()
+        total = 0
+
+        for route, (latencies, statuses) in sorted(self._recorder.merged(drain).items()):
+            latencies = sorted(latencies)
+            count = len(latencies)
+            total += count
+
+            status_counts = dict()
+            for status in statuses:
+                status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+
+            routes[route] = {
+                "requests": count,
+                "throughput_rps": count / elapsed,
+                "errors": sum(1 for status in statuses if status == 0 or status >= 500),
+                "statuses": status_counts,
+                "p50_ms": _percentile(latencies, 0.50) * 1000,
+                "p95_ms": _percentile(latencies, 0.95) * 1000,
+                "p99_ms": _percentile(latencies, 0.99) * 1000,
+                "max_ms": latencies[-1] * 1000,
+            }
+
+        return {
+            "duration_s": elapsed,
+            "requests": total,
+            "throughput_rps": total / elapsed,
+            "routes": routes
+        }
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def print_report(report):
+    print("%-24s %9s %9s %7s %9s %9s %9s" % ("route", "requests", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    for route, stats in report["routes"].items():
+        print("%-24s %9d %9.1f %7d %9.2f %9.2f %9.2f" % (route, stats["requests"], stats["throughput_rps"],
+                                                         stats["errors"], stats["p50_ms"], stats["p95_ms"],
+                                                         stats["p99_ms"]))
+    print("total: %d requests in %.1f s (%.1f req/s)"
+          % (report["requests"], report["duration_s"], report["throughput_rps"]))
+
+
+def load_dataset(db_path):
+    """
+    :param db_path:     The database the server under test uses
+    :return:            -> the emails of its users that have a password set
+                        -> the names of its courses
+    """
+    con = sql.connect(db_path)
+    users = [row[0] for row in con.execute("SELECT email FROM users WHERE password IS NOT NULL ORDER BY id")]
+    courses = [row[0] for row in con.execute("SELECT name FROM courses ORDER BY id")]
+    con.close()
+    return users, courses
+
+
+def parse_mix(value):
+    """
+    :param value:   A string of the format "work_session=2,dashboard=6,..."
+    :return:        The mix, as a dictionary (scenarios that aren't mentioned keep their default weight)
+    """
+    mix = dict(DEFAULT_MIX)
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in DEFAULT_MIX:
+            raise ValueError("Unknown scenario: " + name)
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def in_process_client(db_path, backend="sqlite"):
+    """
+        Function that imports the server on the given database and returns a client for it
+    """
+    os.environ["DATABASE_PATH"] = db_path
+    os.environ["DATABASE_BACKEND"] = backend
+    import server
+    return FlaskClient(server.app)
+
+
+if __name__ == "__main__":
+    from benchmarks.handler_benchmark import SCALES
+
+    parser = argparse.ArgumentParser(description="Load test the API")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", help="Base URL of a running server (default: in-process Flask test client)")
+    parser.add_argument("--db", help="The database the server uses (in-process mode: the database to serve)")
+    parser.add_argument("--generate", choices=sorted(SCALES), help="Serve a freshly generated database (in-process)")
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite",
+                        help="The storage the server uses (in-process)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30, help="In seconds")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Pause between requests, in seconds")
+    parser.add_argument("--mix", help="Scenario weights, e.g. work_session=2,dashboard=6")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Where to save the report, as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    db_path = args.db
+    if args.generate:
+        from database.dataset_generator import generate
+        db_path = os.path.join(workdir, args.generate + ".db")
+        generate(db_path, **SCALES[args.generate])
+
+    if db_path is None:
+        parser.error("--db or --generate is required")
+
+    client = HttpClient(args.url) if args.url else in_process_client(db_path, args.backend)
+    users, courses = load_dataset(db_path)
+
+    test = LoadTest(client, users, courses, parse_mix(args.mix) if args.mix else None, args.think_time, args.seed)
+    report = test.run(args.concurrency, args.duration)
+    report["concurrency"] = args.concurrency
+    report["target"] = args.url or "in-process"
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,285 @@
+"""
+    Runs the server in-process under synthetic load for hours, sampling memory, file descriptors
+    and SQLite statistics, to find what grows (or slows down) with uptime.
+
+    Usage (from the repository root):
+
+        python -m benchmarks.soak_test --generate medium --hours 12 --interval 300 --output soak.json
+"""
+import argparse
+import ctypes
+import ctypes.util
+import json
+import linecache
+import os
+import sqlite3 as sql
+import tempfile
+import threading
+import time
+import tracemalloc
+from benchmarks.load_test import LoadTest, in_process_client, load_dataset
+
+# sqlite3_status() operation codes
+_SQLITE_STATUS_MEMORY_USED = 0
+_SQLITE_STATUS_PAGECACHE_USED = 1
+_SQLITE_STATUS_PAGECACHE_OVERFLOW = 2
+
+
+def _load_sqlite_library():
+    """
+        The sqlite3 module doesn't expose sqlite3_status(), but on most systems it links the shared
+    SQLite library, which ctypes can load a second handle to.
+    """
+    try:
+        library = ctypes.CDLL(ctypes.util.find_library("sqlite3"))
+        library.sqlite3_status64
+    except (OSError, TypeError, AttributeError):
+        return None
+
+    library.sqlite3_status64.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                         ctypes.POINTER(ctypes.c_int64), ctypes.c_int]
+    return library
+
+
+_sqlite_library = _load_sqlite_library()
+
+
+def sqlite_status(op):
+    """
+    :param op:      A sqlite3_status() operation code
+    :return:        The (current, highwater) values, or None if the library isn't reachable
+    """
+    if _sqlite_library is None:
+        return None
+
+    current, highwater = ctypes.c_int64(), ctypes.c_int64()
+    if _sqlite_library.sqlite3_status64(op, ctypes.byref(current), ctypes.byref(highwater), 0) != 0:
+        return None
+    return current.value, highwater.value
+
+
+def rss_bytes():
+    """
+    :return:    The resident set size of the process, or None where /proc isn't available
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def open_fds():
+    """
+    :return:    The number of open file descriptors of the process, or None where /proc isn't available
+    """
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def database_stats(db_path):
+    """
+    :param db_path:     The database the server uses
+    :return:            The size of the database file (and of its WAL, if any), and its page statistics
+    """
+    con = sql.connect(db_path)
+    try:
+        page_size = con.execute("PRAGMA page_size").fetchone()[0]
+        page_count = con.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = con.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        con.close()
+
+    wal_path = db_path + "-wal"
+    return {
+        "file_bytes": os.path.getsize(db_path),
+        "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist_count,
+    }
+
+
+def take_sample(started, db_path, handler, test, window_seconds):
+    """
+        Function that samples the state of the process and the latencies of the last window
+    """
+    traced, traced_peak = tracemalloc.get_traced_memory()
+    window = test.report(window_seconds, drain=True)
+
+    routes = list(window["routes"].values())
+    sample = {
+        "elapsed_s": time.monotonic() - started,
+        "rss_bytes": rss_bytes(),
+        "open_fds": open_fds(),
+        "threads": threading.active_count(),
+        "traced_bytes": traced,
+        "traced_peak_bytes": traced_peak,
+        "requests": window["requests"],
+        "throughput_rps": window["throughput_rps"],
+        "errors": sum(stats["errors"] for stats in routes),
+        # The slowest route's percentile, so a regression on any route shows up
+        "p95_ms": max([stats["p95_ms"] for stats in routes] or [0]),
+        "p99_ms": max([stats["p99_ms"] for stats in routes] or [0]),
+        "query_cache_entries": handler.get_cache_stats()["entries"],
+        "database": database_stats(db_path),
+    }
+
+    for name, op in (("sqlite_memory_used", _SQLITE_STATUS_MEMORY_USED),
+                     ("sqlite_pagecache_used", _SQLITE_STATUS_PAGECACHE_USED),
+                     ("sqlite_pagecache_overflow", _SQLITE_STATUS_PAGECACHE_OVERFLOW)):
+        status = sqlite_status(op)
+        sample[name] = status[0] if status is not None else None
+
+    return sample
+
+
+def trend(samples, field):
+    """
+        Function that fits a line through the samples of a field
+
+    :return:    A dictionary with the first and last values, and the growth per hour (least squares),
+                or None if the field wasn't sampled
+    """
+    points = [(sample["elapsed_s"] / 3600.0, sample[field]) for sample in samples if sample[field] is not None]
+    if len(points) < 2:
+        return None
+
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance if variance else 0.0
+
+    return {
+        "first": points[0][1],
+        "last": points[-1][1],
+        "per_hour": slope,
+    }
+
+
+def top_allocations(baseline, final, limit):
+    """
+    :return:    The allocation sites that grew the most between the two tracemalloc snapshots
+    """
+    ignored = (tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, linecache.__file__),
+               tracemalloc.Filter(False, __file__))
+
+    statistics = final.filter_traces(ignored).compare_to(baseline.filter_traces(ignored), "traceback")
+
+    return [{
+        "size_diff_bytes": stat.size_diff,
+        "size_bytes": stat.size,
+        "count_diff": stat.count_diff,
+        "traceback": [str(frame.filename) + ":" + str(frame.lineno) for frame in stat.traceback],
+    } for stat in statistics[:limit]]
+
+
+def soak(db_path, hours, interval, concurrency, think_time=0.0, warmup=60, frames=5, top=20, seed=0):
+    """
+        Function that runs the load test on an in-process server for a number of hours
+
+    :param db_path:         The database to serve
+    :param hours:           How long to run for
+    :param interval:        How often to take a sample, in seconds
+    :param concurrency:     The number of virtual users
+    :param think_time:      The pause between two requests of the same virtual user, in seconds
+    :param warmup:          How long to run before the baseline tracemalloc snapshot, in seconds, so
+                            that caches filling up once don't count as growth
+    :param frames:          The number of frames tracemalloc keeps per allocation
+    :param top:             The number of allocation sites to report
+    :param seed:            The seed of the random generators
+    :return:                A dictionary with the samples, the trends and the top allocation sites
+    """
+    tracemalloc.start(frames)
+
+    client = in_process_client(db_path)
+    import server
+
+    users, courses = load_dataset(db_path)
+    test = LoadTest(client, users, courses, think_time=think_time, seed=seed)
+
+    duration = hours * 3600
+    runner = threading.Thread(target=test.run, args=(concurrency, duration), daemon=True)
+
+    started = time.monotonic()
+    runner.start()
+
+    time.sleep(min(warmup, duration))
+    test.report(1, drain=True)
+    baseline = tracemalloc.take_snapshot()
+
+    samples = list()
+    last = time.monotonic()
+    while runner.is_alive():
+        runner.join(interval)
+        now = time.monotonic()
+        samples.append(take_sample(started, db_path, server.dh, test, now - last))
+        last = now
+
+        sample = samples[-1]
+        print("%7.0f s  %8.1f req/s  p95 %8.2f ms  rss %8.1f MB  traced %8.1f MB  fds %4s  errors %d"
+              % (sample["elapsed_s"], sample["throughput_rps"], sample["p95_ms"],
+                 (sample["rss_bytes"] or 0) / 2 ** 20, sample["traced_bytes"] / 2 ** 20,
+                 sample["open_fds"], sample["errors"]))
+
+    final = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    for sample in samples:
+        sample["database_bytes"] = sample["database"]["file_bytes"] + sample["database"]["wal_bytes"]
+
+    return {
+        "samples": samples,
+        "trends": {field: trend(samples, field)
+                   for field in ("rss_bytes", "traced_bytes", "open_fds", "threads", "sqlite_memory_used",
+                                 "query_cache_entries", "database_bytes", "throughput_rps", "p95_ms", "p99_ms")},
+        "top_allocations": top_allocations(baseline, final, top),
+    }
+
+
+if __name__ == "__main__":
+    from benchmarks.handler_benchmark import SCALES
+
+    parser = argparse.ArgumentParser(description="Soak test the API in-process")
+    parser.add_argument("--db", help="The database to serve (it is written to)")
+    parser.add_argument("--generate", choices=sorted(SCALES), help="Serve a freshly generated database")
+    parser.add_argument("--hours", type=float, default=1)
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between two samples")
+    parser.add_argument("--warmup", type=float, default=60, help="Seconds before the baseline snapshot")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--frames", type=int, default=5, help="Frames tracemalloc keeps per allocation")
+    parser.add_argument("--top", type=int, default=20, help="Number of allocation sites to report")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Where to save the report, as JSON")
+    args = parser.parse_args()
+
+    db_path = args.db
+    if args.generate:
+        from database.dataset_generator import generate
+        db_path = os.path.join(tempfile.mkdtemp(), args.generate + ".db")
+        generate(db_path, **SCALES[args.generate])
+
+    if db_path is None:
+        parser.error("--db or --generate is required")
+
+    report = soak(db_path, args.hours, args.interval, args.concurrency, args.think_time, args.warmup,
+                  args.frames, args.top, args.seed)
+
+    print()
+    for field, growth in report["trends"].items():
+        if growth is not None:
+            print("%-22s %14.1f -> %14.1f  (%+.1f / hour)" % (field, growth["first"], growth["last"],
+                                                              growth["per_hour"]))
+
+    print()
+    for allocation in report["top_allocations"]:
+        print("%+12d B  %+8d blocks  %s" % (allocation["size_diff_bytes"], allocation["count_diff"],
+                                            allocation["traceback"][-1] if allocation["traceback"] else "?"))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,239 @@
+"""
+    Online backups of the database, taken while the server keeps writing to it. POSIX only: the
+    processes taking them agree on which one does through fcntl locks.
+
+    Usage (from the repository root), for a one-off backup:
+
+        python -m database.backup_manager database/SMU-logs.db backups/ --keep 7
+"""
+import argparse
+import fcntl
+import logging
+import os
+import sqlite3 as sql
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+class BackupManager:
+    """
+        Takes backups of a database with SQLite's online backup API and rotates them.
+
+        The copy is made a few pages at a time, so writers are never held up for more than one
+    step. With a DatabaseHandler, the copy is made by its writer thread, which commits the queued
+    writes between two steps, so that writes made during the copy don't make it start over.
+    Otherwise, it sleeps between steps. Writes
+    from other connections (e.g. other processes) still do: after max_restarts, the copy is made
+    again in a single step, which can't be interrupted but holds up the writes for its whole duration.
+
+        Backups are named <database>-<YYYYmmdd-HHMMSS>.db and only the newest ones are kept. When
+    several processes run a BackupManager on the same directory (e.g. the workers of a prefork
+    server), a lock file makes sure only one of them takes each backup.
+    """
+
+    def __init__(self, db_path, backup_dir, keep=7, pages_per_step=256, step_sleep=0.005, handler=None,
+                 max_restarts=3):
+        """
+        :param db_path:             The path of the database to back up
+        :param backup_dir:          The directory the backups are written to
+        :param keep:                How many backups to keep
+        :param pages_per_step:      How many pages are copied at a time
+        :param step_sleep:          How long to sleep between two steps, in seconds
+        :param handler:             The DatabaseHandler writing to the database, if any
+        :param max_restarts:        How many times a copy can start over before it is made in a single step
+        """
+        self._db_path = db_path
+        self._backup_dir = backup_dir
+        self._keep = keep
+        self._pages_per_step = pages_per_step
+        self._step_sleep = step_sleep
+        self._handler = handler
+        self._max_restarts = max_restarts
+
+        self._prefix = os.path.splitext(os.path.basename(db_path))[0] + "-"
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+        self._stats = {
+            "backups": 0,
+            "failures": 0,
+            "last_duration_s": 0.0,
+            "last_bytes": 0,
+            "last_steps": 0,
+            "last_restarts": 0,
+            "last_success": None,
+            "bytes_total": 0,
+            "seconds_total": 0.0,
+        }
+
+    def backups(self):
+        """
+        :return:    The paths of the existing backups, oldest first
+        """
+        if not os.path.isdir(self._backup_dir):
+            return []
+
+        names = sorted(name for name in os.listdir(self._backup_dir)
+                       if name.startswith(self._prefix) and name.endswith(".db"))
+        return [os.path.join(self._backup_dir, name) for name in names]
+
+    def run(self):
+        """
+            Method that takes a backup, then deletes the oldest ones
+
+        :return:    The path of the new backup, or None if another process is taking one
+        """
+        os.makedirs(self._backup_dir, exist_ok=True)
+
+        with open(os.path.join(self._backup_dir, "." + self._prefix + "lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+
+            path = os.path.join(self._backup_dir, self._prefix + time.strftime("%Y%m%d-%H%M%S") + ".db")
+            temporary = path + ".tmp"
+            steps = [0]
+            restarts = [0]
+            remaining_before = [None]
+
+            def progress(status, remaining, total):
+                steps[0] += 1
+                if remaining_before[0] is not None and remaining > remaining_before[0]:
+                    restarts[0] += 1
+                    if restarts[0] > self._max_restarts:
+                        raise _TooManyRestarts()
+                remaining_before[0] = remaining
+
+                # Let the writers in between two steps (the writer thread of a handler commits them itself)
+                if self._handler is None:
+                    time.sleep(self._step_sleep)
+
+            start = time.perf_counter()
+            try:
+                target = sql.connect(temporary)
+                try:
+                    try:
+                        self._copy(target, self._pages_per_step, progress)
+                    except _TooManyRestarts:
+                        logger.warning("Backup of %s restarted %d times, copying it in a single step",
+                                       self._db_path, restarts[0])
+                        self._copy(target, -1, None)
+                finally:
+                    target.close()
+
+                os.replace(temporary, path)
+            except Exception:
+                logger.exception("Could not back up %s", self._db_path)
+                with self._lock:
+                    self._stats["failures"] += 1
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(path)
+
+            with self._lock:
+                self._stats["backups"] += 1
+                self._stats["last_duration_s"] = elapsed
+                self._stats["last_bytes"] = size
+                self._stats["last_steps"] = steps[0]
+                self._stats["last_restarts"] = restarts[0]
+                self._stats["last_success"] = time.time()
+                self._stats["bytes_total"] += size
+                self._stats["seconds_total"] += elapsed
+
+            for old in self.backups()[:-self._keep]:
+                os.remove(old)
+
+            logger.info("Backed up %s to %s (%d bytes, %d steps, %.2f s)", self._db_path, path, size, steps[0],
+                        elapsed)
+            return path
+
+    def _copy(self, target, pages, progress):
+        if self._handler is not None:
+            self._handler.backup_to(target, pages, self._step_sleep, progress)
+            return
+
+        source = sql.connect(self._db_path)
+        try:
+            source.backup(target, pages=pages, progress=progress, sleep=self._step_sleep)
+        finally:
+            source.close()
+
+    def start(self, interval):
+        """
+            Method that takes a backup every interval seconds, on a background thread. A backup is
+        skipped if the newest one (taken by any process) is more recent than that.
+
+        :param interval:    The time between two backups, in seconds
+        """
+        def loop():
+            while not self._stop.is_set():
+                existing = self.backups()
+                age = time.time() - os.path.getmtime(existing[-1]) if existing else None
+
+                if age is None or age >= interval:
+                    try:
+                        self.run()
+                    except Exception:
+                        pass
+                    age = 0
+
+                self._stop.wait(interval - age)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=loop, name="backups", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "backups": <no_of_backups_taken_by_this_process>,
+                        "failures": <no_of_backups_that_failed>,
+                        "last_duration_s": <time_the_last_backup_took>,
+                        "last_bytes": <size_of_the_last_backup>,
+                        "last_steps": <no_of_steps_of_the_last_backup>,
+                        "last_restarts": <no_of_times_the_last_backup_started_over>,
+                        "last_success": <epoch_of_the_last_backup> (None if there was none),
+                        "bytes_total": <bytes_written_by_all_the_backups>,
+                        "seconds_total": <time_taken_by_all_the_backups>
+                    }
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Back up the database while it is in use")
+    parser.add_argument("db_path")
+    parser.add_argument("backup_dir")
+    parser.add_argument("--keep", type=int, default=7, help="How many backups to keep")
+    parser.add_argument("--pages-per-step", type=int, default=256)
+    parser.add_argument("--step-sleep", type=float, default=0.005, help="In seconds")
+    args = parser.parse_args()
+
+    manager = BackupManager(args.db_path, args.backup_dir, args.keep, args.pages_per_step, args.step_sleep)
+    path = manager.run()
+
+    if path is None:
+        print("Another backup is in progress")
+    else:
+        stats = manager.stats()
+        print("Backed up to " + path + ": " + str(stats["last_bytes"]) + " bytes in "
+              + "%.2f s" % stats["last_duration_s"])
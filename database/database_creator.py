@@ -1,4 +1,8 @@
 import sqlite3 as sql
+from database.table_generations import version_table_statements
+from database.log_partitions import log_partitions_table_statements
+from database.log_retention import logs_daily_table_statements
+from database.maintenance import enable_incremental_vacuum
 
 db_path = ""
 
@@ -48,7 +52,7 @@ def create_logged_in_table():
             "logged_in (" \
                 "token CHAR(64) PRIMARY KEY, " \
                 "uid INTEGER NOT NULL, " \
-                "last_login DATE NOT NULL, " \
+                "last_login INTEGER NOT NULL, " \
                 "TTL INTEGER NOT NULL, " \
                 "FOREIGN KEY(uid) REFERENCES users(id) " \
             ");"
@@ -56,12 +60,23 @@ def create_logged_in_table():
     execute_query(query)
 
 
+def create_revoked_sessions_table():
+    query = "CREATE TABLE IF NOT EXISTS " \
+            "revoked_sessions (" \
+                "uid INTEGER PRIMARY KEY, " \
+                "revoked_at INTEGER NOT NULL, " \
+                "FOREIGN KEY(uid) REFERENCES users(id) " \
+            ");"
+
+    execute_query(query)
+
+
 def create_working_table():
     query = "CREATE TABLE IF NOT EXISTS " \
             "working (" \
                 "uid INTEGER PRIMARY KEY, " \
                 "working INTEGER NOT NULL DEFAULT 0, " \
-                "since DATE, " \
+                "since INTEGER, " \
                 "cid INTEGER NOT NULL, " \
                 "time INTEGER NOT NULL DEFAULT 0, " \
                 "FOREIGN KEY(uid) REFERENCES users(id), " \
@@ -108,8 +123,8 @@ def create_log_table():
                 "uid INTEGER NOT NULL, " \
                 "cid INTEGER NOT NULL, " \
                 "duration INTEGER NOT NULL, " \
-                "started_at DATE, " \
-                "logged_at DATE, " \
+                "started_at INTEGER, " \
+                "logged_at INTEGER, " \
                 "FOREIGN KEY(cid) REFERENCES courses(id), " \
                 "FOREIGN KEY(uid) REFERENCES users(id)" \
             ");"
@@ -117,14 +132,47 @@ def create_log_table():
     execute_query(query)
 
 
+def create_log_indexes():
+    execute_query("CREATE INDEX IF NOT EXISTS logs_started_at ON logs(started_at);")
+    execute_query("CREATE INDEX IF NOT EXISTS logs_uid_started_at ON logs(uid, started_at);")
+
+
+def create_log_partitions_tables():
+    for query in log_partitions_table_statements():
+        execute_query(query)
+
+
+def create_logs_daily_table():
+    for query in logs_daily_table_statements():
+        execute_query(query)
+
+
+def create_table_versions():
+    for query in version_table_statements():
+        execute_query(query)
+
+
+def set_incremental_vacuum():
+    con = sql.connect(db_path)
+    pages = con.execute("PRAGMA page_count;").fetchone()[0]
+    con.close()
+
+    # Only a new database is switched right away: an existing one has to be rebuilt (see database/maintenance.py)
+    if pages == 0:
+        enable_incremental_vacuum(db_path)
+
+
 def create_all(path):
     global db_path
     db_path = path
+    set_incremental_vacuum()
     print("Creating tables...")
     create_users_table()
     print("Created users table!")
     create_logged_in_table()
     print("Created logged_in table!")
+    create_revoked_sessions_table()
+    print("Created revoked_sessions table!")
     create_working_table()
     print("Created working table!")
     create_course_categories_table()
@@ -133,8 +181,16 @@ def create_all(path):
     print("Created courses table!")
     create_log_table()
     print("Created logs table!")
+    create_log_indexes()
+    print("Created logs indexes!")
+    create_log_partitions_tables()
+    print("Created log_partitions tables!")
+    create_logs_daily_table()
+    print("Created logs_daily table!")
     create_rights_table()
     print("Created rights table!")
+    create_table_versions()
+    print("Created table versions!")
     print("Done!")
 
 if __name__ == "__main__":
@@ -1,15 +1,52 @@
-import sqlite3 as sql
-from datetime import datetime as dt
-from dateutil import parser as dt_parse
-import datetime
-from passlib.hash import pbkdf2_sha256
 import secrets
+import threading
 import time
+from database.query_cache import QueryCache, cached_read
+from database.single_flight import SingleFlight
+from database.identity import Identity
+from database.session_tokens import SessionTokenSigner
+from database.password_hasher import PasswordHasher
+from database.storage_backend import ConstraintError
+from database.sqlite_backend import SQLiteBackend
+from database.event_journal import EventJournal
+from database.timestamps import to_epoch, format_timestamp
+
+
+def _epoch_now():
+    return int(time.time())
 
 
 class DatabaseHandler:
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, cache_size=256, scan_threshold=1000, session_secret=None, revocation_refresh=60,
+                 write_batch=64, shared_generations=False, password_processes=0, snapshot_staleness=None,
+                 backend=None, password_hasher=None, journal_path=None):
+        """
+        :param db_path:             The path of the SQLite database file (ignored if a backend is given)
+        :param cache_size:          How many read results to cache (0 disables the cache)
+        :param scan_threshold:      Queries doing full scans of tables bigger than this get flagged
+                                    by the profiler (None disables the check)
+        :param session_secret:      If given, login tokens are HMAC-signed with it and validated without
+                                    touching the database. Otherwise, random tokens stored in logged_in are used
+        :param revocation_refresh:  How often (in seconds) the revoked sessions are reloaded from the database,
+                                    so that logouts handled by other workers are picked up
+        :param write_batch:         The maximum number of writes the writer thread commits together
+        :param shared_generations:  If True, the table generations the cache and the version tokens rely on
+                                    are kept in the database (by triggers), so that they see the writes of
+                                    other processes. Needed when several workers serve the same database
+        :param password_processes:  If not 0, passwords are hashed on a pool of that many processes
+        :param snapshot_staleness:  If given, the analytics reads (logs, leaderboard, history, stats) are served
+                                    from a copy of the database refreshed once it is older than this
+                                    many seconds, instead of from the live database
+        :param backend:             The StorageBackend to use instead of the SQLite database file, e.g. a
+                                    MemoryBackend. The SQLite specific options above don't apply to it
+        :param password_hasher:     The PasswordHasher to use instead of a pool of password_processes, if shared
+                                    with other handlers (e.g. the shards of a ShardedHandler)
+        :param journal_path:        If given, the work session events (start_work, stop_work, update_time) are
+                                    made durable in this journal before being applied (see EventJournal),
+                                    so that the sessions can be rebuilt from it (see event_journal.replay).
+                                    They then wait for an fsync of the journal as well as for the commit
+        """
         self._users_table = "users"
         self._working_table = "working"
         self._logs_table = "logs"
@@ -18,31 +55,40 @@ class DatabaseHandler:
 
         self._DEFAULT_TTL = 7200  # 2 hours
 
-        self._dbName = db_path
-
-    def _execute_query(self, query, *args):
-        """
-            Function that executes a given query, except SELECT queries
-        :param query:       the query to be executed
-        :param args:        the arguments to be inserted
-        :return:
-        """
-
-        con = sql.connect(self._dbName)
-        cur = con.cursor()
-        cur.execute(query, args)
-        con.commit()
-        con.close()
+        if backend is None:
+            backend = SQLiteBackend(db_path, scan_threshold, write_batch, shared_generations, snapshot_staleness)
+        self._storage = backend
+
+        self._query_cache = QueryCache(cache_size)
+        self._single_flight = SingleFlight()
+        self.profiler = self._storage.profiler
+        self._request_scope = threading.local()
+        self._password_hasher = password_hasher if password_hasher is not None \
+            else PasswordHasher(password_processes)
+
+        self._session_signer = None
+        self._revocations = dict()
+        self._revocations_loaded_at = 0
+        self._revocation_refresh = revocation_refresh
+
+        if session_secret is not None:
+            self._session_signer = SessionTokenSigner(session_secret)
+            self._load_revocations()
+
+        self._journal = None
+        if journal_path is not None:
+            self._journal = EventJournal(journal_path)
+            # A new journal starts from the users working now, which the events are applied to
+            self._journal.start(lambda: [(uid, cid, to_epoch(since), time) for uid, cid, since, time in
+                                         self._storage.select(self._working_table, {"working": 1},
+                                                              ["uid", "cid", "since", "time"])])
 
     def _encrypt_pass(self, password):
         """
         :param password:        the password to encrypt
         :return:                the encrypted password
         """
-        hash = pbkdf2_sha256.encrypt(password,
-                                     rounds=200000,
-                                     salt_size=16)
-        return hash
+        return self._password_hasher.hash(password)
 
     def _check_pass(self, password, hash):
         """
@@ -51,154 +97,288 @@ class DatabaseHandler:
         :return:                True - if the passwords match
                                 False - otherwise
         """
-        return pbkdf2_sha256.verify(password, hash)
+        return self._password_hasher.verify(password, hash)
+
+    @cached_read("users")
+    def _get_users_by_hash(self):
+        """
+            Method that indexes all the users by the hash of their email.
+            The index is cached until the next write to the users table.
 
-    def _execute_DELETE(self, table, conds, *args):
+        :return:        A dictionary of the format {<email_hash>: <user_row>}
         """
-            Method that deletes an entry from a table
+        return {self._get_sha256_encryption(user[1]): user
+                for user in self._storage.select(self._users_table)}
 
-        :param table:       the name of the table to delete from
-        :param conds:       The conditions used to identify the row we want to delete
-        :param args:        The values of the variables used in the conditions
-        :return:            -
+    def _get_user_from_hash(self, hash):
         """
+            Method that identifies an user based on the hash of the email
 
-        query = "DELETE FROM " + table + " WHERE " + conds
-        self._execute_query(query, *args)
+        :param hash:    the hash of the email we're looking for
+        :return:        -> A tuple representing the row corresponding to that user
+                        -> None: otherwise
+        """
+        return self._get_users_by_hash().get(hash)
 
-    def _execute_INSERT(self, table, cols, *args):
+    def begin_request_scope(self):
         """
-        :param table:       the table to insert into
-        :param cols:        the list of columns we want to insert to
-        :param items:       the list of items we want to insert
-        :return:            -
+            Method that starts a request scope for the calling thread. Until end_request_scope is
+        called, every user is resolved at most once.
         """
+        self._request_scope.identities = dict()
 
-        query = "INSERT INTO " + table + " ("
+    def end_request_scope(self):
+        self._request_scope.identities = None
 
-        qmarks = "("
+    def resolve_identity(self, user):
+        """
+            Method that resolves a user, at most once per request scope
 
-        for col in cols:
-            qmarks = qmarks + "?"
-            query += col
-            if col != cols[-1]:
-                query += ", "
-                qmarks += ", "
-            else:
-                query += ") "
-                qmarks += ") "
+        :param user:    The email hash of the user, or an already resolved Identity
+        :return:        -> The Identity of the user
+                        -> None: if there is no such user
+        """
+        if isinstance(user, Identity):
+            return user
 
-        query += "VALUES " + qmarks
+        identities = getattr(self._request_scope, "identities", None)
+        if identities is not None and user in identities:
+            return identities[user]
 
+        row = self._get_user_from_hash(user)
+        identity = Identity(user, row) if row is not None else None
 
+        if identities is not None:
+            identities[user] = identity
 
-        self._execute_query(query, *args)
+        return identity
 
-    def _execute_SELECT(self, table, conds, cols=["*"], limit=None, order=None, groupBy=None, *args):
+    def _get_user_row(self, user):
         """
-                    function that executes a SELECT query
-        :param cols:        the list of columns we want. default ['*']
-        :param table:       the table name
-        :param conds:       the conditions, as a string
-        :param limit:       how many results to return. default None
-        :param order:       the way to order the results. default None
-        :param groupBy:     the way to group the results. default None
-        :return:            the list representing the results of the query
+        :param user:    The email hash of the user, or an already resolved Identity
+        :return:        -> A tuple representing the row corresponding to that user
+                        -> None: otherwise
         """
+        identity = self.resolve_identity(user)
+        return identity.row if identity is not None else None
 
-        cols_string = ",".join(cols)
-        query = "SELECT " + cols_string + " FROM " + str(table)
+    def _has_rights_over(self, asker, user):
+        """
+        :param asker:   The Identity of the user asking (None if the user doesn't exist)
+        :param user:    The email hash or the Identity of the user the request is about
+        :return:        True - if the asker is an admin, or the same user
+                        False - otherwise
+        """
+        if asker is None:
+            return False
 
-        if conds != None:
-            query += " WHERE " + str(conds)
+        if asker.admin:
+            return True
 
-        if order != None:
-            query += " ORDER BY " + str(order)
+        if isinstance(user, Identity):
+            return user.uid == asker.uid
 
-        if groupBy != None:
-            query += " GROUP BY " + str(groupBy)
+        return user == asker.email_hash
 
-        if limit != None:
-            query += " LIMIT " + str(limit)
+    def _get_sha256_encryption(self, plaintext):
+        """
+            Method that takes a plaintext message and returns its sha256 encryption
 
-        con = sql.connect(self._dbName)
-        cur = con.cursor()
-        cur.execute(query, args)
-        results = list(set(cur.fetchall()))
-        con.commit()
-        con.close()
+        :param plaintext:       The text to encrypt
+        :return:                the SHA-256 encryption as a base64 string
+        """
+        import hashlib
+        return hashlib.sha256(plaintext.encode('utf-8')).hexdigest()
 
-        return results
+    def _generations_for(self, from_snapshot):
+        """
+        :param from_snapshot:   Whether the reads are served from the read snapshot
+        :return:                The generations those reads are versioned by
+        """
+        return self._storage.generations(from_snapshot)
 
-    def _execute_UPDATE(self, table, cols, new_values, conds, conds_args):
+    def get_version_token(self, *tables, from_snapshot=False):
         """
-            Method that updates a database table
+            Method that returns a cheap version token for the given tables.
+            The token changes every time one of the tables is written to, so it can be used
+        as an ETag for responses built only from those tables.
 
-        :param table:           The table we execute the update in
-        :param cols:            The columns we update, as a list
-        :param new_values:      The new values for the corresponding columns, also as a list
-        :param conds:           The conditions to identify the row(s) to update
-        :param conds_args:      The arguments for the conditions, as a list!!!
-        :return:                -
+        :param tables:          The names of the tables the response depends on
+        :param from_snapshot:   True - if the response is built from the read snapshot, whose
+                                version changes when it is refreshed instead
+        :return:                The version token, as a string
         """
-        query = "UPDATE " + table + " SET "
+        return self._generations_for(from_snapshot).token(tables)
 
-        for i in range(len(cols)):
-            item = str(cols[i]) + "=?"
-            if i != len(cols) - 1:
-                item += ", "
-            else:
-                item += " "
+    def get_database_path(self):
+        """
+        :return:    The path of the SQLite database file (None if the backend isn't file backed)
+        """
+        return self._storage.path
 
-            query += item
+    def register_log_partition(self, path, starts_at, ends_at, last_id, rows):
+        """
+            Method that puts an archive file written by LogArchiver in place of the logs it holds
+        (see SQLiteBackend.register_log_partition)
+        """
+        self._storage.register_log_partition(path, starts_at, ends_at, last_id, rows)
 
-        query += " WHERE " + conds
-        arg = new_values+conds_args
+    def downsample_logs(self, cutoff, batch_size):
+        """
+            Method that rolls the oldest logs started before cutoff up into their daily totals
+        (see SQLiteBackend.downsample_logs)
 
-        self._execute_query(query, *arg)
+        :return:            The number of logs rolled up
+        """
+        return self._storage.downsample_logs(cutoff, batch_size)
 
-    def _get_user_from_hash(self, hash):
+    def downsample_log_partition(self, path, totals):
         """
-            Method that identifies an user based on the hash of the email
+            Method that puts the daily totals of an archive partition in place of it
+        (see SQLiteBackend.downsample_log_partition)
+        """
+        self._storage.downsample_log_partition(path, totals)
 
-        :param hash:    the hash of the email we're looking for
-        :return:        -> A tuple representing the row corresponding to that user
-                        -> None: otherwise
+    def run_maintenance(self, statements):
+        """
+            Method that runs maintenance statements (e.g. ANALYZE) through the writer thread, as one
+        transaction (see MaintenanceScheduler)
         """
+        self._storage.run_maintenance(statements)
 
-        all_users = self._execute_SELECT("users", None)
-        for user in all_users:
-            email = user[1]
-            if self._get_sha256_encryption(email) == hash:
-                return user
+    def get_snapshot_stats(self):
+        """
+        :return:    The refresh statistics of the read snapshot (see ReadSnapshot.stats), or None if it's disabled
+        """
+        return self._storage.snapshot_stats()
 
-        return None
+    def get_cache_stats(self):
+        """
+        :return:    The hit/ miss statistics of the query result cache (see QueryCache.stats)
+        """
+        return self._query_cache.stats()
 
-    def _get_sha256_encryption(self, plaintext):
+    def close(self):
         """
-            Method that takes a plaintext message and returns its sha256 encryption
+            Method that closes the event journal and the storage backend and stops the password hashing
+        processes, once the pending writes are committed. They are all started again on their next use,
+        so a handler closed before forking is reopened by each child, with nothing shared across the fork
+        """
+        if self._journal is not None:
+            self._journal.close()
+        self._storage.close()
+        self._password_hasher.close()
 
-        :param plaintext:       The text to encrypt
-        :return:                the SHA-256 encryption as a base64 string
+    def backup_to(self, target, pages, sleep, progress=None):
         """
-        import hashlib
-        return hashlib.sha256(plaintext.encode('utf-8')).hexdigest()
+            Method that copies the database into another one while it is in use (see SQLiteBackend.backup_to)
+        """
+        self._storage.backup_to(target, pages, sleep, progress)
+
+    def warm_up(self):
+        """
+            Method that runs every cached read that takes no arguments, and the leaderboard over all
+        time, so that their results are cached before the first request. Called before forking, it lets
+        every worker start with the same (shared, copy-on-write) cache.
+        """
+        self._get_users_by_hash()
+        self.get_courses_list()
+        self.get_courses_list_with_details()
+        self.get_working_users()
+        self.get_logs()
+        # With the arguments of the requests: the cached results are looked up by the arguments given
+        self.get_leaderboard_totals(None, None)
+
+    def get_write_stats(self):
+        """
+        :return:    The write statistics of the storage backend (see StorageBackend.write_stats)
+        """
+        return self._storage.write_stats()
+
+    def get_journal_stats(self):
+        """
+        :return:    The write statistics of the event journal (see EventJournal.stats), or None if there's none
+        """
+        return self._journal.stats() if self._journal is not None else None
+
+    def _journal_event(self, event):
+        """
+            Method that makes a work session event durable in the journal, if there's one, before it is
+        applied to the database
+
+        :param event:   The event, as a dictionary of the format {"event": <kind>, <field>: <value>, ...}
+        """
+        if self._journal is not None:
+            self._journal.append(event)
+
+    def _abort_event(self, event, **fields):
+        """
+            Method that journals that a work session event made durable couldn't be applied after all, so
+        that replaying the journal undoes it (see event_journal.fold_events). A failure to do so is ignored:
+        the write failed already
+
+        :param event:   The event, as given to _journal_event
+        :param fields:  What else undoing it takes (previous_time: the time worked before it)
+        """
+        try:
+            self._journal_event(dict(event, event="abort", of=event["event"], **fields))
+        except:
+            pass
 
-    def _execute_SELECT_from_query(self, query, *args):
+    def restore_work_sessions(self, working, logs):
         """
-                Method that executes complex SELECT statements, from a given query
+            Method that writes the work sessions rebuilt from the event journal (see event_journal.replay),
+        as one transaction
 
-        :param query:       The query to execute
-        :param args:        The arguments to replace the '?' wildcards from the query
-        :return:            The result of the query, as a list of tuples
+        :param working:     The users working, as a list of (uid, cid, since, time) tuples, that replace the
+                            working table (None to leave it as it is)
+        :param logs:        The logs to add, as a list of (uid, cid, duration, started_at, logged_at) tuples
+        """
+        with self._storage.atomic():
+            if working is not None:
+                self._storage.delete(self._working_table, {})
+                for uid, cid, since, time in working:
+                    self._storage.insert(self._working_table,
+                                         {"uid": uid, "working": 1, "since": since, "cid": cid, "time": time})
+
+            for uid, cid, duration, started_at, logged_at in logs:
+                self._storage.insert(self._logs_table, {"uid": uid, "cid": cid, "duration": duration,
+                                                        "started_at": started_at, "logged_at": logged_at})
+
+    def get_single_flight_stats(self):
+        """
+        :return:    Per-method statistics of the request coalescing layer (see SingleFlight.stats)
         """
-        con = sql.connect(self._dbName)
-        cur = con.cursor()
-        cur.execute(query)
-        results = list(set(cur.fetchall()))
-        con.commit()
-        con.close()
-        return results
+        return self._single_flight.stats()
+
+    def _load_revocations(self):
+        """
+            Method that (re)loads the set of revoked sessions. Revocations older than the TTL are
+        skipped, as every token they could apply to has expired anyway.
+        """
+        oldest = int((time.time() - self._DEFAULT_TTL) * 1000)
+        self._revocations = {uid: revoked_at for uid, revoked_at in self._storage.revocations(oldest)}
+        self._revocations_loaded_at = time.monotonic()
+
+    def _is_revoked(self, uid, issued_at):
+        """
+        :param uid:         The uid a signed token was issued for
+        :param issued_at:   When the token was issued (in milliseconds)
+        :return:            True - if the user logged out after the token was issued
+                            False - otherwise
+        """
+        if time.monotonic() - self._revocations_loaded_at > self._revocation_refresh:
+            self._load_revocations()
+
+        return issued_at <= self._revocations.get(uid, -1)
+
+    def _revoke_sessions(self, uid):
+        """
+            Method that invalidates every signed token issued to a user so far
+        """
+        revoked_at = int(time.time() * 1000)
+        self._storage.insert("revoked_sessions", {"uid": uid, "revoked_at": revoked_at}, replace=True)
+        self._revocations[uid] = revoked_at
 
     def start_work(self, email_hash, course):
         """
@@ -211,7 +391,7 @@ class DatabaseHandler:
         """
 
         try:
-            user = self._get_user_from_hash(email_hash)
+            user = self._get_user_row(email_hash)
         except:
             return False, "Server error"
 
@@ -221,13 +401,7 @@ class DatabaseHandler:
         uid = user[0]
 
         try:
-            con = sql.connect(self._dbName)
-            cur = con.cursor()
-            cur.execute("SELECT id FROM courses WHERE name='"+course+"';")
-            results = list(set(cur.fetchall()))
-            con.commit()
-            con.close()
-
+            results = self._storage.select(self._courses_table, {"name": course}, ["id"])
         except:
             return False, "Server error"
 
@@ -236,13 +410,31 @@ class DatabaseHandler:
             return False, "Incorrect course name"
 
         cid = results[0][0]
+        since = _epoch_now()
 
+        if self._journal is not None:
+            # Not journaled if it can't apply, as the insert would be refused
+            try:
+                if self._storage.select(self._working_table, {"uid": uid}, ["uid"]):
+                    return False, "Email already in use!"
+            except:
+                return False, "Server error"
+
+        event = {"event": "start_work", "uid": int(uid), "cid": int(cid), "since": since}
         try:
-            self._execute_INSERT(self._working_table,
-                                ["uid", "working", "since", "cid"],
-                                int(uid), 1, dt.now(), int(cid))
+            self._journal_event(event)
         except:
+            return False, "Server error"
+
+        try:
+            self._storage.insert(self._working_table,
+                                 {"uid": int(uid), "working": 1, "since": since, "cid": int(cid)})
+        except ConstraintError:
+            # There is already a row for the user in working. The event is a no-op when replayed
             return False, "Email already in use!"
+        except:
+            self._abort_event(event)
+            return False, "Server error"
 
         return True, ""
 
@@ -257,7 +449,7 @@ class DatabaseHandler:
 
 
         try:
-            user = self._get_user_from_hash(email_hash)
+            user = self._get_user_row(email_hash)
         except:
             return False, "Server error"
 
@@ -267,12 +459,7 @@ class DatabaseHandler:
         uid = user[0]
 
         try:
-            con = sql.connect(self._dbName)
-            cur = con.cursor()
-            cur.execute("SELECT working, cid, since FROM working WHERE uid=" + str(uid))
-            results = list(set(cur.fetchall()))
-            con.commit()
-            con.close()
+            results = self._storage.select(self._working_table, {"uid": uid}, ["working", "cid", "since", "time"])
         except:
             return False, "Server error!"
 
@@ -284,12 +471,23 @@ class DatabaseHandler:
         if not isinstance(time, int) or time < 0:
             return False, "Incorrect time!"
 
+        logged_at = _epoch_now()
+
+        event = {"event": "stop_work", "uid": uid, "cid": cid, "duration": time, "since": to_epoch(results[0][2]),
+                 "logged_at": logged_at}
+        try:
+            self._journal_event(event)
+        except:
+            return False, "Server error!"
+
         try:
-            self._execute_DELETE(self._working_table, "uid=?", uid)
-            self._execute_INSERT(self._logs_table,
-                                ["uid", "cid", "duration", "started_at", "logged_at"],
-                                uid, cid, time, results[0][2], dt.now())
+            with self._storage.atomic():
+                self._storage.delete(self._working_table, {"uid": uid})
+                self._storage.insert(self._logs_table,
+                                     {"uid": uid, "cid": cid, "duration": time, "started_at": results[0][2],
+                                      "logged_at": logged_at})
         except:
+            self._abort_event(event, previous_time=results[0][3])
             return False, "Server error!"
 
         return True, ""
@@ -309,7 +507,7 @@ class DatabaseHandler:
                             -> an error message, if necessary
         """
         try:
-            users = self._execute_SELECT("users","email='"+email+"'")
+            users = self._storage.select(self._users_table, {"email": email}, ["id"])
         except:
             return False, "Server error"
 
@@ -318,12 +516,11 @@ class DatabaseHandler:
             return False, "Email already in use"
 
         try:
-            self._execute_INSERT("users",
-                                 ["email", "full_name", "password", "admin"],
-                                 email,
-                                 name,
-                                 self._encrypt_pass(password),
-                                 1 if admin else 0)
+            self._storage.insert(self._users_table,
+                                 {"email": email,
+                                  "full_name": name,
+                                  "password": self._encrypt_pass(password),
+                                  "admin": 1 if admin else 0})
         except:
             return False, "Server error"
 
@@ -356,7 +553,7 @@ class DatabaseHandler:
             }
 
         try:
-            user = self._execute_SELECT("users", "email='"+email + "'")
+            user = self._storage.select(self._users_table, {"email": email})
         except:
             return {
                 "success":  False,
@@ -373,16 +570,24 @@ class DatabaseHandler:
                 }
             elif self._check_pass(password, user[3]):
 
+                if self._session_signer is not None:
+                    return {
+                        "success": True,
+                        "id": self._get_sha256_encryption(user[1]),
+                        "name": user[2],
+                        "token": self._session_signer.issue(user[0], self._DEFAULT_TTL),
+                        "ttl": self._DEFAULT_TTL
+                    }
+
                 def get_new_token(ttl):
                     """
                         Inner function that creates
                     :return:
                     """
                     token = secrets.token_hex(64)
-                    self._execute_INSERT("logged_in",
-                                         ["token", "uid", "last_login", "TTL"],
-                                         token, user[0], dt.now(), self._DEFAULT_TTL
-                                         )
+                    self._storage.insert("logged_in",
+                                         {"token": token, "uid": user[0], "last_login": _epoch_now(),
+                                          "TTL": self._DEFAULT_TTL})
                     return {
                         "success": True,
                         "id": self._get_sha256_encryption(user[1]),
@@ -391,7 +596,7 @@ class DatabaseHandler:
                         "ttl": ttl
                     }
 
-                logged_in = self._execute_SELECT("logged_in", "uid="+str(user[0]), ["token"])
+                logged_in = self._storage.select("logged_in", {"uid": user[0]}, ["token"])
                 if len(logged_in) == 0:
                     return get_new_token(self._DEFAULT_TTL)
                 else:
@@ -417,6 +622,7 @@ class DatabaseHandler:
                 "message": "Incorrect username or password"
             }
 
+    @cached_read("courses")
     def get_courses_list(self):
         """
             Method that returns the list of the courses currently in the database
@@ -439,7 +645,7 @@ class DatabaseHandler:
         """
 
         try:
-            query_results = self._execute_SELECT("courses", None, ["name", "url"])
+            query_results = self._storage.select(self._courses_table, None, ["name", "url"])
         except:
             return False, "Server Error!"
 
@@ -469,7 +675,7 @@ class DatabaseHandler:
         :return:            A dictionary of the format:
 
         """
-        user = self._get_user_from_hash(email_hash)
+        user = self._get_user_row(email_hash)
         if user is None:
             return False, "Incorrect user hash"
 
@@ -477,12 +683,13 @@ class DatabaseHandler:
             return False, "User's password already set"
 
         try:
-            self._execute_UPDATE("users", ["password"], [self._encrypt_pass(password), ], "id=?", [user[0], ])
+            self._storage.update(self._users_table, {"password": self._encrypt_pass(password)}, {"id": user[0]})
         except:
             return False, "Server error"
 
         return True, ""
 
+    @cached_read("working", "users", "courses")
     def get_working_users(self):
         """
                 Method that returns the users working at the moment.
@@ -503,13 +710,8 @@ class DatabaseHandler:
                         ]
                     }
         """
-        query = "SELECT u.full_name, u.email, c.name, w.since, w.time FROM " \
-                "working AS w " \
-                "INNER JOIN users AS u ON w.uid=u.id " \
-                "INNER JOIN courses AS c ON w.cid=c.id ";
-
         try:
-            results = self._execute_SELECT_from_query(query)
+            results = self._storage.working_users()
         except:
             print("SERVER ERROR!")
             return None
@@ -526,13 +728,14 @@ class DatabaseHandler:
             new_entry["name"] = result[0]
             new_entry["email"] = self._get_sha256_encryption(result[1])
             new_entry["course"] = result[2]
-            new_entry["since"] = result[3]
+            new_entry["since"] = format_timestamp(result[3])
             new_entry["worked for"] = result[4]
             id += 1
             working_users["users"].append(new_entry)
 
         return working_users
 
+    @cached_read("logs", "users", "courses", from_snapshot=True)
     def get_logs(self):
         """
             Method that returns all the logs from the database
@@ -555,13 +758,8 @@ class DatabaseHandler:
                     }
         """
 
-        query = "SELECT u.full_name, u.email, c.name, l.duration, l.started_at, l.logged_at " \
-                "FROM logs AS l " \
-                "INNER JOIN users AS u ON l.uid=u.id " \
-                "INNER JOIN courses AS c ON l.cid=c.id"
-
         try:
-            results = self._execute_SELECT_from_query(query)
+            results = self._storage.logs(from_snapshot=True)
         except:
             print("SERVER ERROR!")
             return None
@@ -578,28 +776,105 @@ class DatabaseHandler:
             new_entry["email"] = self._get_sha256_encryption(result[1])
             new_entry["course"] = result[2]
             new_entry["seconds"] = result[3]
-            new_entry["started"] = result[4]
-            new_entry["logged"] = result[5]
+            new_entry["started"] = format_timestamp(result[4])
+            new_entry["logged"] = format_timestamp(result[5])
             logs["users"].append(new_entry)
             id += 1
         return logs
 
+    def parse_watermark(self, since):
+        """
+        :param since:   A watermark returned by get_log_changes (None for none)
+        :return:        The id of the last log it covers (0 for none)
+        :raises:        ValueError if it isn't a watermark
+        """
+        watermark = int(since) if since else 0
+        if watermark < 0:
+            raise ValueError("Invalid watermark: " + repr(since))
+        return watermark
+
+    def get_log_changes(self, since=None, limit=1000):
+        """
+            Method that returns the logs written after a watermark, for the consumers that keep a copy
+        of them. Only the logs after the watermark are read (by their id), so polling it costs
+        time proportional to the new logs only.
+
+        :param since:       The watermark returned by the previous call (None for every log)
+        :param limit:       The maximum number of logs to return
+        :return:            A dictionary of the format:
+
+                    {
+                        "success": <True/False>,
+                        "users": [                                      (only if successful)
+                            {
+                                "id": <log_id>,
+                                "name": <full_name>,
+                                "email": <hashed_email>,
+                                "course": <course_name>,
+                                "seconds": <no_of_seconds_worked>,
+                                "started": <date&time_the_user_started_working>,
+                                "logged": <date&time_the_entry_was_logged>
+                            },
+                            ...
+                        ],
+                        "watermark": <watermark_to_ask_for_the_next_logs>, (only if successful)
+                        "more": <True if there may be more logs already>,  (only if successful)
+                        "message": <ERROR_message>                      (only if not successful)
+                    }
+        """
+        try:
+            watermark = self.parse_watermark(since)
+        except ValueError:
+            return {
+                "success": False, "message": "Invalid watermark"
+            }
+
+        try:
+            results, last_id, scanned = self._storage.log_changes(watermark, limit)
+        except:
+            return {
+                "success": False, "message": "Server error"
+            }
+
+        logs = list()
+        for result in results:
+            logs.append({
+                "id": result[0],
+                "name": result[1],
+                "email": self._get_sha256_encryption(result[2]),
+                "course": result[3],
+                "seconds": result[4],
+                "started": format_timestamp(result[5]),
+                "logged": format_timestamp(result[6])
+            })
+
+        # From the logs read, not the ones returned: those left out don't hold the watermark back
+        if last_id is not None:
+            watermark = last_id
+
+        return {
+            "success": True,
+            "users": logs,
+            "watermark": str(watermark),
+            "more": scanned == limit
+        }
+
     def is_admin(self, email_hash):
         """
             Method that checks if a user is admin or not, based on the hashed email address
 
-        :param email_hash:      The hashed email address
+        :param email_hash:      The hashed email address (or the Identity of the user)
         :return:                True - if the user is an admin
                                 False - otherwise
         """
 
-        user_row = self._get_user_from_hash(email_hash)
+        identity = self.resolve_identity(email_hash)
 
-        if user_row is None:
+        if identity is None:
             # The user doesn't exist
             return False
 
-        return user_row[-1] == 1
+        return identity.admin
 
     def is_token_still_valid(self, token):
         """
@@ -616,8 +891,16 @@ class DatabaseHandler:
                     }
         """
 
+        if self._session_signer is not None and SessionTokenSigner.is_signed_token(str(token)):
+            # Pure CPU: the signature and the expiry are in the token, the revocations in memory
+            verified = self._session_signer.verify(token)
+            return {
+                "success": True,
+                "valid": verified is not None and not self._is_revoked(*verified)
+            }
+
         try:
-            login_data = self._execute_SELECT("logged_in", "token='"+str(token)+"'", ["last_login", "TTL"])
+            login_data = self._storage.select("logged_in", {"token": str(token)}, ["last_login", "TTL"])
         except:
             return {
                 "success": False,
@@ -630,16 +913,15 @@ class DatabaseHandler:
                 "valid": False
             }
 
-        last_login = dt_parse.parse(login_data[0][0])
-        expiry_time = last_login + datetime.timedelta(seconds=login_data[0][1])
+        expiry_time = to_epoch(login_data[0][0]) + login_data[0][1]
 
-        if dt.now() < expiry_time:
+        if time.time() < expiry_time:
             return {
                 "success": True,
                 "valid": True
             }
         else:
-            self._execute_DELETE("logged_in", "token=?", token)
+            self._storage.delete("logged_in", {"token": token})
             return {
                 "success": True,
                 "valid": False
@@ -657,17 +939,23 @@ class DatabaseHandler:
                     }
         """
         try:
-            uid = self._get_user_from_hash(email_hash)
+            user = self._get_user_row(email_hash)
         except:
             return {
                 "success": False,
                 "message": "Server error when finding user"
             }
 
-        print("USER DETAILS: ", uid)
+        if user is None:
+            return {
+                "success": False,
+                "message": "Invalid user id"
+            }
 
         try:
-            self._execute_DELETE("logged_in", "uid=?", uid[0])
+            self._storage.delete("logged_in", {"uid": user[0]})
+            if self._session_signer is not None:
+                self._revoke_sessions(user[0])
         except:
             return {
                 "success": False,
@@ -676,7 +964,7 @@ class DatabaseHandler:
 
         return {"success": True}
 
-    def get_history_for_user(self, email_for_request, email_for_user):
+    def get_history_for_user(self, email_for_request, email_for_user, since=None, until=None):
         """
             Method that gets the history for a user, but the request is made by another user
 
@@ -685,6 +973,9 @@ class DatabaseHandler:
 
         :param email_for_user:          The email hash of the user we want the history for
 
+        :param since:                   Only entries started at or after this epoch (optional)
+        :param until:                   Only entries started before this epoch (optional)
+
         :return:                        A dictionary of the format:
 
                         {
@@ -695,10 +986,13 @@ class DatabaseHandler:
                                     "id": <entry_id>,
                                     "course_name": <Course_name>,
                                     "course_url": <course_url>,
-                                    "started_at": <started_at>,
-                                    "logged_at": <time_entry_was_logged>,
+                                    "started_at": <started_at>,                 (as an epoch)
+                                    "logged_at": <time_entry_was_logged>,       (as an epoch)
                                     "time":  <no_of_seconds_spent_working>
-                                },
+                                    "sessions": <no_of_sessions>                (only for the days rolled up
+                                },                                               by LogRetention: started_at is
+                                                                                 the start of the day, and
+                                                                                 logged_at is None)
                                 { ... },
                                 ...
                             ],
@@ -706,14 +1000,14 @@ class DatabaseHandler:
                             "message": <ERROR_message>                          (only if not successful)
                         }
         """
-        if not self.is_admin(email_for_request) and email_for_request != email_for_user:
+        if not self._has_rights_over(self.resolve_identity(email_for_request), email_for_user):
             return {
                 "success": False,
                 "message": "Not enough privileges"
             }
 
         try:
-            user = self._get_user_from_hash(email_for_user)
+            user = self._get_user_row(email_for_user)
         except:
             return {
                     "success": False,
@@ -728,13 +1022,8 @@ class DatabaseHandler:
 
         uid = user[0]
 
-        query = "SELECT c.name, c.url, l.started_at, l.duration, l.logged_at " \
-                "FROM logs AS l " \
-                "INNER JOIN courses AS c ON l.cid = c.id " \
-                "WHERE l.uid=" + str(uid) + ";"
-
         try:
-            results = self._execute_SELECT_from_query(query)
+            results = self._storage.history(uid, since, until, from_snapshot=True)
         except:
             return {
                 "success": False,
@@ -750,28 +1039,24 @@ class DatabaseHandler:
         id = 1
         total = 0
 
-        results = sorted(results, key=lambda x: x[2] if x[2] else "")
-
         for result in results:
-            if result[2] is None or result[4] is None:
-                continue
-
-            response["history"].append({
+            entry = {
                     "id": id,
                     "course_name": result[0],
                     "course_url": result[1],
-                    "started_at": result[2][:-7],
-                    "logged_at": result[4][:-7],
+                    "started_at": to_epoch(result[2]),
+                    "logged_at": to_epoch(result[4]),
                     "time": time.strftime('%H:%M:%S', time.gmtime(result[3])),
-                })
+                }
+            if len(result) > 5:
+                entry["sessions"] = result[5]
+            response["history"].append(entry)
 
             id += 1
             total += result[3]
 
         response["total"] = time.strftime('%H:%M:%S', time.gmtime(total))
 
-        response["history"] = sorted(response["history"],
-                                     key=lambda x: x["started_at"])
         return response
 
     def get_stats_for_user(self, email_for_request, email_for_user):
@@ -790,14 +1075,14 @@ class DatabaseHandler:
                                         "message": <ERROR_message>              (only if not successful)
                                     }
         """
-        if not self.is_admin(email_for_request) and email_for_request != email_for_user:
+        if not self._has_rights_over(self.resolve_identity(email_for_request), email_for_user):
             return {
                 "success": False,
                 "message": "Not enough privileges"
             }
 
         try:
-            user = self._get_user_from_hash(email_for_user)
+            user = self._get_user_row(email_for_user)
         except:
             return {
                     "success": False,
@@ -812,30 +1097,25 @@ class DatabaseHandler:
 
         uid = user[0]
 
-        query = "SELECT SUM(l.duration) FROM logs AS l WHERE l.uid=?;"
-
         try:
-            results = self._execute_SELECT_from_query(query, uid)
+            seconds = self._storage.total_duration(uid, from_snapshot=True)
         except:
             return {
                 "success": False,
                 "message": "Server error"
             }
 
-        if len(results) == 0:
-            return {
-                "success": True,
-                "seconds": 0
-            }
-
         return {
             "success": True,
-            "seconds": results[0][0]
+            "seconds": seconds
         }
 
-    def get_leaderboard(self):
+    def get_leaderboard(self, since=None, until=None):
         """
+            Not cached itself: it formats the cached totals (see get_leaderboard_totals)
 
+        :param since:   Only count work started at or after this epoch (optional)
+        :param until:   Only count work started before this epoch (optional)
         :return:    The leader board based on the data we have so far in the database.
 
                     It will be an dictionary of the format:
@@ -856,21 +1136,35 @@ class DatabaseHandler:
 
                             }
         """
-        query = "SELECT u.full_name, u.id, u.email, TOTAL(l.duration) AS tot " \
-                "FROM users AS u " \
-                "LEFT OUTER JOIN logs AS l ON u.id = l.uid " \
-                "GROUP BY u.id " \
-                "ORDER BY tot DESC;"
+        users = self.get_leaderboard_totals(since, until)
 
-        try:
-            users = sorted(self._execute_SELECT_from_query(query),
-                            key=lambda user: -1.0 * user[3])
-        except:
+        if users is None:
             return {
                 "success": False,
                 "message": "Server error"
             }
 
+        return self.format_leaderboard(users)
+
+    @cached_read("users", "logs", "logs_daily", from_snapshot=True)
+    def get_leaderboard_totals(self, since=None, until=None):
+        """
+
+        :param since:   Only count work started at or after this epoch (optional)
+        :param until:   Only count work started before this epoch (optional)
+        :return:        The time worked by every user, as a list of (full_name, uid, email, seconds_worked)
+                        tuples, the ones who worked the most first. None if it couldn't be read
+        """
+        try:
+            return self._storage.leaderboard(since, until, from_snapshot=True)
+        except:
+            return None
+
+    def format_leaderboard(self, users):
+        """
+        :param users:   The time worked by the users, as returned by get_leaderboard_totals
+        :return:        The leader board, in the format of get_leaderboard
+        """
         result = {
             "success": True,
             "leader_board": list()
@@ -893,6 +1187,7 @@ class DatabaseHandler:
 
         return result
 
+    @cached_read("courses", "course_categories")
     def get_courses_list_with_details(self):
         """
                 Method that returns a list of courses, with details
@@ -921,13 +1216,8 @@ class DatabaseHandler:
                     }
         """
 
-        query = "SELECT c.name, c.url, c.syllabus, c.about, c.notes, " \
-                    "c.weekly_commitment_low, c.weekly_commitment_high, c.number_weeks, cc.category_name " \
-                "FROM courses AS c " \
-                "INNER JOIN course_categories AS cc ON c.cid = cc.id;"
-
         try:
-            courses = self._execute_SELECT_from_query(query)
+            courses = self._storage.courses_with_details()
         except:
             return {
                 "success": False,
@@ -980,7 +1270,7 @@ class DatabaseHandler:
             return {"success": False, "message": "You don't have enough rights for this."}
 
         try:
-            self._execute_INSERT("users", ["email", "full_name", "admin"], email, full_name, admin)
+            self._storage.insert(self._users_table, {"email": email, "full_name": full_name, "admin": admin})
         except:
             return {"success": False, "message": "Server error"}
 
@@ -1005,7 +1295,7 @@ class DatabaseHandler:
                         }
         """
         try:
-           user = self._get_user_from_hash(id_user)
+           user = self._get_user_row(id_user)
         except:
             return {"success": False, "message": "Server error"}
 
@@ -1013,25 +1303,19 @@ class DatabaseHandler:
             return {"success": False, "message": "Invalid user id"}
 
         try:
-            query = "SELECT c.course_name, w.time, w.since " \
-                    "FROM working AS w " \
-                    "INNER JOIN courses AS c " \
-                        "ON w.cid = c.id " \
-                    "WHERE w.uid=? AND w.working=1"
-
-            result = self._execute_SELECT_from_query(query, user[0])
+            result = self._storage.working_course(user[0])
         except:
             return {"success": False, "message": "Server error"}
 
-        if len(result) == 0:
+        if result is None:
             return {"success": True, "working":False}
 
         return {
             "success": True,
             "working": True,
-            "course": result[0][0],
-            "time": result[0][1],
-            "since": result[0][2]
+            "course": result[0],
+            "time": result[1],
+            "since": format_timestamp(result[2])
         }
 
     def update_time(self, id_user, time):
@@ -1045,7 +1329,7 @@ class DatabaseHandler:
                             message - the ERROR message / "" if successful
         """
         try:
-           user = self._get_user_from_hash(id_user)
+           user = self._get_user_row(id_user)
         except:
             return False, "Server error"
 
@@ -1055,10 +1339,27 @@ class DatabaseHandler:
         id = user[0]
 
         try:
-            self._execute_UPDATE("working", ["time"], [time], "uid=?", [id])
+            results = self._storage.select(self._working_table, {"uid": id}, ["time"])
         except:
+            return False, "Server error"
+
+        if len(results) != 1:
+            return False, "User not working"
+
+        event = {"event": "update_time", "uid": id, "time": time}
+        try:
+            self._journal_event(event)
+        except:
+            return False, "Server error"
+
+        try:
+            self._storage.update(self._working_table, {"time": time}, {"uid": id})
+        except:
+            self._abort_event(event, previous_time=results[0][0])
             return False, "User not working"
 
+        return True, ""
+
     def get_user_details(self, id_asker, id_user):
         """
 
@@ -1074,19 +1375,21 @@ class DatabaseHandler:
                             "message":  <ERROR_message>     (only if not successful)
                         }
         """
-        if not (self.is_admin(id_asker) or id_asker == id_user):
+        asker = self.resolve_identity(id_asker)
+
+        if not self._has_rights_over(asker, id_user):
             return {
                 "success": False, "message": "Not enough rights to do this!"
             }
 
-        user = self._get_user_from_hash(id_user)
+        user = self._get_user_row(id_user)
 
         if user is None:
             return {
                 "success": False, "message": "Invalid user id!"
             }
 
-        if self.is_admin(id_asker):
+        if asker.admin:
             uid = user[0]
             #TODO: FINALIZE IMPLEMENTATION HERE!!!!
 
@@ -1109,12 +1412,12 @@ class DatabaseHandler:
                             "message": <ERROR_message> (only if not successful)
                         }
         """
-        if not (self.is_admin(id_updater) or id_updater == id_user):
+        if not self._has_rights_over(self.resolve_identity(id_updater), id_user):
             return {
                 "success": False, "message": "Not enough rights to do it"
             }
 
-        user = self._get_user_from_hash(id_user)
+        user = self._get_user_row(id_user)
 
         if user is None:
             return {
@@ -1124,7 +1427,7 @@ class DatabaseHandler:
         uid = user[0]
 
         try:
-            self._execute_UPDATE("users", ["full_name"], [new_name], "id=?", [uid])
+            self._storage.update(self._users_table, {"full_name": new_name}, {"id": uid})
         except:
             return {
                 "success": False, "message": "Database failure"
@@ -1146,7 +1449,7 @@ class DatabaseHandler:
                                 "message": <ERROR_message>  (only if not successful)
                             }
         """
-        user = self._get_user_from_hash(id_user)
+        user = self._get_user_row(id_user)
         if user is None:
             return {
                 "success": False, "message": "Incorrect user ID"
@@ -1154,7 +1457,7 @@ class DatabaseHandler:
 
         if self._check_pass(old_password, user[3]):
             try:
-                self._execute_UPDATE("users", ["password"], [self._encrypt_pass(new_password)], "id=?", [user[0]])
+                self._storage.update(self._users_table, {"password": self._encrypt_pass(new_password)}, {"id": user[0]})
             except:
                 return {
                     "success": False,
@@ -1184,7 +1487,7 @@ class DatabaseHandler:
                 "message": "Not enough rights to do this"
             }
 
-        user = self._get_user_from_hash(id_user)
+        user = self._get_user_row(id_user)
 
         if user is None:
             return {
@@ -1193,7 +1496,7 @@ class DatabaseHandler:
             }
 
         try:
-            self._execute_UPDATE("users", ["password"], [self._encrypt_pass(new_password)], "id=?", [user[0]])
+            self._storage.update(self._users_table, {"password": self._encrypt_pass(new_password)}, {"id": user[0]})
         except:
             return {
                 "success": False,
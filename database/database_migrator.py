@@ -1,4 +1,5 @@
 import sqlite3 as sql
+from database import database_creator
 
 def _execute_SELECT(db_name, table, conds, cols=["*"], limit=None, order=None, groupBy=None, *args):
 
@@ -87,15 +88,81 @@ def migrate_table(old_db, new_db, table_name, first_index):
         _execute_INSERT(new_db, table_name, cols_list, *tuple)
 
 
+TIMESTAMP_COLUMNS = [
+    ("working", "since"),
+    ("logs", "started_at"),
+    ("logs", "logged_at"),
+    ("logged_in", "last_login"),
+]
+
+
+def migrate_timestamps_to_epoch(db_path):
+    """
+        Function that converts the timestamps stored as str(datetime.now()) text into integer
+    Unix epochs, and indexes the logs by start time. Rows that already hold integers are left
+    alone, so it is safe to run more than once.
+
+        The columns keep their DATE declaration: its NUMERIC affinity stores the new values as
+    INTEGERs, so there is no need to rebuild the tables.
+
+    :param db_path:     The path of the database to migrate
+    :return:            -
+    """
+    con = sql.connect(db_path)
+    cur = con.cursor()
+
+    for table, col in TIMESTAMP_COLUMNS:
+        # The text was written in local time, the 'utc' modifier converts it to UTC first
+        cur.execute("UPDATE " + table + " SET " + col + " = CAST(strftime('%s', " + col + ", 'utc') AS INTEGER) "
+                    "WHERE typeof(" + col + ") = 'text';")
+        print("Converted " + table + "." + col + " (" + str(cur.rowcount) + " rows)")
+
+    cur.execute("CREATE INDEX IF NOT EXISTS logs_started_at ON logs(started_at);")
+    cur.execute("CREATE INDEX IF NOT EXISTS logs_uid_started_at ON logs(uid, started_at);")
+    print("Created the logs indexes")
+
+    con.commit()
+    con.close()
+
+
+def migrate_schema(db_path):
+    """
+        Function that adds the tables created by database_creator since the database was: the revoked
+    sessions, the archive partitions, the daily log totals and the table versions (with their triggers).
+    Tables that already exist are left alone, so it is safe to run more than once.
+
+    :param db_path:     The path of the database to migrate
+    :return:            -
+    """
+    database_creator.db_path = db_path
+
+    database_creator.create_revoked_sessions_table()
+    database_creator.create_log_partitions_tables()
+    database_creator.create_logs_daily_table()
+    print("Created the missing tables")
+
+    # After the tables, as the triggers need every versioned table to exist
+    database_creator.create_table_versions()
+    print("Created the table versions")
+
+
 if __name__ == "__main__":
 
-    old_db = input("Old database name: ")
-    new_db = input("New database name: ")
+    migration = input("Migration to run (tables/ epochs/ schema): ")
+
+    if migration == "epochs":
+        migrate_timestamps_to_epoch(input("Database name: "))
+    elif migration == "schema":
+        migrate_schema(input("Database name: "))
+    else:
+        old_db = input("Old database name: ")
+        new_db = input("New database name: ")
+
+        migrate_table(old_db, new_db, "logs", 1)
+        print("Migrated logs table!")
+        #migrate_table(old_db, new_db, "working", 0)
+        #print("Migrated working table!")
+        #migrate_table(old_db, new_db, "logged_in", 1)
+        #print("Migrated logged_in table!")
 
-    migrate_table(old_db, new_db, "logs", 1)
-    print("Migrated logs table!")
-    #migrate_table(old_db, new_db, "working", 0)
-    #print("Migrated working table!")
-    #migrate_table(old_db, new_db, "logged_in", 1)
-    #print("Migrated logged_in table!")
     print("Migration done!")
\ No newline at end of file
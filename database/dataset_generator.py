@@ -0,0 +1,132 @@
+"""
+    Generates a synthetic database with the same schema as the production one, at a configurable scale.
+
+    Usage (from the repository root):
+
+        python -m database.dataset_generator <db_path> --users 1000 --months 12
+"""
+import argparse
+import os
+import random
+import sqlite3 as sql
+import time
+from passlib.hash import pbkdf2_sha256
+from database import database_creator
+
+CATEGORIES = ["Coding", "Data Science", "Entrepreneurship", "Marketing", "UX+Design"]
+
+# Every generated user can log in with this password
+DEFAULT_PASSWORD = "password"
+
+_FIRST_NAMES = ["Ada", "Alan", "Grace", "Linus", "Margaret", "Dennis", "Barbara", "Ken", "Frances", "Edsger",
+                "Radia", "Tim", "Hedy", "Guido", "Katherine", "Donald", "Sophie", "John", "Anita", "Niklaus"]
+_LAST_NAMES = ["Lovelace", "Turing", "Hopper", "Torvalds", "Hamilton", "Ritchie", "Liskov", "Thompson", "Allen",
+               "Dijkstra", "Perlman", "Berners-Lee", "Lamarr", "van Rossum", "Johnson", "Knuth", "Wilson", "Backus"]
+
+
+def generate(db_path, users=1000, courses=50, months=12, sessions_per_week=3, working=50, admins=5,
+             logged_in=200, seed=0):
+    """
+        Function that creates a new database and fills it with realistic-looking data
+
+    :param db_path:             The path of the database to create (it is overwritten if it exists)
+    :param users:               The number of users
+    :param courses:             The number of courses, spread over the categories
+    :param months:              How many months of logs to generate, up to now
+    :param sessions_per_week:   The average number of work sessions per user and week
+    :param working:             The number of users currently working
+    :param admins:              How many of the users are admins
+    :param logged_in:           The number of users with an active login session
+    :param seed:                The seed of the random generator, so that datasets are reproducible
+    :return:                    A dictionary with the number of rows generated in each table
+    """
+    rng = random.Random(seed)
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    database_creator.create_all(db_path)
+
+    con = sql.connect(db_path)
+    cur = con.cursor()
+
+    cur.executemany("INSERT INTO course_categories (category_name) VALUES (?)",
+                    [(category,) for category in CATEGORIES])
+
+    cur.executemany("INSERT INTO courses (name, url, cid, description, weekly_commitment_low, "
+                    "weekly_commitment_high, number_weeks) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [("Course " + str(i) + " - " + CATEGORIES[i % len(CATEGORIES)],
+                      "https://example.com/courses/" + str(i),
+                      i % len(CATEGORIES) + 1,
+                      "Description of course " + str(i),
+                      rng.randint(1, 4),
+                      rng.randint(5, 10),
+                      rng.randint(4, 16)) for i in range(courses)])
+
+    # Hashing is deliberately slow, so all the users share the same password hash
+    password_hash = pbkdf2_sha256.encrypt(DEFAULT_PASSWORD, rounds=200000, salt_size=16)
+
+    cur.executemany("INSERT INTO users (email, full_name, password, admin) VALUES (?, ?, ?, ?)",
+                    [("user" + str(i) + "@example.com",
+                      rng.choice(_FIRST_NAMES) + " " + rng.choice(_LAST_NAMES),
+                      password_hash,
+                      1 if i < admins else 0) for i in range(users)])
+
+    now = int(time.time())
+    start = now - months * 30 * 24 * 3600
+    weeks = months * 30 / 7.0
+
+    logs = list()
+    for uid in range(1, users + 1):
+        # Some users work a lot more than others
+        activity = rng.lognormvariate(0, 0.75)
+        for _ in range(int(sessions_per_week * weeks * activity)):
+            started_at = rng.randint(start, now - 3600)
+            duration = int(rng.triangular(300, 4 * 3600, 45 * 60))
+            logs.append((uid, rng.randint(1, courses), duration, started_at, started_at + duration))
+
+    # Logs are appended when sessions end
+    logs.sort(key=lambda log: log[4])
+    cur.executemany("INSERT INTO logs (uid, cid, duration, started_at, logged_at) VALUES (?, ?, ?, ?, ?)", logs)
+
+    working_users = rng.sample(range(1, users + 1), min(working, users))
+    cur.executemany("INSERT INTO working (uid, working, since, cid, time) VALUES (?, 1, ?, ?, ?)",
+                    [(uid, now - elapsed, rng.randint(1, courses), elapsed)
+                     for uid, elapsed in ((uid, rng.randint(60, 3 * 3600)) for uid in working_users)])
+
+    sessions = rng.sample(range(1, users + 1), min(logged_in, users))
+    cur.executemany("INSERT INTO logged_in (token, uid, last_login, TTL) VALUES (?, ?, ?, ?)",
+                    [("%0128x" % rng.getrandbits(512), uid, now - rng.randint(0, 7200), 7200) for uid in sessions])
+
+    con.commit()
+    cur.execute("ANALYZE;")
+    con.close()
+
+    return {
+        "course_categories": len(CATEGORIES),
+        "courses": courses,
+        "users": users,
+        "logs": len(logs),
+        "working": len(working_users),
+        "logged_in": len(sessions)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic database")
+    parser.add_argument("db_path")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--courses", type=int, default=50)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--sessions-per-week", type=float, default=3)
+    parser.add_argument("--working", type=int, default=50)
+    parser.add_argument("--admins", type=int, default=5)
+    parser.add_argument("--logged-in", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    counts = generate(args.db_path, args.users, args.courses, args.months, args.sessions_per_week,
+                      args.working, args.admins, args.logged_in, args.seed)
+
+    for table, count in counts.items():
+        print(table + ": " + str(count) + " rows")
@@ -0,0 +1,625 @@
+"""
+    Journal of the work sessions: every start_work, stop_work and update_time is appended to a JSON
+    lines file, and made durable, before the DatabaseHandler applies it to the working and logs tables.
+
+    The journal doesn't replace the database commit, it comes on top of it: each work session write
+    waits for an fsync of the journal (one per group of events written together) and then for the
+    commit, so fewer of them are made per second. What it buys is that those sessions can be rebuilt
+    when the database is lost, from a backup and the journal. A write that fails once its event is
+    journaled is followed by an abort event, which undoes it when the journal is replayed. POSIX only:
+    the processes sharing a journal coordinate its rotation with fcntl locks.
+
+    Usage (from the repository root), to rebuild the working users and the missing logs of a database
+    (e.g. a restored backup) from its journal (and the rotated files still next to it):
+
+        python -m database.event_journal replay database/SMU-logs.db journal/events.jsonl
+"""
+import argparse
+import fcntl
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3 as sql
+import threading
+import time
+from datetime import datetime as dt
+from database.log_partitions import partition_paths
+from database.timestamps import to_epoch
+
+logger = logging.getLogger(__name__)
+
+# Guards the start of the flusher threads. Replaced in forked children, where it could be held forever
+_start_lock = threading.Lock()
+
+
+def _reset_start_lock():
+    global _start_lock
+    _start_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_start_lock)
+
+
+class JournalUnavailable(Exception):
+    """
+        Raised to the callers of EventJournal.append when the flusher thread is dead, or hasn't made
+    their event durable within the timeout (it may still be written later)
+    """
+    pass
+
+
+class _Append:
+    """
+        A queued event: the line it is written as
+    """
+
+    def __init__(self, line):
+        self.line = line
+        self.done = threading.Event()
+        self.error = None
+
+
+class EventJournal:
+    """
+        An append-only file of events, one JSON object per line, with group commit.
+
+        Callers queue their events and wait. The flusher thread takes everything that is queued
+    (up to max_batch events), writes it at the end of the file and fsyncs it once, so concurrent
+    callers share the cost of making their events durable. An event is only acknowledged once it
+    is on disk: a line cut short by a crash was never acknowledged, and is dropped when the
+    journal is opened again.
+
+        The file is opened in append mode, and the thread is started on the first event of each
+    process, so the workers of a preforking server can share one journal.
+
+        Once the file grows past max_bytes, it is rotated: it is renamed to
+    <name>-<YYYYmmdd-HHMMSS-ffffff>.jsonl, and a new one is started with a checkpoint of the users
+    working after its last event, so that replaying the new file alone gives the same working users.
+    The events are folded into the checkpoint while the other processes keep appending, and then only
+    the last few of them, under an exclusive lock of <path>.lock (every batch is written under a shared
+    lock of it). The keep newest rotated files are kept, for the logs of the work sessions they hold.
+    """
+
+    def __init__(self, path, max_batch=256, flush_delay=0.0, max_bytes=64 * 1024 * 1024, keep=4,
+                 write_timeout=60.0):
+        """
+        :param path:            The path of the journal file (created if missing)
+        :param max_batch:       The maximum number of events written per fsync
+        :param flush_delay:     How long the flusher waits for more events before writing a batch, in
+                                seconds (0: it writes what is queued right away)
+        :param max_bytes:       The size past which the file is rotated (None: never)
+        :param keep:            How many rotated files to keep
+        :param write_timeout:   How long a caller waits for its event to be durable before giving up, in seconds
+        """
+        self._path = path
+        self._max_batch = max_batch
+        self._flush_delay = flush_delay
+        self._max_bytes = max_bytes
+        self._keep = keep
+        self._write_timeout = write_timeout
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._drop_partial_line()
+
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "batches": 0,
+            "events": 0,
+            "failed": 0,
+            "largest_batch": 0,
+            "bytes": 0,
+            "fsync_s": 0.0,
+            "rotations": 0
+        }
+
+    @property
+    def path(self):
+        return self._path
+
+    def is_empty(self):
+        """
+        :return:    True if no event was ever written to the journal
+        """
+        return not os.path.exists(self._path) or os.path.getsize(self._path) == 0
+
+    def start(self, working):
+        """
+            Method that starts an empty journal with a checkpoint of the users working, under the lock of
+        its rotation, so that only one of the processes sharing it does, before any event
+
+        :param working:     A function returning the users working, as a list of (uid, cid, since, time) tuples.
+                            It is only called if the journal is empty
+        :return:            True if the checkpoint was written, False if the journal wasn't empty
+        """
+        lock_fd = os.open(self._path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            if not self.is_empty():
+                return False
+
+            fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                data = _checkpoint_line(working()).encode("utf-8")
+                written = 0
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            return True
+        finally:
+            # Closing it releases the lock
+            os.close(lock_fd)
+
+    def _drop_partial_line(self):
+        if self.is_empty():
+            return
+
+        with open(self._path, "rb+") as journal:
+            size = journal.seek(0, os.SEEK_END)
+            journal.seek(size - 1)
+            if journal.read(1) == b"\n":
+                return
+
+            # Look for the end of the last complete line, from the end of the file
+            end = size
+            while end > 0:
+                step = min(end, 65536)
+                end -= step
+                journal.seek(end)
+                newline = journal.read(step).rfind(b"\n")
+                if newline >= 0:
+                    end += newline + 1
+                    break
+
+            logger.warning("Dropping %d bytes of a partial event at the end of %s", size - end, self._path)
+            journal.truncate(end)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+
+        with _start_lock:
+            if self._pid != os.getpid():
+                self._lock = threading.Lock()
+                self._stats = dict.fromkeys(self._stats, 0)
+                self._queue = queue.Queue()
+                fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                lock_fd = os.open(self._path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+                self._thread = threading.Thread(target=self._run, args=(fd, lock_fd, self._queue),
+                                                name="event-journal", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def append(self, event):
+        """
+            Method that queues an event and waits until it is durable
+
+        :param event:       The event, as a JSON serializable dictionary
+        :raises:            The OSError raised by the write or the fsync of its batch.
+                            JournalUnavailable if the flusher thread died or is stuck
+        """
+        self._ensure_started()
+
+        entry = _Append(json.dumps(event, separators=(",", ":")) + "\n")
+        self._queue.put(entry)
+        self._wait(entry, self._write_timeout)
+
+        if entry.error is not None:
+            raise entry.error
+
+    def _wait(self, entry, timeout=None):
+        """
+            Method that waits until an event is written (for at most timeout seconds, if given), checking every
+        second that the flusher thread is alive
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        thread = self._thread
+
+        while not entry.done.wait(1.0 if deadline is None else min(1.0, max(deadline - time.monotonic(), 0))):
+            if not thread.is_alive():
+                raise JournalUnavailable("The flusher thread of " + self._path + " is not running")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise JournalUnavailable("No fsync of " + self._path + " within " + str(timeout) + " s")
+
+    def close(self):
+        """
+            Method that stops the flusher thread, once every event queued so far is durable
+        """
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+            self._pid = None
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "batches": <no_of_fsyncs>,
+                        "events": <no_of_events_written_or_failed>,
+                        "failed": <no_of_events_that_could_not_be_written>,
+                        "largest_batch": <max_no_of_events_written_together>,
+                        "bytes": <no_of_bytes_written>,
+                        "fsync_s": <time_spent_writing_and_fsyncing>,
+                        "rotations": <no_of_times_this_process_rotated_the_file>
+                    }
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _run(self, fd, lock_fd, entries):
+        while True:
+            entry = entries.get()
+            if entry is None:
+                break
+
+            if self._flush_delay:
+                time.sleep(self._flush_delay)
+
+            batch = [entry]
+            stop = False
+            while len(batch) < self._max_batch:
+                try:
+                    entry = entries.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+
+            fd = self._write(fd, lock_fd, batch)
+
+            if stop:
+                break
+
+        os.close(fd)
+        os.close(lock_fd)
+
+    def _write(self, fd, lock_fd, batch):
+        """
+        :return:    The file descriptor to write the next batch to (a new one once the file was rotated)
+        """
+        data = "".join(entry.line for entry in batch).encode("utf-8")
+        start = time.perf_counter()
+        rotate = False
+
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+            try:
+                fd = self._reopen_if_rotated(fd)
+                written = 0
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+                os.fsync(fd)
+                rotate = self._max_bytes is not None and os.fstat(fd).st_size >= self._max_bytes
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        except OSError as e:
+            logger.exception("Could not write %d events to %s", len(batch), self._path)
+            for entry in batch:
+                entry.error = e
+
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["events"] += len(batch)
+            self._stats["failed"] += sum(1 for entry in batch if entry.error is not None)
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+            self._stats["bytes"] += len(data)
+            self._stats["fsync_s"] += time.perf_counter() - start
+
+        for entry in batch:
+            entry.done.set()
+
+        if rotate:
+            try:
+                fd = self._rotate(fd, lock_fd)
+            except Exception:
+                logger.exception("Could not rotate %s", self._path)
+
+        return fd
+
+    def _reopen_if_rotated(self, fd):
+        """
+            Method that opens the journal again if the file fd was opened on isn't the one at its path anymore
+        (called with the lock held)
+        """
+        try:
+            if os.fstat(fd).st_ino == os.stat(self._path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+
+        os.close(fd)
+        return os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _rotate(self, fd, lock_fd):
+        """
+            Method that puts a new file, starting with a checkpoint, in place of the journal, and deletes
+        the oldest rotated files
+
+        :return:    The file descriptor of the new file
+        """
+        # Folded before taking the lock, so that the other processes are only held up while the events
+        # they appended meanwhile are
+        with open(self._path, "rb") as journal:
+            inode = os.fstat(journal.fileno()).st_ino
+            offset, working = _fold_working(journal, 0, dict())
+
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            if os.stat(self._path).st_ino != inode:
+                # Another process rotated it already
+                return self._reopen_if_rotated(fd)
+
+            with open(self._path, "rb") as journal:
+                _, working = _fold_working(journal, offset, working)
+
+            temporary = self._path + ".tmp"
+            with open(temporary, "w") as checkpoint:
+                checkpoint.write(_checkpoint_line([(uid, cid, since, worked)
+                                                   for uid, (cid, since, worked) in sorted(working.items())]))
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+
+            root, extension = os.path.splitext(self._path)
+            os.rename(self._path, root + "-" + dt.now().strftime("%Y%m%d-%H%M%S-%f") + extension)
+            os.rename(temporary, self._path)
+
+            directory = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+            fd = self._reopen_if_rotated(fd)
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+        for old in journal_files(self._path)[:-1][:-self._keep or None]:
+            os.remove(old)
+
+        with self._lock:
+            self._stats["rotations"] += 1
+        logger.info("Rotated %s: %d users working", self._path, len(working))
+        return fd
+
+
+def _checkpoint_line(working):
+    """
+    :param working:     The users working, as a list of (uid, cid, since, time) tuples
+    :return:            The line of a checkpoint event holding them
+    """
+    return json.dumps({"event": "checkpoint", "at": int(time.time()), "working": [list(row) for row in working]},
+                      separators=(",", ":")) + "\n"
+
+
+def _fold_working(journal, offset, working):
+    """
+    :param journal:     The journal file, opened in binary mode
+    :param offset:      Where to start reading it from
+    :param working:     The users working before the event at that offset, as returned by fold_events
+    :return:            The offset of the end of the last complete line, and the users working after it
+    """
+    journal.seek(offset)
+    events = list()
+    for line in journal:
+        if not line.endswith(b"\n"):
+            break
+        offset += len(line)
+        events.append(json.loads(line))
+
+    working, _, _ = fold_events(events, working)
+    return offset, working
+
+
+def journal_files(path):
+    """
+    :param path:    The path of a journal
+    :return:        The paths of its rotated files, oldest first, followed by its own (if it exists)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    root, extension = os.path.splitext(os.path.basename(path))
+    rotated = re.compile(re.escape(root) + r"-\d{8}-\d{6}-\d{6}" + re.escape(extension) + "$")
+
+    paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if rotated.match(name)]
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def read_events(path):
+    """
+        Generator that reads the events of a journal, oldest first. A partial last line (a write
+    cut short by a crash) is skipped.
+
+    :param path:    The path of the journal file
+    :return:        The events, as dictionaries
+    """
+    with open(path, "rb") as journal:
+        for line in journal:
+            if not line.endswith(b"\n"):
+                break
+            yield json.loads(line)
+
+
+def fold_events(events, working=None):
+    """
+        Function that applies events the way the DatabaseHandler does: a user can't start to work
+    twice, and only a working user can stop or update their time. An abort event undoes the event
+    of the same user it holds the fields of (see DatabaseHandler._abort_event), which was journaled but
+    couldn't be applied: "previous_time" is the time worked before it.
+
+    :param events:  The events of a journal, oldest first (the first one being a checkpoint, unless
+                    working is given)
+    :param working: The users working before the first event, in the format returned
+    :return:        - The users working after the last event, as a dictionary of the format
+                      {<uid>: (cid, since, time)}
+                    - The logs written since the checkpoint, as a list of (uid, cid, duration, started_at,
+                      logged_at) tuples
+                    - The number of events read
+    """
+    working = dict(working) if working is not None else dict()
+    logs = list()
+    count = 0
+
+    for event in events:
+        count += 1
+        kind = event["event"]
+        uid = event.get("uid")
+
+        if kind == "checkpoint":
+            working = {uid: (cid, since, time) for uid, cid, since, time in event["working"]}
+        elif kind == "start_work":
+            if uid not in working:
+                working[uid] = (event["cid"], event["since"], 0)
+        elif kind == "stop_work":
+            if uid in working:
+                del working[uid]
+                logs.append((uid, event["cid"], event["duration"], event["since"], event["logged_at"]))
+        elif kind == "update_time":
+            if uid in working:
+                cid, since, _ = working[uid]
+                working[uid] = (cid, since, event["time"])
+        elif kind == "abort":
+            aborted = event["of"]
+            if aborted == "start_work":
+                if uid in working and working[uid][:2] == (event["cid"], event["since"]):
+                    del working[uid]
+            elif aborted == "stop_work":
+                log = (uid, event["cid"], event["duration"], event["since"], event["logged_at"])
+                if log in logs:
+                    # The last one: it was logged before its abort
+                    del logs[len(logs) - 1 - logs[::-1].index(log)]
+                if uid not in working:
+                    working[uid] = (event["cid"], event["since"], event["previous_time"])
+            elif aborted == "update_time":
+                if uid in working:
+                    cid, since, _ = working[uid]
+                    working[uid] = (cid, since, event["previous_time"])
+            else:
+                raise ValueError("Unknown aborted event: " + str(aborted))
+        else:
+            raise ValueError("Unknown event: " + str(kind))
+
+    return working, logs, count
+
+
+def _day_start(epoch):
+    date = dt.fromtimestamp(epoch)
+    return int(dt(date.year, date.month, date.day).timestamp())
+
+
+def _existing_logs(db_path, since):
+    """
+    :param db_path:     The path of the database
+    :param since:       The oldest start of the logs looked for
+    :return:            - The logs started since then, in the database or in its archive partitions,
+                          as a set of (uid, started_at, logged_at) tuples
+                        - The days rolled up by the retention (see LogRetention) since then, as a set
+                          of (uid, cid, day) tuples
+    """
+    con = sql.connect(db_path)
+    try:
+        query = "SELECT uid, started_at, logged_at FROM logs WHERE started_at >= ?;"
+        rows = con.execute(query, (since,)).fetchall()
+
+        for path in partition_paths(con, os.path.dirname(os.path.abspath(db_path)), since=since):
+            partition = sql.connect(path)
+            try:
+                rows += partition.execute(query, (since,)).fetchall()
+            finally:
+                partition.close()
+
+        days = con.execute("SELECT uid, cid, day FROM logs_daily WHERE day >= ?;",
+                           (_day_start(since),)).fetchall()
+    finally:
+        con.close()
+
+    return {(uid, to_epoch(started_at), to_epoch(logged_at)) for uid, started_at, logged_at in rows}, set(days)
+
+
+def replay(handler, path, batch_size=1000):
+    """
+        Function that rebuilds the work sessions of a database from its journal, the rotated files
+    still next to it included: the working table becomes the one the journal ends with, and the logs
+    the journal has but the database lacks
+    (e.g. in a backup older than the journal, or after a lost write) are added. Logs already there,
+    archived or rolled up into their daily totals are left as they are, so replaying a journal
+    again changes nothing. It is meant for a database that isn't being served: the users who
+    started to work after the last event of the journal would stop working.
+
+        The writes go through the DatabaseHandler, in transactions of batch_size logs, which
+    invalidates the cached reads (leaderboard, stats, history, ...) computed from those tables.
+
+    :param handler:     The DatabaseHandler of the database
+    :param path:        The path of the journal file (see journal_files)
+    :param batch_size:  How many logs are added per transaction
+    :return:            A dictionary of the format:
+                        {
+                            "events": <no_of_events_read>,
+                            "working": <no_of_users_working>,
+                            "logs": <no_of_logs_in_the_journal>,
+                            "restored": <no_of_logs_added>,
+                            "duration_s": <time_the_replay_took>
+                        }
+    """
+    start = time.perf_counter()
+    working, logs, events = fold_events(itertools.chain.from_iterable(read_events(journal)
+                                                                      for journal in journal_files(path)))
+
+    missing = logs
+    if logs:
+        present, days = _existing_logs(handler.get_database_path(), min(log[3] for log in logs))
+        missing = [(uid, cid, duration, started_at, logged_at) for uid, cid, duration, started_at, logged_at in logs
+                   if (uid, started_at, logged_at) not in present
+                   and (uid, cid, _day_start(started_at)) not in days]
+
+    rows = [(uid, cid, since, time) for uid, (cid, since, time) in sorted(working.items())]
+    handler.restore_work_sessions(rows, missing[:batch_size])
+    for i in range(batch_size, len(missing), batch_size):
+        handler.restore_work_sessions(None, missing[i:i + batch_size])
+
+    stats = {
+        "events": events,
+        "working": len(working),
+        "logs": len(logs),
+        "restored": len(missing),
+        "duration_s": time.perf_counter() - start
+    }
+    logger.info("Replayed %d events of %s: %d users working, %d of %d logs restored (%.2f s)", events, path,
+                stats["working"], stats["restored"], stats["logs"], stats["duration_s"])
+    return stats
+
+
+if __name__ == "__main__":
+    from database.database_handler import DatabaseHandler
+
+    parser = argparse.ArgumentParser(description="Rebuild the work sessions of a database from its event journal")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = subparsers.add_parser("replay", help="Rebuild the working users and the missing logs")
+    replay_parser.add_argument("db_path")
+    replay_parser.add_argument("journal")
+    replay_parser.add_argument("--batch-size", type=int, default=1000, help="How many logs are added per transaction")
+
+    args = parser.parse_args()
+
+    handler = DatabaseHandler(args.db_path)
+    try:
+        stats = replay(handler, args.journal, args.batch_size)
+    finally:
+        handler.close()
+
+    print("Replayed " + str(stats["events"]) + " events: " + str(stats["working"]) + " users working, " +
+          str(stats["restored"]) + " of " + str(stats["logs"]) + " logs restored in " +
+          "%.2f s" % stats["duration_s"])
@@ -0,0 +1,29 @@
+class Identity:
+    """
+        A resolved user: everything the DatabaseHandler needs to know about the caller of a
+    request, so that the user's row is looked up once per request and then passed around.
+
+        Every DatabaseHandler method taking an email hash also accepts an Identity.
+    """
+
+    def __init__(self, email_hash, row):
+        """
+        :param email_hash:      The hash of the user's email
+        :param row:             The user's row from the users table
+        """
+        self.email_hash = email_hash
+        self.row = row
+
+        self.uid = row[0]
+        self.email = row[1]
+        self.name = row[2]
+        self.admin = row[-1] == 1
+
+    def __eq__(self, other):
+        return isinstance(other, Identity) and other.uid == self.uid
+
+    def __hash__(self):
+        return hash(self.uid)
+
+    def __repr__(self):
+        return "Identity(uid=%r, name=%r, admin=%r)" % (self.uid, self.name, self.admin)
@@ -0,0 +1,147 @@
+"""
+    Incremental export of the logs, as JSON lines, for the pipelines that keep a copy of them: each run
+    only appends the logs written since the previous one (see DatabaseHandler.get_log_changes).
+
+    Usage (from the repository root), from a database file, a directory of shards or a running server:
+
+        python -m database.log_export database/SMU-logs.db --state logs.watermark >> logs.jsonl
+        python -m database.log_export shards/ --state logs.watermark --output logs.jsonl
+        python -m database.log_export https://www.neural-guide.me --state logs.watermark --output logs.jsonl
+"""
+import argparse
+import json
+import os
+import stat
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+
+def read_watermark(path):
+    """
+    :param path:    The path of the state file (None for no state)
+    :return:        The watermark saved in it (None if there's none yet)
+    """
+    if path is None or not os.path.exists(path):
+        return None
+
+    with open(path) as state:
+        return state.read().strip() or None
+
+
+def write_watermark(path, watermark):
+    """
+        Function that saves the watermark of the logs exported so far, atomically, so that a crash
+    leaves either the previous watermark or the new one
+    """
+    temporary = path + ".tmp"
+    with open(temporary, "w") as state:
+        state.write(watermark + "\n")
+        state.flush()
+        os.fsync(state.fileno())
+    os.replace(temporary, path)
+
+
+def _is_file(output):
+    """
+    :return:    True if the output is a regular file, which fsync makes durable
+    """
+    try:
+        return stat.S_ISREG(os.fstat(output.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        # Not backed by a file descriptor (e.g. an io.StringIO)
+        return False
+
+
+def http_source(url, timeout=30):
+    """
+    :param url:     The base URL of the server
+    :return:        A function fetching the logs after a watermark from its /logs/changes endpoint
+    """
+    def fetch(since, limit):
+        query = {"limit": limit}
+        if since:
+            query["since"] = since
+        with urllib.request.urlopen(url.rstrip("/") + "/logs/changes?" + urllib.parse.urlencode(query),
+                                    timeout=timeout) as response:
+            return json.loads(response.read())
+
+    return fetch
+
+
+def export(fetch, output, since=None, batch_size=1000, on_batch=None):
+    """
+        Function that writes every log after the watermark to the output, one JSON object per line,
+    oldest first
+
+    :param fetch:       A function returning the logs after a watermark, in the format of
+                        DatabaseHandler.get_log_changes, as fetch(since, limit)
+    :param output:      The file to write the logs to
+    :param since:       The watermark to start from (None for every log)
+    :param batch_size:  How many logs are fetched per call
+    :param on_batch:    Called with the new watermark once each batch is written and flushed (and fsynced, if
+                        the output is a file)
+    :return:            The number of logs exported, and the watermark after the last one
+    """
+    count = 0
+
+    while True:
+        result = fetch(since, batch_size)
+        if not result["success"]:
+            raise RuntimeError("Could not fetch the logs: " + result["message"])
+
+        for log in result["users"]:
+            output.write(json.dumps(log, separators=(",", ":")) + "\n")
+        output.flush()
+        if _is_file(output):
+            # On disk before the watermark moves past them, or a crash would lose them for good
+            os.fsync(output.fileno())
+
+        count += len(result["users"])
+        if result["watermark"] != since:
+            since = result["watermark"]
+            if on_batch is not None:
+                on_batch(since)
+
+        if not result["more"]:
+            return count, since
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the logs written since the previous export")
+    parser.add_argument("source", help="A database file, a directory of shards or the URL of a server")
+    parser.add_argument("--state", help="The file the watermark is kept in between runs")
+    parser.add_argument("--since", help="The watermark to start from (default: the one in the state file)")
+    parser.add_argument("--output", help="The file the logs are appended to (default: stdout)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="How many logs are fetched per request")
+    args = parser.parse_args()
+
+    handler = None
+    if args.source.startswith("http://") or args.source.startswith("https://"):
+        fetch = http_source(args.source)
+    else:
+        if os.path.isdir(args.source):
+            from database.sharding import ShardedHandler
+            handler = ShardedHandler(args.source)
+        else:
+            from database.database_handler import DatabaseHandler
+            handler = DatabaseHandler(args.source)
+        fetch = handler.get_log_changes
+
+    since = args.since if args.since is not None else read_watermark(args.state)
+    output = open(args.output, "a") if args.output else sys.stdout
+    start = time.perf_counter()
+
+    try:
+        count, since = export(fetch, output, since, args.batch_size,
+                              on_batch=lambda watermark: write_watermark(args.state, watermark)
+                              if args.state else None)
+    finally:
+        if args.output:
+            output.close()
+        if handler is not None:
+            handler.close()
+
+    print("Exported " + str(count) + " logs up to " + str(since) + " in " + "%.2f s" % (time.perf_counter() - start),
+          file=sys.stderr)
@@ -0,0 +1,415 @@
+"""
+    Monthly archival of old logs into partition databases, which the reads of the logs attach on demand.
+
+    Usage (from the repository root), to archive every month but the current one:
+
+        python -m database.log_partitions database/SMU-logs.db database/archive/ --keep-months 1
+"""
+import argparse
+import fcntl
+import logging
+import os
+import sqlite3 as sql
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime as dt
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# The attached partitions are named partition0, partition1, ...
+_SCHEMA_PREFIX = "partition"
+
+# The columns of the logs, in the order the reads of the live table and of the partitions are unioned in
+LOG_COLUMNS = "id, uid, cid, duration, started_at, logged_at"
+
+
+def log_partitions_table_statements():
+    """
+    :return:    The statements creating the log_partitions table, which lists the archive files, and the
+                retired_log_partitions table, which lists the ones rolled up since (see LogRetention).
+                They can safely be run again
+    """
+    return ["CREATE TABLE IF NOT EXISTS "
+            "log_partitions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "path TEXT NOT NULL, "
+                "starts_at INTEGER NOT NULL, "
+                "ends_at INTEGER NOT NULL, "
+                "last_id INTEGER NOT NULL, "
+                "rows INTEGER NOT NULL, "
+                "archived_at INTEGER NOT NULL"
+            ");",
+            "CREATE TABLE IF NOT EXISTS "
+            "retired_log_partitions ("
+                "path TEXT PRIMARY KEY, "
+                "retired_at INTEGER NOT NULL"
+            ");"]
+
+
+def month_start(epoch):
+    """
+    :param epoch:   A Unix epoch
+    :return:        The epoch of the start of its month, in local time
+    """
+    date = dt.fromtimestamp(epoch)
+    return int(dt(date.year, date.month, 1).timestamp())
+
+
+def next_month_start(epoch):
+    """
+    :param epoch:   A Unix epoch
+    :return:        The epoch of the start of the following month, in local time
+    """
+    date = dt.fromtimestamp(epoch)
+    if date.month == 12:
+        return int(dt(date.year + 1, 1, 1).timestamp())
+    return int(dt(date.year, date.month + 1, 1).timestamp())
+
+
+def partition_paths(con, base_dir, since=None, until=None):
+    """
+        Function that lists the partitions holding logs started in [since, until)
+
+    :param con:         A connection to the live database (or to its read snapshot)
+    :param base_dir:    The directory the partition paths are relative to (the one of the live database)
+    :param since:       The start of the time range (None for no bound)
+    :param until:       The end of the time range (None for no bound)
+    :return:            The absolute paths of the partitions, oldest first
+    """
+    query = "SELECT path FROM log_partitions WHERE 1"
+    args = []
+
+    if since is not None:
+        query += " AND ends_at > ?"
+        args.append(since)
+
+    if until is not None:
+        query += " AND starts_at < ?"
+        args.append(until)
+
+    try:
+        rows = con.execute(query + " ORDER BY starts_at, id;", args).fetchall()
+    except sql.OperationalError:
+        # Databases (or snapshots) from before the partitioning have no partitions table
+        return []
+
+    return [os.path.normpath(os.path.join(base_dir, path)) for path, in rows]
+
+
+def attach_limit(con):
+    """
+    :param con:     A connection
+    :return:        How many databases can be attached to it
+    """
+    try:
+        return con.getlimit(sql.SQLITE_LIMIT_ATTACHED)
+    except AttributeError:
+        return 10
+
+
+def attach_partitions(con, paths):
+    """
+        Function that attaches partitions, read-only, to a connection opened with uri=True
+
+    :param con:     The connection
+    :param paths:   The paths of the partitions (no more than attach_limit(con))
+    :return:        The source to read the logs of those partitions from, for the FROM clause of a query
+    """
+    schemas = list()
+    for index, path in enumerate(paths):
+        schema = _SCHEMA_PREFIX + str(index)
+        con.execute("ATTACH DATABASE ? AS " + schema, ("file:" + quote(path) + "?mode=ro",))
+        schemas.append(schema)
+
+    return "(" + " UNION ALL ".join("SELECT " + LOG_COLUMNS + " FROM " + schema + ".logs"
+                                       for schema in schemas) + ")"
+
+
+def detach_partitions(con):
+    for _, schema, _ in con.execute("PRAGMA database_list;").fetchall():
+        if schema.startswith(_SCHEMA_PREFIX):
+            con.execute("DETACH DATABASE " + schema)
+
+
+@contextmanager
+def logs_lock(db_path, stop=None):
+    """
+        Context manager holding the lock file that LogArchiver and LogRetention take while they move logs
+    out of the logs table, so that they never move the same ones, whichever processes they run in
+
+    :param db_path: The path of the live database
+    :param stop:    An event: the lock is waited for, trying again every second until it is set.
+                    Without it, the lock isn't waited for
+    :return:        (as the target of the with statement) True if the lock is held, False if it isn't
+    """
+    with open(db_path + ".logs.lock", "w") as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if stop is None or stop.wait(1.0):
+                    yield False
+                    return
+
+        yield True
+
+
+class LogArchiver:
+    """
+        Moves the logs of closed months out of the live database, into one archive file per month.
+
+        The rows of a month are first copied into a new file, which is not read by anyone yet.
+    The file is then registered in log_partitions and the rows deleted from the logs table, in a
+    single transaction made through the DatabaseHandler, so that readers see every log exactly
+    once, whether they read before or after it. Logs are never updated once written, so the copy
+    can't go stale in between.
+
+        Logs of an archived month logged later on (e.g. of work started just before the end of it)
+    stay in the live database until the next run, which moves them into another file of the month.
+    A lock file (see logs_lock) makes sure only one process archives at a time, and that LogRetention
+    doesn't roll up logs between their copy and their deletion.
+
+        The files of partitions rolled up by LogRetention are removed once retired_grace seconds
+    have passed, so that read snapshots taken before still find them.
+    """
+
+    def __init__(self, handler, archive_dir, keep_months=1, retired_grace=86400):
+        """
+        :param handler:         The DatabaseHandler of the live database
+        :param archive_dir:     The directory the archive files are written to. It has to be on the
+                                same machine as the live database, and can't move once files are in it
+        :param keep_months:     How many months (the current one included) are kept in the live database
+        :param retired_grace:   How long the files of retired partitions are kept, in seconds
+        """
+        self._handler = handler
+        self._db_path = handler.get_database_path()
+        self._archive_dir = archive_dir
+        self._keep_months = max(1, keep_months)
+        self._retired_grace = retired_grace
+
+        self._base_dir = os.path.dirname(os.path.abspath(self._db_path))
+        self._prefix = os.path.splitext(os.path.basename(self._db_path))[0] + "-logs-"
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+        self._stats = {
+            "runs": 0,
+            "failures": 0,
+            "partitions": 0,
+            "rows": 0,
+            "last_duration_s": 0.0,
+            "last_rows": 0,
+        }
+
+    def cutoff(self, now=None):
+        """
+        :param now:     The current epoch (default: now)
+        :return:        The epoch before which logs are archived
+        """
+        cutoff = month_start(time.time() if now is None else now)
+        for _ in range(self._keep_months - 1):
+            cutoff = month_start(cutoff - 1)
+        return cutoff
+
+    def run(self, now=None, wait=False):
+        """
+            Method that archives the logs started before the cutoff, month by month
+
+        :param now:     The current epoch (default: now)
+        :param wait:    Whether to wait (until stop() is called) for the other processes archiving, or rolling up logs
+        :return:        A list of (path_of_the_new_archive_file, no_of_rows_moved) tuples,
+                        or None if another process is archiving, or rolling up logs
+        """
+        os.makedirs(self._archive_dir, exist_ok=True)
+
+        with logs_lock(self._db_path, self._stop if wait else None) as locked:
+            if not locked:
+                return None
+
+            start = time.perf_counter()
+            archived = list()
+            try:
+                self._remove_orphans()
+
+                con = sql.connect(self._db_path)
+                try:
+                    last_id, first_start = con.execute("SELECT MAX(id), MIN(started_at) FROM logs "
+                                                       "WHERE started_at < ?;", (self.cutoff(now),)).fetchone()
+                finally:
+                    con.close()
+
+                if first_start is not None:
+                    month = month_start(first_start)
+                    while month < self.cutoff(now):
+                        result = self._archive_month(month, next_month_start(month), last_id)
+                        if result is not None:
+                            archived.append(result)
+                        month = next_month_start(month)
+            except Exception:
+                logger.exception("Could not archive the logs of %s", self._db_path)
+                with self._lock:
+                    self._stats["failures"] += 1
+                raise
+
+            elapsed = time.perf_counter() - start
+            rows = sum(count for _, count in archived)
+
+            with self._lock:
+                self._stats["runs"] += 1
+                self._stats["partitions"] += len(archived)
+                self._stats["rows"] += rows
+                self._stats["last_duration_s"] = elapsed
+                self._stats["last_rows"] = rows
+
+            logger.info("Archived %d logs of %s into %d partitions (%.2f s)", rows, self._db_path, len(archived),
+                        elapsed)
+            return archived
+
+    def _archive_month(self, starts_at, ends_at, last_id):
+        """
+            Method that moves the logs started in [starts_at, ends_at), up to the id last_id, to a new archive file
+
+        :return:    (path_of_the_file, no_of_rows), or None if there was nothing to move
+        """
+        source = sql.connect(self._db_path)
+        try:
+            rows = source.execute("SELECT " + LOG_COLUMNS + " FROM logs "
+                                  "WHERE started_at >= ? AND started_at < ? AND id <= ?;",
+                                  (starts_at, ends_at, last_id)).fetchall()
+        finally:
+            source.close()
+
+        if not rows:
+            return None
+
+        name = self._prefix + dt.fromtimestamp(starts_at).strftime("%Y-%m") + "-" + str(last_id) + ".db"
+        path = os.path.join(self._archive_dir, name)
+        temporary = path + ".tmp"
+
+        try:
+            _write_partition(temporary, rows)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+        try:
+            self._handler.register_log_partition(os.path.relpath(os.path.abspath(path), self._base_dir),
+                                                 starts_at, ends_at, last_id, len(rows))
+        except Exception:
+            os.remove(path)
+            raise
+
+        return path, len(rows)
+
+    def _remove_orphans(self):
+        """
+            Method that removes the archive files left by runs that failed before registering them,
+        and the ones of partitions retired more than retired_grace seconds ago
+        """
+        con = sql.connect(self._db_path)
+        try:
+            registered = set(partition_paths(con, self._base_dir))
+            try:
+                retired = con.execute("SELECT path FROM retired_log_partitions WHERE retired_at > ?;",
+                                      (time.time() - self._retired_grace,)).fetchall()
+            except sql.OperationalError:
+                retired = []
+        finally:
+            con.close()
+
+        registered.update(os.path.normpath(os.path.join(self._base_dir, path)) for path, in retired)
+
+        for name in os.listdir(self._archive_dir):
+            path = os.path.normpath(os.path.join(os.path.abspath(self._archive_dir), name))
+            if name.startswith(self._prefix) and (name.endswith(".db") or name.endswith(".tmp")) \
+                    and path not in registered:
+                os.remove(path)
+
+    def start(self, interval):
+        """
+            Method that archives the closed months every interval seconds, on a background thread
+
+        :param interval:    The time between two runs, in seconds
+        """
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.run(wait=True)
+                except Exception:
+                    pass
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=loop, name="log-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "runs": <no_of_runs_of_this_process>,
+                        "failures": <no_of_runs_that_failed>,
+                        "partitions": <no_of_archive_files_written>,
+                        "rows": <no_of_logs_moved>,
+                        "last_duration_s": <time_the_last_run_took>,
+                        "last_rows": <no_of_logs_moved_by_the_last_run>
+                    }
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+def _write_partition(path, rows):
+    con = sql.connect(path)
+    try:
+        con.execute("CREATE TABLE logs ("
+                        "id INTEGER PRIMARY KEY, "
+                        "uid INTEGER NOT NULL, "
+                        "cid INTEGER NOT NULL, "
+                        "duration INTEGER NOT NULL, "
+                        "started_at INTEGER, "
+                        "logged_at INTEGER"
+                    ");")
+        con.executemany("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?);", rows)
+        con.execute("CREATE INDEX logs_started_at ON logs(started_at);")
+        con.execute("CREATE INDEX logs_uid_started_at ON logs(uid, started_at);")
+        con.commit()
+        con.execute("ANALYZE;")
+        # Read-only from now on: make the file as small as it can be
+        con.execute("VACUUM;")
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    from database.database_handler import DatabaseHandler
+
+    parser = argparse.ArgumentParser(description="Move the logs of closed months into archive files")
+    parser.add_argument("db_path")
+    parser.add_argument("archive_dir")
+    parser.add_argument("--keep-months", type=int, default=1,
+                        help="How many months (the current one included) to keep in the database")
+    args = parser.parse_args()
+
+    handler = DatabaseHandler(args.db_path)
+    try:
+        archived = LogArchiver(handler, args.archive_dir, args.keep_months).run()
+    finally:
+        handler.close()
+
+    if archived is None:
+        print("Another archival, or a roll up of the logs, is in progress")
+    else:
+        for path, rows in archived:
+            print("Archived " + str(rows) + " logs to " + path)
+        print("Done!")
@@ -0,0 +1,231 @@
+"""
+    Retention of the logs: past a given age, the logs are rolled up into per-user, per-course, per-day totals.
+
+    Usage (from the repository root), to roll up the logs older than a year:
+
+        python -m database.log_retention database/SMU-logs.db --days 365
+"""
+import argparse
+import logging
+import os
+import sqlite3 as sql
+import threading
+import time
+from datetime import datetime as dt, timedelta
+
+from database.log_partitions import logs_lock
+
+logger = logging.getLogger(__name__)
+
+# The start of the (local) day a log was started on, as an epoch
+DAY_OF_STARTED_AT = "CAST(strftime('%s', started_at, 'unixepoch', 'localtime', 'start of day', 'utc') AS INTEGER)"
+
+
+def logs_daily_table_statements():
+    """
+    :return:    The statements creating the logs_daily table, which holds the totals of the logs
+                rolled up by LogRetention. They can safely be run again
+    """
+    return ["CREATE TABLE IF NOT EXISTS "
+            "logs_daily ("
+                "uid INTEGER NOT NULL, "
+                "cid INTEGER NOT NULL, "
+                "day INTEGER NOT NULL, "
+                "duration INTEGER NOT NULL, "
+                "sessions INTEGER NOT NULL, "
+                "PRIMARY KEY (uid, cid, day), "
+                "FOREIGN KEY(cid) REFERENCES courses(id), "
+                "FOREIGN KEY(uid) REFERENCES users(id)"
+            ");",
+            "CREATE INDEX IF NOT EXISTS logs_daily_day ON logs_daily(day);"]
+
+
+def _day_start(epoch):
+    date = dt.fromtimestamp(epoch)
+    return int(dt(date.year, date.month, date.day).timestamp())
+
+
+class LogRetention:
+    """
+        Rolls the logs older than the retention period up into logs_daily, one row per user,
+    course and day, holding the total time worked and the number of sessions.
+
+        Logs still in the live database are rolled up and deleted in batches, each one in its
+    own transaction made through the DatabaseHandler, so that writers are never held up for long
+    and readers see every log either raw or in its day's total, never both. Archive partitions
+    (see LogArchiver) older than the retention period are rolled up whole, and retired: their
+    files are removed by the archiver, once no read snapshot can refer to them anymore. Runs hold
+    the lock of the archiver (see logs_lock), so that no log is rolled up while it is archived.
+
+        Only the granularity is lost: the totals of the history, stats and leaderboard reads,
+    which read both tables, stay the same. Time ranges falling inside a rolled up day count it
+    if the day starts within them.
+    """
+
+    def __init__(self, handler, retention_days=365, batch_size=1000, batch_sleep=0.05):
+        """
+        :param handler:         The DatabaseHandler of the live database
+        :param retention_days:  How many days the logs are kept as they are
+        :param batch_size:      How many logs are rolled up per transaction
+        :param batch_sleep:     How long to sleep between two batches, in seconds
+        """
+        self._handler = handler
+        self._db_path = handler.get_database_path()
+        self._retention_days = retention_days
+        self._batch_size = batch_size
+        self._batch_sleep = batch_sleep
+
+        self._base_dir = os.path.dirname(os.path.abspath(self._db_path))
+        self._lock = threading.Lock()
+        self._running = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+        self._stats = {
+            "runs": 0,
+            "failures": 0,
+            "rows": 0,
+            "partitions": 0,
+            "batches": 0,
+            "last_duration_s": 0.0,
+            "last_rows": 0,
+        }
+
+    def cutoff(self, now=None):
+        """
+        :param now:     The current epoch (default: now)
+        :return:        The epoch before which logs are rolled up (the start of a day)
+        """
+        now = dt.fromtimestamp(time.time() if now is None else now)
+        return _day_start((now - timedelta(days=self._retention_days)).timestamp())
+
+    def run(self, now=None):
+        """
+            Method that rolls up every log started before the cutoff
+
+        :param now:     The current epoch (default: now)
+        :return:        The number of logs rolled up (0 if stop() was called while waiting for LogArchiver)
+        """
+        with self._running, logs_lock(self._db_path, self._stop) as locked:
+            if not locked:
+                return 0
+
+            cutoff = self.cutoff(now)
+            start = time.perf_counter()
+            rows = 0
+            partitions = 0
+            batches = 0
+
+            try:
+                for path, relative_path in self._partitions_before(cutoff):
+                    rows += self._roll_up_partition(path, relative_path)
+                    partitions += 1
+
+                while not self._stop.is_set():
+                    rolled_up = self._handler.downsample_logs(cutoff, self._batch_size)
+                    rows += rolled_up
+                    batches += 1
+                    if rolled_up < self._batch_size:
+                        break
+                    time.sleep(self._batch_sleep)
+            except Exception:
+                logger.exception("Could not roll up the logs of %s", self._db_path)
+                with self._lock:
+                    self._stats["failures"] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self._stats["rows"] += rows
+                    self._stats["partitions"] += partitions
+                    self._stats["batches"] += batches
+
+            with self._lock:
+                self._stats["runs"] += 1
+                self._stats["last_duration_s"] = elapsed
+                self._stats["last_rows"] = rows
+
+            logger.info("Rolled up %d logs of %s started before %s (%d partitions, %d batches, %.2f s)", rows,
+                        self._db_path, dt.fromtimestamp(cutoff).isoformat(), partitions, batches, elapsed)
+            return rows
+
+    def _partitions_before(self, cutoff):
+        con = sql.connect(self._db_path)
+        try:
+            rows = con.execute("SELECT path FROM log_partitions WHERE ends_at <= ? ORDER BY starts_at, id;",
+                               (cutoff,)).fetchall()
+        except sql.OperationalError:
+            return []
+        finally:
+            con.close()
+
+        return [(os.path.normpath(os.path.join(self._base_dir, path)), path) for path, in rows]
+
+    def _roll_up_partition(self, path, relative_path):
+        con = sql.connect(path)
+        try:
+            totals = con.execute("SELECT uid, cid, " + DAY_OF_STARTED_AT + ", SUM(duration), COUNT(*) "
+                                 "FROM logs GROUP BY 1, 2, 3;").fetchall()
+        finally:
+            con.close()
+
+        self._handler.downsample_log_partition(relative_path, totals)
+        return sum(total[4] for total in totals)
+
+    def start(self, interval):
+        """
+            Method that rolls up the old logs every interval seconds, on a background thread
+
+        :param interval:    The time between two runs, in seconds
+        """
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.run()
+                except Exception:
+                    pass
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=loop, name="log-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "runs": <no_of_runs_of_this_process>,
+                        "failures": <no_of_runs_that_failed>,
+                        "rows": <no_of_logs_rolled_up>,
+                        "partitions": <no_of_archive_partitions_rolled_up>,
+                        "batches": <no_of_batches_of_live_logs_rolled_up>,
+                        "last_duration_s": <time_the_last_run_took>,
+                        "last_rows": <no_of_logs_rolled_up_by_the_last_run>
+                    }
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+if __name__ == "__main__":
+    from database.database_handler import DatabaseHandler
+
+    parser = argparse.ArgumentParser(description="Roll the old logs up into daily totals")
+    parser.add_argument("db_path")
+    parser.add_argument("--days", type=int, default=365, help="How many days the logs are kept as they are")
+    parser.add_argument("--batch-size", type=int, default=1000, help="How many logs are rolled up per transaction")
+    args = parser.parse_args()
+
+    handler = DatabaseHandler(args.db_path)
+    try:
+        retention = LogRetention(handler, args.days, args.batch_size)
+        rows = retention.run()
+    finally:
+        handler.close()
+
+    print("Rolled up " + str(rows) + " logs in " + "%.2f s" % retention.stats()["last_duration_s"])
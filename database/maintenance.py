@@ -0,0 +1,400 @@
+"""
+    Scheduled maintenance of the database: incremental vacuum of the free pages and refresh of the planner statistics.
+
+    Usage (from the repository root), to run a maintenance pass right away:
+
+        python -m database.maintenance database/SMU-logs.db
+
+    Databases created before incremental vacuum was enabled have to be converted once, while the server is stopped:
+
+        python -m database.maintenance database/SMU-logs.db --enable-incremental-vacuum
+"""
+import argparse
+import collections
+import fcntl
+import logging
+import os
+import sqlite3 as sql
+import threading
+import time
+from database.table_generations import VERSIONED_TABLES
+
+logger = logging.getLogger(__name__)
+
+_AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def enable_incremental_vacuum(db_path):
+    """
+        Function that switches a database to incremental auto-vacuum. This rebuilds the whole
+    file (VACUUM), under an exclusive lock, so it should only be run while the database isn't in use
+
+    :param db_path:     The path of the database
+    """
+    con = sql.connect(db_path, isolation_level=None)
+    try:
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        con.execute("VACUUM;")
+    finally:
+        con.close()
+
+
+class MaintenanceScheduler:
+    """
+        Keeps an eye on the fragmentation of the database and on the size of its tables, and
+    does the maintenance SQLite never does on its own, during quiet windows.
+
+        The constant inserts and deletes of logged_in and working leave free pages behind: once
+    they make up more than max_freelist_ratio of the file, they are given back to the file system
+    with incremental vacuum, a few pages per transaction. Tables that have no statistics are
+    analyzed, and so are tables in which more than analyze_drift of the rows they had when last
+    analyzed were written since, so that the query planner keeps picking the right indexes. Nothing
+    is counted: the rows written are those counted by the table_versions triggers, since the
+    scheduler started, and the rows of a table when it was analyzed are those of sqlite_stat1.
+
+        Every action goes through the writer thread of the DatabaseHandler, like any other write,
+    and only while the rows written per second, by any process (as counted by the table_versions
+    triggers), stay under max_write_rate (and, if given, within the quiet hours). When several
+    processes run a MaintenanceScheduler on the same database, a lock file makes sure only one of
+    them does the maintenance at a time.
+    """
+
+    def __init__(self, handler, max_freelist_ratio=0.1, pages_per_step=256, analyze_drift=0.25,
+                 analysis_limit=1000, max_write_rate=1.0, quiet_hours=None, history=50):
+        """
+        :param handler:             The DatabaseHandler of the database
+        :param max_freelist_ratio:  The fraction of free pages above which they are vacuumed
+        :param pages_per_step:      How many pages are freed per transaction
+        :param analyze_drift:       The relative change of its number of rows past which a table is analyzed again
+        :param analysis_limit:      How many rows of each index ANALYZE looks at (0 for all of them)
+        :param max_write_rate:      The maximum number of rows written per second for the database to be
+                                    considered quiet
+        :param quiet_hours:         If given, maintenance only happens between these (local) hours, as a
+                                    (start, end) tuple, e.g. (2, 5) for 02:00 to 05:00
+        :param history:             How many of the latest actions are reported by stats()
+        """
+        self._handler = handler
+        self._db_path = handler.get_database_path()
+        self._max_freelist_ratio = max_freelist_ratio
+        self._pages_per_step = pages_per_step
+        self._analyze_drift = analyze_drift
+        self._analysis_limit = analysis_limit
+        self._max_write_rate = max_write_rate
+        self._quiet_hours = quiet_hours
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._last_writes = None
+        # The table_versions counters of each table when it was last analyzed (or first seen)
+        self._analyzed_versions = dict()
+
+        try:
+            self._write_counters()
+        except sql.OperationalError as e:
+            raise RuntimeError(self._db_path + " has no table_versions table: run the schema migration of "
+                               "database/database_migrator.py on it first") from e
+
+        self._actions = collections.deque(maxlen=history)
+        self._stats = {
+            "checks": 0,
+            "passes": 0,
+            "skipped": 0,
+            "failures": 0,
+            "vacuums": 0,
+            "pages_freed": 0,
+            "analyzes": 0,
+            "seconds_total": 0.0,
+            "auto_vacuum": None,
+            "page_count": 0,
+            "freelist_count": 0,
+            "freelist_ratio": 0.0,
+            "file_bytes": 0,
+            "tables": dict(),
+        }
+
+    def check(self, force=False):
+        """
+            Method that measures the database and, if it is quiet (or if forced), does the maintenance it needs
+
+        :param force:   True - to do the maintenance even if the database isn't quiet
+        :return:        The list of actions done (see stats()), or None if the database wasn't quiet
+                        or another process is doing the maintenance
+        """
+        self._measure()
+
+        quiet = self._is_quiet()
+        if not (quiet or force):
+            with self._lock:
+                self._stats["skipped"] += 1
+            return None
+
+        lock_path = self._db_path + ".maintenance.lock"
+        with open(lock_path, "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+
+            try:
+                actions = self._maintain()
+            except Exception:
+                logger.exception("Maintenance of %s failed", self._db_path)
+                with self._lock:
+                    self._stats["failures"] += 1
+                raise
+
+        with self._lock:
+            self._stats["passes"] += 1
+
+        # The writes made by the maintenance itself don't count towards the next quiet check
+        self._last_writes = (time.monotonic(), sum(self._write_counters().values()))
+        return actions
+
+    def _measure(self):
+        con = sql.connect(self._db_path)
+        try:
+            auto_vacuum = con.execute("PRAGMA auto_vacuum;").fetchone()[0]
+            page_count = con.execute("PRAGMA page_count;").fetchone()[0]
+            freelist_count = con.execute("PRAGMA freelist_count;").fetchone()[0]
+        finally:
+            con.close()
+
+        with self._lock:
+            self._stats["checks"] += 1
+            self._stats["auto_vacuum"] = _AUTO_VACUUM_MODES.get(auto_vacuum, str(auto_vacuum))
+            self._stats["page_count"] = page_count
+            self._stats["freelist_count"] = freelist_count
+            self._stats["freelist_ratio"] = freelist_count / page_count if page_count else 0.0
+            self._stats["file_bytes"] = os.path.getsize(self._db_path)
+
+    def _is_quiet(self):
+        if self._quiet_hours is not None:
+            start, end = self._quiet_hours
+            hour = time.localtime().tm_hour
+            if not (start <= hour < end if start <= end else hour >= start or hour < end):
+                return False
+
+        now = time.monotonic()
+        writes = sum(self._write_counters().values())
+        last, self._last_writes = self._last_writes, (now, writes)
+
+        if last is None or now <= last[0]:
+            # Nothing to compare with yet
+            return False
+
+        return (writes - last[1]) / (now - last[0]) <= self._max_write_rate
+
+    def _maintain(self):
+        actions = list()
+
+        with self._lock:
+            auto_vacuum = self._stats["auto_vacuum"]
+            freelist_ratio = self._stats["freelist_ratio"]
+            freelist_count = self._stats["freelist_count"]
+
+        if freelist_ratio > self._max_freelist_ratio:
+            if auto_vacuum == "incremental":
+                actions.append(self._vacuum(freelist_count))
+            else:
+                logger.warning("%s has %.0f%% of free pages, but its auto_vacuum mode is %s: run "
+                               "python -m database.maintenance %s --enable-incremental-vacuum",
+                               self._db_path, 100 * freelist_ratio, auto_vacuum, self._db_path)
+
+        counters = self._write_counters()
+        for table, (analyzed_rows, empty) in sorted(self._table_statistics().items()):
+            if analyzed_rows is None:
+                if not empty:
+                    actions.append(self._analyze(table, counters))
+                continue
+
+            # Tables without a counter are only analyzed once
+            if table not in counters:
+                continue
+            if table not in self._analyzed_versions:
+                self._analyzed_versions[table] = counters[table]
+            elif counters[table] - self._analyzed_versions[table] > self._analyze_drift * max(analyzed_rows, 1):
+                actions.append(self._analyze(table, counters))
+
+        with self._lock:
+            self._stats["tables"] = {table: rows for table, (rows, _) in self._table_statistics().items()
+                                     if rows is not None}
+            self._stats["seconds_total"] += sum(action["duration_s"] for action in actions)
+            self._actions.extend(actions)
+
+        for action in actions:
+            logger.info("Maintenance of %s: %s", self._db_path, action)
+
+        return actions
+
+    def _vacuum(self, pages):
+        """
+            Method that frees the free pages, pages_per_step at a time
+        """
+        start = time.perf_counter()
+        steps = 0
+        remaining = pages
+
+        while remaining > 0 and not self._stop.is_set():
+            step = min(remaining, self._pages_per_step)
+            # Run from Python, each execution of the pragma frees a single page
+            self._handler.run_maintenance(["PRAGMA incremental_vacuum(1);"] * step)
+            remaining -= step
+            steps += 1
+
+        con = sql.connect(self._db_path)
+        try:
+            freed = pages - con.execute("PRAGMA freelist_count;").fetchone()[0]
+        finally:
+            con.close()
+
+        with self._lock:
+            self._stats["vacuums"] += 1
+            self._stats["pages_freed"] += max(freed, 0)
+
+        return {"action": "incremental_vacuum", "table": None, "pages": max(freed, 0), "steps": steps,
+                "duration_s": time.perf_counter() - start, "at": time.time()}
+
+    def _analyze(self, table, counters):
+        start = time.perf_counter()
+        self._handler.run_maintenance(["PRAGMA analysis_limit = " + str(int(self._analysis_limit)) + ";",
+                                       "ANALYZE \"" + table.replace("\"", "\"\"") + "\";"])
+        if table in counters:
+            self._analyzed_versions[table] = counters[table]
+
+        with self._lock:
+            self._stats["analyzes"] += 1
+
+        return {"action": "analyze", "table": table, "rows": self._table_statistics().get(table, (None,))[0],
+                "duration_s": time.perf_counter() - start, "at": time.time()}
+
+    def _write_counters(self):
+        """
+        :return:    The number of rows written to each versioned table so far, by every process, as counted by
+                    the table_versions triggers: {<table>: <no_of_rows_written>}
+        """
+        con = sql.connect(self._db_path)
+        try:
+            return dict(con.execute("SELECT name, version FROM table_versions WHERE name IN (" +
+                                    ", ".join("?" * len(VERSIONED_TABLES)) + ");", VERSIONED_TABLES).fetchall())
+        finally:
+            con.close()
+
+    def _table_statistics(self):
+        """
+        :return:    A dictionary of the format
+                    {<table>: (<no_of_rows_when_last_analyzed> (None if never), <is_empty>)}
+                    (<is_empty> is only looked up for the tables that were never analyzed)
+        """
+        con = sql.connect(self._db_path)
+        try:
+            tables = [name for name, in con.execute("SELECT name FROM sqlite_master "
+                                                    "WHERE type='table' AND name NOT LIKE 'sqlite_%';")]
+            try:
+                stats = con.execute("SELECT tbl, stat FROM sqlite_stat1;").fetchall()
+            except sql.OperationalError:
+                stats = []
+
+            analyzed = dict()
+            for table, stat in stats:
+                if stat is None:
+                    continue
+                # The first number of a stat is the number of rows of the table when it was analyzed
+                analyzed[table] = max(analyzed.get(table, 0), int(stat.split(" ")[0]))
+
+            return {table: (analyzed[table], False) if table in analyzed else
+                    (None, con.execute("SELECT 1 FROM \"" + table.replace("\"", "\"\"") + "\" LIMIT 1;").fetchone()
+                     is None)
+                    for table in tables}
+        finally:
+            con.close()
+
+    def start(self, interval):
+        """
+            Method that checks the database every interval seconds, on a background thread
+
+        :param interval:    The time between two checks, in seconds
+        """
+        def loop():
+            # Only measures the write rate, which needs two checks to be known
+            self._is_quiet()
+            while not self._stop.wait(interval):
+                try:
+                    self.check()
+                except Exception:
+                    pass
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=loop, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "checks": <no_of_checks>,
+                        "passes": <no_of_maintenance_passes_done>,
+                        "skipped": <no_of_checks_outside_of_a_quiet_window>,
+                        "failures": <no_of_maintenance_passes_that_failed>,
+                        "vacuums": <no_of_incremental_vacuums>,
+                        "pages_freed": <no_of_pages_given_back_to_the_file_system>,
+                        "analyzes": <no_of_tables_analyzed>,
+                        "seconds_total": <time_spent_on_maintenance>,
+                        "auto_vacuum": <"none"/"full"/"incremental">,
+                        "page_count": <no_of_pages_at_the_last_check>,
+                        "freelist_count": <no_of_free_pages_at_the_last_check>,
+                        "freelist_ratio": <fraction_of_free_pages_at_the_last_check>,
+                        "file_bytes": <size_of_the_file_at_the_last_check>,
+                        "tables": {<table>: <no_of_rows_when_last_analyzed>, ...},
+                        "actions": [                                            (the latest ones, oldest first)
+                            {
+                                "action": <"incremental_vacuum"/"analyze">,
+                                "table": <analyzed_table> (None for vacuums),
+                                "duration_s": <time_it_took>,
+                                "at": <epoch_it_finished_at>,
+                                ...                                             ("pages" and "steps" for vacuums,
+                            },                                                   "rows" for analyzes)
+                            ...
+                        ]
+                    }
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["tables"] = dict(stats["tables"])
+            stats["actions"] = list(self._actions)
+            return stats
+
+
+if __name__ == "__main__":
+    from database.database_handler import DatabaseHandler
+
+    parser = argparse.ArgumentParser(description="Vacuum the free pages of the database and refresh its statistics")
+    parser.add_argument("db_path")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="Switch the database to incremental vacuum first (rebuilds it: stop the server before)")
+    parser.add_argument("--max-freelist-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(args.db_path)
+        print("Enabled incremental vacuum")
+
+    handler = DatabaseHandler(args.db_path)
+    try:
+        scheduler = MaintenanceScheduler(handler, args.max_freelist_ratio)
+        actions = scheduler.check(force=True)
+    finally:
+        handler.close()
+
+    stats = scheduler.stats()
+    print("%d pages, %.1f%% free, auto_vacuum %s" % (stats["page_count"], 100 * stats["freelist_ratio"],
+                                                   stats["auto_vacuum"]))
+    for action in actions or []:
+        print(action["action"] + (" " + action["table"] if action["table"] else "") + ": "
+              + "%.3f s" % action["duration_s"])
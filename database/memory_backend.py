@@ -0,0 +1,463 @@
+import bisect
+import os
+import sqlite3 as sql
+import threading
+from contextlib import contextmanager
+from database.storage_backend import StorageBackend, ConstraintError
+from database.timestamps import to_epoch
+from database.table_generations import TableGenerations
+from database.query_profiler import QueryProfiler
+from database.log_partitions import partition_paths
+
+# name -> (columns, primary key, default values, NOT NULL columns, indexed columns), as in database_creator
+_TABLES = {
+    "users": (("id", "email", "full_name", "password", "admin"), ("id",), {"admin": 0},
+              ("email", "full_name", "admin"), ("email",)),
+    "logged_in": (("token", "uid", "last_login", "TTL"), ("token",), {},
+                  ("uid", "last_login", "TTL"), ("uid",)),
+    "revoked_sessions": (("uid", "revoked_at"), ("uid",), {}, ("revoked_at",), ()),
+    "working": (("uid", "working", "since", "cid", "time"), ("uid",), {"working": 0, "time": 0},
+                ("working", "cid", "time"), ()),
+    "course_categories": (("id", "category_name"), ("id",), {}, ("category_name",), ()),
+    "courses": (("id", "name", "url", "cid", "description", "about", "syllabus", "notes", "weekly_commitment_low",
+                 "weekly_commitment_high", "number_weeks"), ("id",), {}, ("name", "url", "cid"), ("name",)),
+    "logs": (("id", "uid", "cid", "duration", "started_at", "logged_at"), ("id",), {},
+             ("uid", "cid", "duration"), ()),
+    "logs_daily": (("uid", "cid", "day", "duration", "sessions"), ("uid", "cid", "day"), {},
+                   ("uid", "cid", "day", "duration", "sessions"), ()),
+    "rights": (("id", "uid", "cid"), ("id",), {}, ("uid", "cid"), ()),
+}
+
+# The timestamp columns, which can hold legacy text in the database files (see to_epoch)
+_TIMESTAMPS = {
+    "logged_in": ("last_login",),
+    "working": ("since",),
+    "logs": ("started_at", "logged_at"),
+}
+
+
+class _Table:
+    """
+        The rows of a table, by primary key, and the hash indexes over some of its columns
+    """
+
+    def __init__(self, name, columns, key, defaults, not_null, indexed):
+        self.name = name
+        self.columns = columns
+        self.positions = {column: i for i, column in enumerate(columns)}
+        self.key = tuple(self.positions[column] for column in key)
+        self.defaults = defaults
+        self.not_null = tuple(self.positions[column] for column in not_null)
+        self.autoincrement = key == ("id",)
+        self.next_id = 1
+
+        # primary key (as a tuple) -> row
+        self.rows = dict()
+        # column -> {value: set of primary keys}
+        self.indexes = {column: dict() for column in indexed}
+
+    def key_of(self, row):
+        return tuple(row[i] for i in self.key)
+
+    def new_row(self, values):
+        """
+        :param values:  The values of the row, as a dictionary of the format {<column>: <value>}
+        :return:        The row, with the default values of the missing columns
+        """
+        for column in values:
+            if column not in self.positions:
+                raise KeyError("No column " + column + " in " + self.name)
+
+        row = [values[column] if column in values else self.defaults.get(column) for column in self.columns]
+        if self.autoincrement and row[0] is None:
+            row[0] = self.next_id
+        return tuple(row)
+
+    def check(self, row):
+        for i in self.not_null:
+            if row[i] is None:
+                raise ConstraintError("NOT NULL constraint failed: " + self.name + "." + self.columns[i])
+
+    def add(self, row):
+        key = self.key_of(row)
+        if key in self.rows:
+            raise ConstraintError("UNIQUE constraint failed: " + self.name)
+
+        self.rows[key] = row
+        for column, index in self.indexes.items():
+            index.setdefault(row[self.positions[column]], set()).add(key)
+
+        if self.autoincrement and isinstance(row[0], int) and row[0] >= self.next_id:
+            self.next_id = row[0] + 1
+
+    def remove(self, key):
+        row = self.rows.pop(key)
+        for column, index in self.indexes.items():
+            keys = index[row[self.positions[column]]]
+            keys.discard(key)
+            if not keys:
+                del index[row[self.positions[column]]]
+        return row
+
+    def find(self, where):
+        """
+        :param where:   The conditions, as a dictionary of the format {<column>: <value>} (None for every row)
+        :return:        The primary keys of the rows matching them
+        """
+        if not where:
+            return list(self.rows)
+
+        if all(self.columns[i] in where for i in self.key):
+            key = tuple(where[self.columns[i]] for i in self.key)
+            candidates = [key] if key in self.rows else []
+        else:
+            indexed = [column for column in where if column in self.indexes]
+            if indexed:
+                candidates = list(self.indexes[indexed[0]].get(where[indexed[0]], ()))
+            else:
+                candidates = list(self.rows)
+
+        conditions = [(self.positions[column], value) for column, value in where.items()]
+        return [key for key in candidates if all(self.rows[key][i] == value for i, value in conditions)]
+
+
+class MemoryBackend(StorageBackend):
+    """
+        The storage of the DatabaseHandler in indexed Python data structures, for benchmarks and
+    tests: nothing is persisted. It gives the floor of the request path, without any I/O.
+
+        Tables are dictionaries of rows by primary key, with hash indexes on the columns the
+    operations look rows up by. The logs of each user are also kept sorted by start time, with
+    their running totals, so that the history, stats and leaderboard reads don't scan the logs
+    of everyone. Writes are applied under a lock; those of an atomic block are undone if one of
+    them fails.
+
+        It can be loaded from a database file, archive partitions included (see LogArchiver).
+    The maintenance of the database file (archival, retention, backups, vacuum) doesn't apply.
+    """
+
+    def __init__(self, db_path=None):
+        """
+        :param db_path:     The database file to load the rows from (optional: empty tables otherwise)
+        """
+        self.profiler = QueryProfiler(None)
+        self._lock = threading.RLock()
+        self._pending_writes = threading.local()
+        self._generations = TableGenerations()
+        self._tables = {name: _Table(name, *definition) for name, definition in _TABLES.items()}
+
+        # uid -> sorted list of (started_at, id) of the logs with a start time
+        self._logs_by_start = dict()
+        # uid -> [no_of_logs, total_duration]
+        self._logs_totals = dict()
+        # The ids of the logs, sorted
+        self._log_ids = list()
+        # uid -> sorted list of (day, cid) of the rolled up logs
+        self._days = dict()
+        # uid -> [no_of_days, total_duration]
+        self._days_totals = dict()
+
+        self._stats = {
+            "batches": 0,
+            "writes": 0,
+            "failed": 0,
+            "largest_batch": 0,
+        }
+
+        if db_path is not None:
+            self._load(db_path)
+
+    def _load(self, db_path):
+        con = sql.connect(db_path)
+        try:
+            for name, table in self._tables.items():
+                try:
+                    rows = con.execute("SELECT " + ", ".join(table.columns) + " FROM " + name + ";").fetchall()
+                except sql.OperationalError:
+                    # Not created in this database (yet)
+                    continue
+                for row in rows:
+                    self._add(table, self._converted(table, row))
+
+            for name, sequence in con.execute("SELECT name, seq FROM sqlite_sequence;").fetchall():
+                if name in self._tables:
+                    self._tables[name].next_id = max(self._tables[name].next_id, sequence + 1)
+
+            paths = partition_paths(con, os.path.dirname(os.path.abspath(db_path)), None, None)
+        finally:
+            con.close()
+
+        logs = self._tables["logs"]
+        for path in paths:
+            partition = sql.connect("file:" + path + "?mode=ro", uri=True)
+            try:
+                for row in partition.execute("SELECT " + ", ".join(logs.columns) + " FROM logs;"):
+                    self._add(logs, self._converted(logs, row))
+            finally:
+                partition.close()
+
+    def _converted(self, table, row):
+        columns = _TIMESTAMPS.get(table.name)
+        if not columns:
+            return row
+
+        row = list(row)
+        for column in columns:
+            row[table.positions[column]] = to_epoch(row[table.positions[column]])
+        return tuple(row)
+
+    def _add(self, table, row):
+        table.add(row)
+
+        if table.name == "logs":
+            uid, duration, started_at = row[1], row[3], row[4]
+            totals = self._logs_totals.setdefault(uid, [0, 0])
+            totals[0] += 1
+            totals[1] += duration
+            if started_at is not None:
+                bisect.insort(self._logs_by_start.setdefault(uid, []), (started_at, row[0]))
+            bisect.insort(self._log_ids, row[0])
+        elif table.name == "logs_daily":
+            uid, cid, day, duration = row[:4]
+            totals = self._days_totals.setdefault(uid, [0, 0])
+            totals[0] += 1
+            totals[1] += duration
+            bisect.insort(self._days.setdefault(uid, []), (day, cid))
+
+    def _remove(self, table, key):
+        row = table.remove(key)
+
+        if table.name == "logs":
+            uid, duration, started_at = row[1], row[3], row[4]
+            self._logs_totals[uid][0] -= 1
+            self._logs_totals[uid][1] -= duration
+            if started_at is not None:
+                entries = self._logs_by_start[uid]
+                del entries[bisect.bisect_left(entries, (started_at, row[0]))]
+            del self._log_ids[bisect.bisect_left(self._log_ids, row[0])]
+        elif table.name == "logs_daily":
+            uid, cid, day, duration = row[:4]
+            self._days_totals[uid][0] -= 1
+            self._days_totals[uid][1] -= duration
+            entries = self._days[uid]
+            del entries[bisect.bisect_left(entries, (day, cid))]
+
+        return row
+
+    @contextmanager
+    def atomic(self):
+        self._pending_writes.operations = list()
+        try:
+            yield
+            operations = self._pending_writes.operations
+        finally:
+            self._pending_writes.operations = None
+
+        if operations:
+            self._commit(operations)
+
+    def _write(self, operation):
+        pending = getattr(self._pending_writes, "operations", None)
+        if pending is not None:
+            pending.append(operation)
+        else:
+            self._commit([operation])
+
+    def _commit(self, operations):
+        """
+            Method that applies writes as one transaction: if one of them fails, the ones applied
+        before it are undone
+        """
+        with self._lock:
+            # ("added", table, key) and ("removed", table, row) entries, in the order they were made
+            undo = list()
+            try:
+                for operation in operations:
+                    with self.profiler.profile(None, operation[0].upper() + " " + operation[1]):
+                        getattr(self, "_apply_" + operation[0])(undo, *operation[1:])
+            except Exception:
+                for change, table, item in reversed(undo):
+                    if change == "added":
+                        self._remove(table, item)
+                    else:
+                        self._add(table, item)
+                self._stats["failed"] += 1
+                self._stats["writes"] += 1
+                raise
+
+            for table in {operation[1] for operation in operations}:
+                self._generations.bump(table)
+
+            # Applied as soon as they're made: there's no group commit
+            self._stats["batches"] += 1
+            self._stats["writes"] += 1
+            self._stats["largest_batch"] = 1
+
+    def _apply_insert(self, undo, name, values, replace):
+        table = self._tables[name]
+        row = table.new_row(values)
+        table.check(row)
+
+        key = table.key_of(row)
+        if replace and key in table.rows:
+            undo.append(("removed", table, self._remove(table, key)))
+
+        self._add(table, row)
+        undo.append(("added", table, key))
+
+    def _apply_update(self, undo, name, values, where):
+        table = self._tables[name]
+        for key in table.find(where):
+            old = table.rows[key]
+            row = list(old)
+            for column, value in values.items():
+                row[table.positions[column]] = value
+            row = tuple(row)
+            table.check(row)
+
+            self._remove(table, key)
+            undo.append(("removed", table, old))
+            self._add(table, row)
+            undo.append(("added", table, table.key_of(row)))
+
+    def _apply_delete(self, undo, name, where):
+        table = self._tables[name]
+        for key in table.find(where):
+            undo.append(("removed", table, self._remove(table, key)))
+
+    def insert(self, table, values, replace=False):
+        self._write(("insert", table, dict(values), replace))
+
+    def update(self, table, values, where):
+        self._write(("update", table, dict(values), dict(where or {})))
+
+    def delete(self, table, where):
+        self._write(("delete", table, dict(where or {})))
+
+    def select(self, table, where=None, columns=None):
+        with self._lock, self.profiler.profile(None, "SELECT " + table):
+            table = self._tables[table]
+            rows = [table.rows[key] for key in table.find(where)]
+            if columns is None:
+                return rows
+
+            positions = [table.positions[column] for column in columns]
+            return [tuple(row[i] for i in positions) for row in rows]
+
+    def _row(self, table, *key):
+        return self._tables[table].rows.get(key)
+
+    def working_users(self):
+        with self._lock, self.profiler.profile(None, "working_users"):
+            results = list()
+            for uid, working, since, cid, time in self._tables["working"].rows.values():
+                user = self._row("users", uid)
+                course = self._row("courses", cid)
+                if user is not None and course is not None:
+                    results.append((user[2], user[1], course[1], since, time))
+            return results
+
+    def working_course(self, uid):
+        with self._lock, self.profiler.profile(None, "working_course"):
+            working = self._row("working", uid)
+            if working is None or working[1] != 1:
+                return None
+
+            course = self._row("courses", working[3])
+            return (course[1], working[4], working[2]) if course is not None else None
+
+    def courses_with_details(self):
+        with self._lock, self.profiler.profile(None, "courses_with_details"):
+            results = list()
+            for course in self._tables["courses"].rows.values():
+                category = self._row("course_categories", course[3])
+                if category is not None:
+                    results.append((course[1], course[2], course[6], course[5], course[7], course[8], course[9],
+                                    course[10], category[1]))
+            return results
+
+    def revocations(self, since):
+        with self._lock, self.profiler.profile(None, "revocations"):
+            return [row for row in self._tables["revoked_sessions"].rows.values() if row[1] > since]
+
+    def logs(self, from_snapshot=False):
+        with self._lock, self.profiler.profile(None, "logs"):
+            results = list()
+            for id, uid, cid, duration, started_at, logged_at in self._tables["logs"].rows.values():
+                user = self._row("users", uid)
+                course = self._row("courses", cid)
+                if user is not None and course is not None:
+                    results.append((user[2], user[1], course[1], duration, started_at, logged_at))
+            return results
+
+    def log_changes(self, since, limit):
+        with self._lock, self.profiler.profile(None, "log_changes"):
+            logs = self._tables["logs"]
+            start = bisect.bisect_right(self._log_ids, since)
+            ids = self._log_ids[start:start + limit]
+            results = list()
+            for id in ids:
+                _, uid, cid, duration, started_at, logged_at = logs.rows[(id,)]
+                user = self._row("users", uid)
+                course = self._row("courses", cid)
+                if user is not None and course is not None:
+                    results.append((id, user[2], user[1], course[1], duration, started_at, logged_at))
+            return results, ids[-1] if ids else None, len(ids)
+
+    def _range(self, entries, since, until):
+        """
+        :param entries:     A sorted list of tuples, whose first item is an epoch
+        :return:            The ones whose epoch is within [since, until)
+        """
+        low = bisect.bisect_left(entries, (since,)) if since is not None else 0
+        high = bisect.bisect_left(entries, (until,)) if until is not None else len(entries)
+        return entries[low:high]
+
+    def history(self, uid, since=None, until=None, from_snapshot=False):
+        with self._lock, self.profiler.profile(None, "history"):
+            results = list()
+            for started_at, id in self._range(self._logs_by_start.get(uid, []), since, until):
+                log = self._row("logs", id)
+                course = self._row("courses", log[2])
+                if log[5] is not None and course is not None:
+                    results.append((course[1], course[2], started_at, log[3], log[5]))
+
+            days = list()
+            for day, cid in self._range(self._days.get(uid, []), since, until):
+                daily = self._row("logs_daily", uid, cid, day)
+                course = self._row("courses", cid)
+                if course is not None:
+                    days.append((course[1], course[2], day, daily[3], None, daily[4]))
+
+            return sorted(results + days, key=lambda result: result[2])
+
+    def total_duration(self, uid, from_snapshot=False):
+        with self._lock, self.profiler.profile(None, "total_duration"):
+            logs = self._logs_totals.get(uid, [0, 0])
+            days = self._days_totals.get(uid, [0, 0])
+            return logs[1] + days[1] if logs[0] or days[0] else None
+
+    def leaderboard(self, since=None, until=None, from_snapshot=False):
+        with self._lock, self.profiler.profile(None, "leaderboard"):
+            logs = self._tables["logs"].rows
+            days = self._tables["logs_daily"].rows
+
+            results = list()
+            for uid, email, full_name, password, admin in sorted(self._tables["users"].rows.values()):
+                if since is None and until is None:
+                    seconds = self._logs_totals.get(uid, [0, 0])[1] + self._days_totals.get(uid, [0, 0])[1]
+                else:
+                    seconds = sum(logs[(id,)][3] for started_at, id in
+                                  self._range(self._logs_by_start.get(uid, []), since, until)) \
+                              + sum(days[(uid, cid, day)][3] for day, cid in
+                                    self._range(self._days.get(uid, []), since, until))
+                results.append((full_name, uid, email, float(seconds)))
+
+            return sorted(results, key=lambda user: -1.0 * user[3])
+
+    def generations(self, from_snapshot=False):
+        return self._generations
+
+    def write_stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from passlib.hash import pbkdf2_sha256
+
+
+def hash_password(password):
+    """
+    :param password:        the password to hash
+    :return:                the hash of the password
+    """
+    return pbkdf2_sha256.encrypt(password,
+                                 rounds=200000,
+                                 salt_size=16)
+
+
+def verify_password(password, hash):
+    """
+    :param password:        the password to be tested
+    :param hash:            the hashed password
+    :return:                True - if the passwords match
+                            False - otherwise
+    """
+    return pbkdf2_sha256.verify(password, hash)
+
+
+class PasswordHasher:
+    """
+        Hashes and checks passwords, either in the calling thread or on a pool of processes.
+
+        Hashing is deliberately slow (200000 rounds). With a pool, it runs on other cores
+    instead of competing with the request handling threads of the server process.
+    """
+
+    def __init__(self, processes=0):
+        """
+        :param processes:   The number of processes of the pool (0 hashes in the calling thread)
+        """
+        self._processes = processes
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # The processes are spawned rather than forked, as the server process runs threads
+                    self._pool = ProcessPoolExecutor(self._processes,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+                    self._pid = os.getpid()
+        return self._pool
+
+    def hash(self, password):
+        if not self._processes:
+            return hash_password(password)
+        return self._get_pool().submit(hash_password, password).result()
+
+    def verify(self, password, hash):
+        if not self._processes:
+            return verify_password(password, hash)
+        return self._get_pool().submit(verify_password, password, hash).result()
+
+    def close(self):
+        """
+            Method that stops the processes of the pool, if it was started by this process
+        """
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown()
+            self._pool = None
+            self._pid = None
@@ -0,0 +1,157 @@
+import functools
+import threading
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+        Bounded LRU cache for the results of DatabaseHandler read methods.
+
+        Every entry remembers the generations of the tables it was computed from. An entry
+    is only served while those generations are unchanged, so invalidation is exact: a write
+    to a table makes every result depending on it stale, and nothing else.
+    """
+
+    def __init__(self, max_entries=256):
+        """
+        :param max_entries:     The maximum number of results kept. 0 disables the cache
+        """
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._evictions = 0
+
+    def get(self, key, generations):
+        """
+            Method that looks up a cached result
+
+        :param key:             The key of the result
+        :param generations:     The current generations of the tables the result depends on
+        :return:                -> found - True if a fresh result was found
+                                -> value - the cached result (None if not found)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self._misses += 1
+                return False, None
+
+            if entry[0] != generations:
+                # One of the tables changed since the result was computed
+                del self._entries[key]
+                self._stale += 1
+                self._misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return True, entry[1]
+
+    def put(self, key, generations, value):
+        """
+            Method that stores a result in the cache, evicting the least recently used ones if needed
+
+        :param key:             The key of the result
+        :param generations:     The generations of the tables at the moment the result was computed
+        :param value:           The result
+        :return:                -
+        """
+        if self._max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (generations, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "entries": <no_of_cached_results>,
+                        "max_entries": <the_size_bound>,
+                        "hits": <no_of_hits>,
+                        "misses": <no_of_misses>,
+                        "stale": <no_of_misses_caused_by_a_write>,
+                        "evictions": <no_of_LRU_evictions>
+                    }
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self._max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "stale": self._stale,
+                "evictions": self._evictions
+            }
+
+
+def _is_cacheable(result):
+    """
+        Failed reads are never cached, so that a transient error doesn't stick until the next write
+    """
+    if result is None:
+        return False
+
+    if isinstance(result, dict) and result.get("success") is False:
+        return False
+
+    if isinstance(result, tuple) and len(result) > 0 and result[0] is False:
+        return False
+
+    return True
+
+
+def cached_read(*tables, from_snapshot=False):
+    """
+        Decorator for DatabaseHandler read methods whose result only depends on their
+    arguments and on the content of the given tables.
+
+        On a miss, identical concurrent calls are coalesced into one computation.
+        Cached results are shared between callers, so they have to be treated as read-only.
+
+    :param tables:          The names of the tables the method reads from
+    :param from_snapshot:   True - if the method reads the tables from the read snapshot, in which
+                            case its results are versioned by the snapshot instead
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapped(self, *args):
+            key = (method.__name__, args)
+            generations = self._generations_for(from_snapshot).snapshot(tables)
+
+            found, value = self._query_cache.get(key, generations)
+            if found:
+                return value
+
+            # Concurrent misses for the same result share a single computation. The
+            # generations are part of the flight key, so a caller arriving after a write
+            # never joins a computation that may have started before it.
+            #
+            # The generations are read before the query runs, so a write racing with it
+            # can only make this entry look older than it is, never fresher
+            value = self._single_flight.do((key, generations), method.__name__, method, self, *args)
+
+            if _is_cacheable(value):
+                self._query_cache.put(key, generations, value)
+
+            return value
+
+        wrapped.cached_tables = tables
+        wrapped.from_snapshot = from_snapshot
+        return wrapped
+
+    return decorator
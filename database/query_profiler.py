@@ -0,0 +1,213 @@
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+_TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+(\w+(?:\.\w+)?)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?([\w.]+)(?: AS (\w+))?")
+_AUTOMATIC_INDEX = re.compile(r"^SEARCH (?:TABLE )?([\w.]+)(?: AS (\w+))? USING AUTOMATIC")
+
+
+def normalize_statement(query):
+    """
+        Function that turns a query into the statement it is an instance of, by replacing
+    inlined literals with '?', so that e.g. "... WHERE uid=3" and "... WHERE uid=7" are
+    accounted together.
+
+    :param query:       The SQL query
+    :return:            The normalized statement
+    """
+    statement = _STRING_LITERAL.sub("?", query)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    return _WHITESPACE.sub(" ", statement).strip().rstrip(";")
+
+
+class QueryProfiler:
+    """
+        Times and counts every statement executed by the DatabaseHandler, both globally and
+    for the request currently being handled by the calling thread.
+
+        The first time a statement is seen (and then again every plan_check_interval seconds)
+    its EXPLAIN QUERY PLAN is inspected. If it does a full scan of (or builds an automatic index
+    over) a table with more than scan_threshold rows, it gets flagged and a warning is logged.
+    """
+
+    def __init__(self, scan_threshold=1000, plan_check_interval=300):
+        """
+        :param scan_threshold:          Full scans of tables with more rows than this get flagged.
+                                        None disables the plan checks
+        :param plan_check_interval:     How often (in seconds) the plan of a statement is checked again
+        """
+        self._scan_threshold = scan_threshold
+        self._plan_check_interval = plan_check_interval
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        # statement -> [count, total_seconds, max_seconds]
+        self._stats = dict()
+        # statement -> time of the last plan check
+        self._plan_checked_at = dict()
+        # statement -> list of (table, rows) it fully scans
+        self._full_scans = dict()
+
+    @contextmanager
+    def profile(self, con, query, args=(), request=None):
+        """
+            Context manager timing the execution of a query (including fetching its results)
+
+        :param con:         The connection the query runs on, used for the plan check
+        :param query:       The query
+        :param args:        The arguments of the query
+        :param request:     The accounting of the request the query runs for (see current_request),
+                            if it runs on another thread than the one handling the request
+        """
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+
+        statement = normalize_statement(query)
+        self._record(statement, elapsed, request)
+
+        if self._scan_threshold is not None and self._plan_is_due(statement):
+            self._check_plan(con, query, args, statement)
+
+    def _record(self, statement, elapsed, request=None):
+        with self._lock:
+            stats = self._stats.get(statement)
+            if stats is None:
+                stats = [0, 0.0, 0.0]
+                self._stats[statement] = stats
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+        current = request if request is not None else getattr(self._local, "request", None)
+        if current is not None:
+            current["queries"] += 1
+            current["seconds"] += elapsed
+            current["statements"][statement] = current["statements"].get(statement, 0) + 1
+
+    def _plan_is_due(self, statement):
+        now = time.monotonic()
+        with self._lock:
+            last = self._plan_checked_at.get(statement)
+            if last is not None and now - last < self._plan_check_interval:
+                return False
+            self._plan_checked_at[statement] = now
+            return True
+
+    def _check_plan(self, con, query, args, statement):
+        if not statement.upper().startswith("SELECT"):
+            return
+
+        try:
+            plan = con.execute("EXPLAIN QUERY PLAN " + query, args).fetchall()
+
+            aliases = dict()
+            for table, alias in _TABLE_REFERENCE.findall(query):
+                aliases[table] = table
+                if alias and alias.upper() not in ("WHERE", "INNER", "LEFT", "ON", "GROUP", "ORDER", "LIMIT"):
+                    aliases[alias] = table
+
+            scans = list()
+            for row in plan:
+                detail = row[-1]
+                match = _FULL_SCAN.match(detail) or _AUTOMATIC_INDEX.match(detail)
+                if match is None:
+                    continue
+
+                table = aliases.get(match.group(1))
+                if table is None:
+                    # A subquery (e.g. the logs combined with their archive partitions), whose tables are listed on their own
+                    continue
+
+                rows = con.execute("SELECT MAX(rowid) FROM " + table).fetchone()[0] or 0
+                if rows > self._scan_threshold:
+                    scans.append((table, rows))
+        except Exception:
+            logger.exception("Could not check the query plan of: %s", statement)
+            return
+
+        with self._lock:
+            if scans:
+                self._full_scans[statement] = scans
+            else:
+                self._full_scans.pop(statement, None)
+
+        for table, rows in scans:
+            logger.warning("Full scan of %s (~%d rows) in: %s", table, rows, statement)
+
+    def begin_request(self):
+        """
+            Method that starts accounting the statements executed by the calling thread
+        """
+        self._local.request = {
+            "queries": 0,
+            "seconds": 0.0,
+            "statements": dict()
+        }
+
+    def end_request(self):
+        """
+            Method that stops the accounting started by begin_request
+
+        :return:    A dictionary of the format:
+                    {
+                        "queries": <no_of_statements_executed>,
+                        "seconds": <time_spent_executing_them>,
+                        "statements": {<statement>: <no_of_executions>, ...}
+                    }
+                    or None if begin_request wasn't called
+        """
+        current = getattr(self._local, "request", None)
+        self._local.request = None
+        return current
+
+    def current_request(self):
+        """
+        :return:    The accounting of the request being handled by the calling thread (see end_request)
+        """
+        return getattr(self._local, "request", None)
+
+    def summary(self, limit=10):
+        """
+        :param limit:   How many statements to return in each list
+        :return:        A dictionary of the format:
+                        {
+                            "slowest": [                    (by maximum execution time)
+                                {
+                                    "statement": <normalized_statement>,
+                                    "count": <no_of_executions>,
+                                    "total_ms": <total_time>,
+                                    "avg_ms": <average_time>,
+                                    "max_ms": <maximum_time>,
+                                    "full_scans": [[<table>, <rows>], ...]
+                                },
+                                ...
+                            ],
+                            "most_frequent": [ ... ],      (by number of executions)
+                            "full_scans": [ ... ]          (every statement flagged for doing a full scan)
+                        }
+        """
+        with self._lock:
+            entries = [{
+                "statement": statement,
+                "count": stats[0],
+                "total_ms": stats[1] * 1000,
+                "avg_ms": stats[1] * 1000 / stats[0],
+                "max_ms": stats[2] * 1000,
+                "full_scans": [list(scan) for scan in self._full_scans.get(statement, [])]
+            } for statement, stats in self._stats.items()]
+
+        return {
+            "slowest": sorted(entries, key=lambda e: -e["max_ms"])[:limit],
+            "most_frequent": sorted(entries, key=lambda e: -e["count"])[:limit],
+            "full_scans": [e for e in entries if e["full_scans"]]
+        }
@@ -0,0 +1,205 @@
+import logging
+import os
+import sqlite3 as sql
+import threading
+import time
+from urllib.parse import quote
+from database.table_generations import FrozenTableGenerations
+
+logger = logging.getLogger(__name__)
+
+
+def connect_read_only(path):
+    """
+    :param path:    The path of a database file
+    :return:        A read-only connection to it
+    """
+    return sql.connect("file:" + quote(os.path.abspath(path)) + "?mode=ro", uri=True)
+
+
+class ReadSnapshot:
+    """
+        A periodically refreshed copy of the database, made with SQLite's online backup API,
+    that the heavy analytics reads run on, so that they never hold locks on the live database.
+
+        The copy is replaced atomically (readers still using the previous one keep reading it)
+    once it is older than max_staleness: the first read noticing it starts the refresh in the
+    background and keeps reading the current copy in the meantime. Several processes can share
+    the same copy, as its age is that of the file.
+
+        Each copy stores the generations the tables had when it was taken, so that cached
+    results and ETags of reads served from it are versioned by the copy, not by the live database.
+
+        The copy is made a few pages at a time, so that it never holds the database lock for longer
+    than a step and writers are never held up by it. Given the backup function of the writer (see
+    SingleWriter.backup), it is made by the writer thread, which commits the writes of this process
+    between two steps, so that they are applied to the copy instead of making it start over. Writes of other processes
+    still make it start over: after max_restarts, the refresh is given up, and the current copy kept
+    until the next one.
+    """
+
+    def __init__(self, db_path, generations, max_staleness=60, snapshot_path=None, backup=None,
+                 pages_per_step=256, step_sleep=0.005, max_restarts=5):
+        """
+        :param db_path:             The path of the live database
+        :param generations:         The generations of the live database (TableGenerations or SharedTableGenerations)
+        :param max_staleness:       How old (in seconds) the copy can get before it is refreshed
+        :param snapshot_path:       Where to keep the copy (default: next to the database)
+        :param backup:              The function copying the database, as backup(target, pages, sleep, progress)
+                                    (default: a copy from a connection of its own)
+        :param pages_per_step:      How many pages are copied at a time
+        :param step_sleep:          How long to sleep between two steps, in seconds
+        :param max_restarts:        How many times a copy can start over before the refresh is given up
+        """
+        self._db_path = db_path
+        self._generations = generations
+        self._max_staleness = max_staleness
+        self._path = snapshot_path or db_path + ".snapshot"
+        self._backup = backup
+        self._pages_per_step = pages_per_step
+        self._step_sleep = step_sleep
+        self._max_restarts = max_restarts
+
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._loaded = None
+        self._stats = {
+            "refreshes": 0,
+            "failures": 0,
+            "last_duration_s": 0.0,
+            "last_bytes": 0,
+        }
+
+    def current(self):
+        """
+            Method that returns the copy to read from, refreshing it first if there is none yet
+
+        :return:        -> The path of the copy
+                        -> The generations of the tables in the copy, as a FrozenTableGenerations
+        """
+        mtime = self._mtime()
+
+        if mtime is None:
+            self.refresh()
+            mtime = self._mtime()
+        elif time.time() - mtime > self._max_staleness:
+            self._refresh_in_background()
+
+        loaded = self._loaded
+        if loaded is None or loaded[0] != mtime:
+            con = connect_read_only(self._path)
+            try:
+                frozen = _read_snapshot_generations(con)
+            finally:
+                con.close()
+            loaded = (mtime, frozen)
+            self._loaded = loaded
+
+        return self._path, loaded[1]
+
+    def _mtime(self):
+        try:
+            return os.stat(self._path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self.refresh, name="read-snapshot", daemon=True).start()
+
+    def refresh(self):
+        """
+            Method that takes a new copy of the database and puts it in place of the current one
+        """
+        with self._lock:
+            self._refreshing = True
+
+        start = time.perf_counter()
+        temporary = self._path + "." + str(os.getpid()) + "-" + str(threading.get_ident()) + ".tmp"
+
+        try:
+            # Read before the copy starts: a write landing during the copy can only make
+            # the copy look older than it is, never fresher
+            frozen = self._generations.freeze()
+
+            target = sql.connect(temporary)
+            try:
+                self._copy(target)
+                _write_snapshot_generations(target, frozen)
+            finally:
+                target.close()
+
+            size = os.path.getsize(temporary)
+            os.replace(temporary, self._path)
+
+            with self._lock:
+                self._stats["refreshes"] += 1
+                self._stats["last_duration_s"] = time.perf_counter() - start
+                self._stats["last_bytes"] = size
+        except Exception:
+            logger.exception("Could not refresh the read snapshot of %s", self._db_path)
+            with self._lock:
+                self._stats["failures"] += 1
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _copy(self, target):
+        remaining_before = [None]
+        restarts = [0]
+
+        def progress(status, remaining, total):
+            if remaining_before[0] is not None and remaining > remaining_before[0]:
+                restarts[0] += 1
+                if restarts[0] > self._max_restarts:
+                    raise RuntimeError("The copy started over " + str(restarts[0]) + " times")
+            remaining_before[0] = remaining
+
+            # Let the writers in between two steps (the writer thread commits them itself)
+            if self._backup is None:
+                time.sleep(self._step_sleep)
+
+        if self._backup is not None:
+            self._backup(target, self._pages_per_step, self._step_sleep, progress)
+            return
+
+        source = sql.connect(self._db_path)
+        try:
+            source.backup(target, pages=self._pages_per_step, progress=progress, sleep=self._step_sleep)
+        finally:
+            source.close()
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "age_s": <age_of_the_current_copy> (None if there is none),
+                        "refreshes": <no_of_copies_taken_by_this_process>,
+                        "failures": <no_of_copies_that_failed>,
+                        "last_duration_s": <time_the_last_copy_took>,
+                        "last_bytes": <size_of_the_last_copy>
+                    }
+        """
+        mtime = self._mtime()
+        with self._lock:
+            stats = dict(self._stats)
+        stats["age_s"] = time.time() - mtime if mtime is not None else None
+        return stats
+
+
+def _write_snapshot_generations(con, frozen):
+    con.execute("CREATE TABLE snapshot_generations (name TEXT PRIMARY KEY, value)")
+    con.execute("INSERT INTO snapshot_generations VALUES ('@epoch', ?)", (frozen.epoch,))
+    con.executemany("INSERT INTO snapshot_generations VALUES (?, ?)", list(frozen.counters.items()))
+    con.commit()
+
+
+def _read_snapshot_generations(con):
+    values = dict(con.execute("SELECT name, value FROM snapshot_generations").fetchall())
+    return FrozenTableGenerations("s" + str(values.pop("@epoch")), values)
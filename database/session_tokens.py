@@ -0,0 +1,86 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import time
+
+
+class SessionTokenSigner:
+    """
+        Stateless session tokens.
+
+        A token carries the uid it was issued for, when it was issued and when it expires, and
+    is signed with HMAC-SHA256, so checking it only needs the secret key - no database access.
+    Tokens have the format:
+
+            v1.<uid>.<issued_at_ms>.<expires_at>.<nonce>.<signature>
+    """
+
+    VERSION = "v1"
+
+    def __init__(self, secret_key):
+        """
+        :param secret_key:      The key the tokens are signed with (str or bytes). Every worker
+                                validating tokens needs the same key
+        """
+        if isinstance(secret_key, str):
+            secret_key = secret_key.encode("utf-8")
+
+        self._key = secret_key
+
+    def _sign(self, payload):
+        digest = hmac.new(self._key, payload.encode("ascii"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+    def issue(self, uid, ttl):
+        """
+            Method that creates a new token
+
+        :param uid:         The id of the user the token is for
+        :param ttl:         How long the token is valid for, in seconds
+        :return:            The token, as a string
+        """
+        now = time.time()
+        payload = ".".join([self.VERSION,
+                            str(int(uid)),
+                            str(int(now * 1000)),
+                            str(int(now + ttl)),
+                            secrets.token_hex(8)])
+
+        return payload + "." + self._sign(payload)
+
+    def verify(self, token):
+        """
+            Method that checks the signature and the expiry of a token
+
+        :param token:       The token
+        :return:            -> (uid, issued_at_ms) if the token is authentic and not expired
+                            -> None otherwise
+        """
+        payload, _, signature = token.rpartition(".")
+        parts = payload.split(".")
+
+        if len(parts) != 5 or parts[0] != self.VERSION:
+            return None
+
+        if not hmac.compare_digest(self._sign(payload), signature):
+            return None
+
+        try:
+            uid, issued_at, expires_at = int(parts[1]), int(parts[2]), int(parts[3])
+        except ValueError:
+            return None
+
+        if time.time() >= expires_at:
+            return None
+
+        return uid, issued_at
+
+    @staticmethod
+    def is_signed_token(token):
+        """
+        :param token:       A session token
+        :return:            True - if the token has the format of a signed token
+                            False - otherwise (e.g. a random token stored in the logged_in table)
+        """
+        return token.startswith(SessionTokenSigner.VERSION + ".")
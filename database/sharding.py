@@ -0,0 +1,634 @@
+"""
+    Multi-tenant storage: every organization (tenant) has its own database file (shard), holding its
+    users, sessions and logs, with its own writer thread. A routing table, keyed by the email hash of
+    the users, tells which shard a user lives in.
+
+    Usage (from the repository root), to split a database into one shard per email domain:
+
+        python -m database.sharding split database/SMU-logs.db shards/
+
+    or per organization, from a CSV file of "<email>,<organization>" lines:
+
+        python -m database.sharding split database/SMU-logs.db shards/ --tenants organizations.csv
+
+    and to add the (empty) shard of a new organization, with the courses of an existing one:
+
+        python -m database.sharding add-tenant shards/ new-organization
+"""
+import argparse
+import csv
+import hashlib
+import os
+import re
+import sqlite3 as sql
+import threading
+from database import database_creator
+from database.database_handler import DatabaseHandler
+from database.sqlite_backend import SQLiteBackend
+from database.query_profiler import QueryProfiler
+from database.password_hasher import PasswordHasher
+from database.identity import Identity
+from database.log_partitions import partition_paths
+
+# The routing table, in the directory of the shards
+ROUTING_DATABASE = "routing.db"
+
+# Tenant names end up in file names and in login tokens (before a ':')
+_TENANT_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+# The tables copied to every shard, and the ones whose rows go to the shard of their user (by column)
+_SHARED_TABLES = ["course_categories", "courses"]
+_USER_TABLES = [("users", "id"), ("logged_in", "uid"), ("revoked_sessions", "uid"), ("working", "uid"),
+                ("logs", "uid"), ("logs_daily", "uid"), ("rights", "uid")]
+
+
+def _hash(email):
+    return hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+
+def _check_tenant_name(name):
+    """
+    :raises:    ValueError if a tenant can't have that name: it isn't a file name, or is that of the routing database
+    """
+    if not isinstance(name, str) or not _TENANT_NAME.fullmatch(name) or name + ".db" == ROUTING_DATABASE:
+        raise ValueError("Invalid tenant name: " + repr(name))
+
+
+def routing_table_statements():
+    """
+    :return:    The statements creating the routing tables. They can safely be run again
+    """
+    return ["CREATE TABLE IF NOT EXISTS "
+            "tenants ("
+                "name TEXT PRIMARY KEY, "
+                "path TEXT NOT NULL"
+            ");",
+            "CREATE TABLE IF NOT EXISTS "
+            "routes ("
+                "email_hash CHAR(64) PRIMARY KEY, "
+                "tenant TEXT NOT NULL, "
+                "FOREIGN KEY(tenant) REFERENCES tenants(name)"
+            ");"]
+
+
+class ShardRouter:
+    """
+        The routing table: the shard of every tenant, and the tenant of every user, by the hash of
+    their email. Routes are cached once read; a route missing from the cache is looked up again, so
+    that users added by other processes are found.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    The path of the routing database
+        """
+        self._path = path
+        self._base_dir = os.path.dirname(os.path.abspath(path))
+        self._lock = threading.Lock()
+
+        con = sql.connect(path)
+        try:
+            for query in routing_table_statements():
+                con.execute(query)
+            con.commit()
+            self._routes = dict(con.execute("SELECT email_hash, tenant FROM routes;").fetchall())
+        finally:
+            con.close()
+
+    def tenants(self):
+        """
+        :return:    The shards, as a dictionary of the format {<tenant>: <absolute_path>}
+        """
+        con = sql.connect(self._path)
+        try:
+            rows = con.execute("SELECT name, path FROM tenants ORDER BY name;").fetchall()
+        finally:
+            con.close()
+
+        return {name: os.path.normpath(os.path.join(self._base_dir, path)) for name, path in rows}
+
+    def tenant_of(self, email_hash):
+        """
+        :param email_hash:  The hash of the email of a user
+        :return:            The tenant of the user, None if there's no route for it
+        """
+        with self._lock:
+            tenant = self._routes.get(email_hash)
+        if tenant is not None:
+            return tenant
+
+        con = sql.connect(self._path)
+        try:
+            row = con.execute("SELECT tenant FROM routes WHERE email_hash=?;", (email_hash,)).fetchone()
+        finally:
+            con.close()
+
+        if row is None:
+            return None
+
+        with self._lock:
+            self._routes[email_hash] = row[0]
+        return row[0]
+
+    def add_tenant(self, name, path):
+        """
+        :param name:    The name of the tenant
+        :param path:    The path of its shard
+        """
+        _check_tenant_name(name)
+
+        con = sql.connect(self._path)
+        try:
+            con.execute("INSERT INTO tenants (name, path) VALUES (?, ?);",
+                        (name, os.path.relpath(os.path.abspath(path), self._base_dir)))
+            con.commit()
+        finally:
+            con.close()
+
+    def assign(self, routes):
+        """
+        :param routes:  The users to route, as a list of (email_hash, tenant) tuples
+        """
+        con = sql.connect(self._path)
+        try:
+            con.executemany("INSERT OR REPLACE INTO routes (email_hash, tenant) VALUES (?, ?);", routes)
+            con.commit()
+        finally:
+            con.close()
+
+        with self._lock:
+            self._routes.update(routes)
+
+
+def _merge_stats(stats, maximum=()):
+    """
+    :param stats:       Statistics dictionaries of the same format, one per shard (None for none)
+    :param maximum:     The keys whose maximum is kept, instead of the sum
+    :return:            Their sum, key by key (None if every one is None)
+    """
+    stats = [shard for shard in stats if shard is not None]
+    if not stats:
+        return None
+
+    merged = dict()
+    for key in stats[0]:
+        values = [shard[key] for shard in stats if shard.get(key) is not None]
+        if not values:
+            merged[key] = None
+        elif isinstance(values[0], dict):
+            merged[key] = _merge_stats(values, maximum)
+        else:
+            merged[key] = max(values) if key in maximum else sum(values)
+    return merged
+
+
+class ShardedHandler:
+    """
+        A DatabaseHandler per tenant, behind the interface of a single one.
+
+        Every call about a user goes to the shard of that user. Calls about two users (e.g. an admin
+    asking for the history of a user) go to the shard of the second one, where an asker from another
+    tenant is unknown: admins only have rights over the users of their organization. Login tokens are
+    prefixed with the tenant they were issued by. The reads over every user (logs, working users,
+    leaderboard) merge those of every shard; the courses are the same in every shard (see split).
+
+        The shards share the query profiler and the password hashing processes. Writes to different
+    shards are committed by different writer threads, on different files, so they don't wait for
+    each other. The shards are the ones in the routing table when the handler is created.
+    """
+
+    def __init__(self, shard_dir, default_tenant=None, cache_size=256, scan_threshold=1000, session_secret=None,
+                 revocation_refresh=60, write_batch=64, shared_generations=False, password_processes=0,
+                 snapshot_staleness=None, journal_dir=None):
+        """
+        :param shard_dir:           The directory of the routing database (see ROUTING_DATABASE)
+        :param default_tenant:      The tenant users signing up without a route are added to (None: they're refused)
+        :param journal_dir:         If given, every shard journals its work session events to <tenant>.jsonl
+                                    in this directory (see EventJournal)
+        :param (others):            The options of the DatabaseHandler of every shard
+        """
+        self._router = ShardRouter(os.path.join(shard_dir, ROUTING_DATABASE))
+        self._default_tenant = default_tenant
+
+        self.profiler = QueryProfiler(scan_threshold)
+        self._password_hasher = PasswordHasher(password_processes)
+
+        self._shards = dict()
+        for tenant, path in self._router.tenants().items():
+            self._shards[tenant] = DatabaseHandler(path, cache_size, session_secret=session_secret,
+                                                   revocation_refresh=revocation_refresh,
+                                                   backend=SQLiteBackend(path, write_batch=write_batch,
+                                                                         shared_generations=shared_generations,
+                                                                         snapshot_staleness=snapshot_staleness,
+                                                                         profiler=self.profiler),
+                                                   password_hasher=self._password_hasher,
+                                                   journal_path=os.path.join(journal_dir, tenant + ".jsonl")
+                                                   if journal_dir is not None else None)
+
+        if not self._shards:
+            raise ValueError("No tenant in " + os.path.join(shard_dir, ROUTING_DATABASE))
+
+        if default_tenant is not None and default_tenant not in self._shards:
+            raise ValueError("Unknown default tenant: " + default_tenant)
+
+        # Users without a route are looked up there, and reported as unknown as usual
+        self._fallback = default_tenant if default_tenant is not None else sorted(self._shards)[0]
+
+    def shards(self):
+        """
+        :return:    The DatabaseHandler of every tenant, as a dictionary of the format {<tenant>: <handler>}
+        """
+        return dict(self._shards)
+
+    def _tenant_of(self, user):
+        """
+        :param user:    The email hash of a user, or their Identity
+        :return:        The tenant of the user, None if there's no route for it
+        """
+        email_hash = user.email_hash if isinstance(user, Identity) else user
+        if not isinstance(email_hash, str):
+            return None
+        return self._router.tenant_of(email_hash)
+
+    def _shard(self, user):
+        return self._shards.get(self._tenant_of(user), self._shards[self._fallback])
+
+    def _asker(self, asker, user):
+        """
+        :return:    The asker, or None if it's from another tenant than the user
+        """
+        return asker if self._tenant_of(asker) == self._tenant_of(user) else None
+
+    def begin_request_scope(self):
+        for shard in self._shards.values():
+            shard.begin_request_scope()
+
+    def end_request_scope(self):
+        for shard in self._shards.values():
+            shard.end_request_scope()
+
+    def resolve_identity(self, user):
+        return self._shard(user).resolve_identity(user)
+
+    def is_admin(self, email_hash):
+        return self._shard(email_hash).is_admin(email_hash)
+
+    def start_work(self, email_hash, course):
+        return self._shard(email_hash).start_work(email_hash, course)
+
+    def stop_work(self, email_hash, time):
+        return self._shard(email_hash).stop_work(email_hash, time)
+
+    def update_time(self, id_user, time):
+        return self._shard(id_user).update_time(id_user, time)
+
+    def user_is_working(self, id_user):
+        return self._shard(id_user).user_is_working(id_user)
+
+    def logout_user(self, email_hash):
+        return self._shard(email_hash).logout_user(email_hash)
+
+    def validate_user(self, email_hash, password):
+        return self._shard(email_hash).validate_user(email_hash, password)
+
+    def update_user_password(self, id_user, old_password, new_password):
+        return self._shard(id_user).update_user_password(id_user, old_password, new_password)
+
+    def get_history_for_user(self, email_for_request, email_for_user, since=None, until=None):
+        return self._shard(email_for_user).get_history_for_user(self._asker(email_for_request, email_for_user),
+                                                                email_for_user, since, until)
+
+    def get_stats_for_user(self, email_for_request, email_for_user):
+        return self._shard(email_for_user).get_stats_for_user(self._asker(email_for_request, email_for_user),
+                                                              email_for_user)
+
+    def get_user_details(self, id_asker, id_user):
+        return self._shard(id_user).get_user_details(self._asker(id_asker, id_user), id_user)
+
+    def update_user_name(self, id_updater, id_user, new_name):
+        return self._shard(id_user).update_user_name(self._asker(id_updater, id_user), id_user, new_name)
+
+    def update_user_password_as_admin(self, id_admin, id_user, new_password):
+        return self._shard(id_user).update_user_password_as_admin(self._asker(id_admin, id_user), id_user,
+                                                                  new_password)
+
+    def signup(self, email, name, password, admin):
+        """
+            Method that adds a new user to the tenant it is routed to, or to the default one
+        (see DatabaseHandler.signup)
+        """
+        email_hash = _hash(email) if isinstance(email, str) else None
+        tenant = self._tenant_of(email_hash) or self._default_tenant
+        if tenant is None:
+            return False, "Unknown organization"
+
+        status, message = self._shards[tenant].signup(email, name, password, admin)
+        if status:
+            self._router.assign([(email_hash, tenant)])
+        return status, message
+
+    def add_user(self, id_adder, email, full_name, admin):
+        """
+            Method that adds a user to the tenant of the admin adding it (see DatabaseHandler.add_user)
+        """
+        tenant = self._tenant_of(id_adder) or self._fallback
+        email_hash = _hash(email) if isinstance(email, str) else None
+
+        if self._tenant_of(email_hash) not in (None, tenant):
+            return {"success": False, "message": "Email already in use"}
+
+        result = self._shards[tenant].add_user(id_adder, email, full_name, admin)
+        if result["success"]:
+            self._router.assign([(email_hash, tenant)])
+        return result
+
+    def verify_user(self, email, password):
+        """
+            Method that authenticates a user on its shard (see DatabaseHandler.verify_user).
+        The token is prefixed with the tenant
+        """
+        if not isinstance(email, str):
+            return self._shards[self._fallback].verify_user(email, password)
+
+        tenant = self._tenant_of(_hash(email)) or self._fallback
+        result = self._shards[tenant].verify_user(email, password)
+
+        if result["success"]:
+            result = dict(result, token=tenant + ":" + result["token"])
+        return result
+
+    def is_token_still_valid(self, token):
+        tenant, separator, token = str(token).partition(":")
+
+        if not separator or tenant not in self._shards:
+            return {
+                "success": True,
+                "valid": False
+            }
+
+        return self._shards[tenant].is_token_still_valid(token)
+
+    def get_courses_list(self):
+        return self._shards[self._fallback].get_courses_list()
+
+    def get_courses_list_with_details(self):
+        return self._shards[self._fallback].get_courses_list_with_details()
+
+    def _merged_users(self, results):
+        if any(result is None for result in results):
+            return None
+
+        merged = {
+            "users": list()
+        }
+        for result in results:
+            for user in result["users"]:
+                merged["users"].append(dict(user, id=len(merged["users"])))
+        return merged
+
+    def get_working_users(self):
+        return self._merged_users([shard.get_working_users() for tenant, shard in sorted(self._shards.items())])
+
+    def get_logs(self):
+        return self._merged_users([shard.get_logs() for tenant, shard in sorted(self._shards.items())])
+
+    def parse_watermark(self, since):
+        """
+        :param since:   A watermark returned by get_log_changes (None for none)
+        :return:        The watermark of every shard it holds, as a dictionary of the format {<tenant>: <watermark>}
+        :raises:        ValueError if it isn't a watermark
+        """
+        watermarks = dict()
+        for watermark in (since.split(",") if since else []):
+            tenant, watermark = watermark.split(":", 1)
+            self._shards[self._fallback].parse_watermark(watermark)
+            watermarks[tenant] = watermark
+        return watermarks
+
+    def get_log_changes(self, since=None, limit=1000):
+        """
+            The logs of every shard written after the watermark (see DatabaseHandler.get_log_changes). The
+        watermark holds the one of every shard, as "<tenant>:<watermark>,...", and the log ids are prefixed
+        with their tenant, like the login tokens.
+        """
+        try:
+            watermarks = self.parse_watermark(since)
+        except ValueError:
+            return {
+                "success": False, "message": "Invalid watermark"
+            }
+
+        merged = {
+            "success": True,
+            "users": list(),
+            "more": False
+        }
+        for tenant, shard in sorted(self._shards.items()):
+            remaining = limit - len(merged["users"])
+            if remaining <= 0:
+                merged["more"] = True
+                break
+
+            result = shard.get_log_changes(watermarks.get(tenant), remaining)
+            if not result["success"]:
+                return result
+
+            merged["users"] += [dict(log, id=tenant + ":" + str(log["id"])) for log in result["users"]]
+            merged["more"] = merged["more"] or result["more"]
+            watermarks[tenant] = result["watermark"]
+
+        merged["watermark"] = ",".join(tenant + ":" + str(watermark) for tenant, watermark in sorted(watermarks.items())
+                                       if watermark)
+        return merged
+
+    def get_leaderboard(self, since=None, until=None):
+        totals = [shard.get_leaderboard_totals(since, until) for shard in self._shards.values()]
+
+        if any(users is None for users in totals):
+            return {
+                "success": False,
+                "message": "Server error"
+            }
+
+        users = sorted((user for users in totals for user in users), key=lambda user: -1.0 * user[3])
+        return self._shards[self._fallback].format_leaderboard(users)
+
+    def get_version_token(self, *tables, from_snapshot=False):
+        return ".".join(shard.get_version_token(*tables, from_snapshot=from_snapshot)
+                        for tenant, shard in sorted(self._shards.items()))
+
+    def get_cache_stats(self):
+        return _merge_stats([shard.get_cache_stats() for shard in self._shards.values()])
+
+    def get_single_flight_stats(self):
+        return _merge_stats([shard.get_single_flight_stats() for shard in self._shards.values()])
+
+    def get_write_stats(self):
+        return _merge_stats([shard.get_write_stats() for shard in self._shards.values()],
+                            maximum=("largest_batch",))
+
+    def get_snapshot_stats(self):
+        return _merge_stats([shard.get_snapshot_stats() for shard in self._shards.values()],
+                            maximum=("age_s", "last_duration_s"))
+
+    def get_journal_stats(self):
+        return _merge_stats([shard.get_journal_stats() for shard in self._shards.values()],
+                            maximum=("largest_batch",))
+
+    def warm_up(self):
+        for shard in self._shards.values():
+            shard.warm_up()
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+
+
+def _columns(con, table):
+    return [row[1] for row in con.execute("PRAGMA main.table_info(" + table + ");")]
+
+
+def _create_shard(path, source, uids, partitions=()):
+    """
+        Function that creates a shard, with the courses of the source database and the rows of the given users
+
+    :param path:        The path of the new shard
+    :param source:      The path of the database to copy from
+    :param uids:        The ids of the users to copy
+    :param partitions:  The paths of the archive partitions of the source, whose logs are copied too
+    """
+    if os.path.exists(path):
+        raise ValueError(path + " already exists")
+
+    database_creator.create_all(path)
+
+    con = sql.connect(path)
+    try:
+        con.execute("ATTACH DATABASE ? AS source;", (source,))
+        con.execute("CREATE TEMP TABLE tenant_users (id INTEGER PRIMARY KEY);")
+        con.executemany("INSERT INTO tenant_users (id) VALUES (?);", [(uid,) for uid in uids])
+
+        def copy(table, schema, conditions):
+            columns = ", ".join(_columns(con, table))
+            try:
+                con.execute("INSERT INTO main." + table + " (" + columns + ") "
+                            "SELECT " + columns + " FROM " + schema + "." + table + conditions + ";")
+            except sql.OperationalError as e:
+                # Not created in the source database
+                if "no such table" not in str(e):
+                    raise
+
+        for table in _SHARED_TABLES:
+            copy(table, "source", "")
+        for table, column in _USER_TABLES:
+            copy(table, "source", " WHERE " + column + " IN (SELECT id FROM temp.tenant_users)")
+
+        con.commit()
+        con.execute("DETACH DATABASE source;")
+
+        # The logs of the archive partitions come back to the logs table, to be archived per shard
+        for partition in partitions:
+            con.execute("ATTACH DATABASE ? AS partition;", (partition,))
+            copy("logs", "partition", " WHERE uid IN (SELECT id FROM temp.tenant_users)")
+            con.commit()
+            con.execute("DETACH DATABASE partition;")
+
+        con.commit()
+    finally:
+        con.close()
+
+
+def email_domain(email):
+    """
+    :return:    The tenant of a user by default: the domain of their email
+    """
+    return email.rpartition("@")[2].lower() or "default"
+
+
+def split(db_path, shard_dir, tenant_of=email_domain):
+    """
+        Function that splits a database into one shard per tenant, and routes every user to its shard.
+        The courses are copied to every shard. The source database isn't changed.
+
+    :param db_path:     The database to split
+    :param shard_dir:   The directory the shards and the routing database are written to
+    :param tenant_of:   Gives the tenant of a user, from their email
+    :return:            The number of users of every tenant, as a dictionary of the format {<tenant>: <no_of_users>}
+    :raises:            ValueError if a tenant name isn't valid, before anything is written
+    """
+    con = sql.connect(db_path)
+    try:
+        users = con.execute("SELECT id, email FROM users;").fetchall()
+        partitions = partition_paths(con, os.path.dirname(os.path.abspath(db_path)), None, None)
+    finally:
+        con.close()
+
+    tenants = dict()
+    for uid, email in users:
+        tenants.setdefault(tenant_of(email), []).append((uid, email))
+
+    # Checked before any shard is created: the names are paths in shard_dir
+    for tenant in tenants:
+        _check_tenant_name(tenant)
+
+    os.makedirs(shard_dir, exist_ok=True)
+    router = ShardRouter(os.path.join(shard_dir, ROUTING_DATABASE))
+    for tenant, members in sorted(tenants.items()):
+        path = os.path.join(shard_dir, tenant + ".db")
+        _create_shard(path, db_path, [uid for uid, email in members], partitions)
+        router.add_tenant(tenant, path)
+        router.assign([(_hash(email), tenant) for uid, email in members])
+
+    return {tenant: len(members) for tenant, members in tenants.items()}
+
+
+def add_tenant(shard_dir, tenant):
+    """
+        Function that adds the shard of a new tenant, with no users and the courses of an existing shard
+
+    :param shard_dir:   The directory of the shards and of the routing database
+    :param tenant:      The name of the new tenant
+    """
+    _check_tenant_name(tenant)
+
+    router = ShardRouter(os.path.join(shard_dir, ROUTING_DATABASE))
+    existing = router.tenants()
+    path = os.path.join(shard_dir, tenant + ".db")
+
+    if existing:
+        _create_shard(path, sorted(existing.items())[0][1], [])
+    else:
+        database_creator.create_all(path)
+    router.add_tenant(tenant, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the database into one shard per organization")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    split_parser = commands.add_parser("split", help="Split a database into shards")
+    split_parser.add_argument("db_path")
+    split_parser.add_argument("shard_dir")
+    split_parser.add_argument("--tenants", help="A CSV file of <email>,<organization> lines "
+                                                "(default: the organization of a user is the domain of their email)")
+
+    add_parser = commands.add_parser("add-tenant", help="Add the shard of a new organization")
+    add_parser.add_argument("shard_dir")
+    add_parser.add_argument("tenant")
+    args = parser.parse_args()
+
+    if args.command == "add-tenant":
+        add_tenant(args.shard_dir, args.tenant)
+        print("Added " + args.tenant)
+    else:
+        tenant_of = email_domain
+        if args.tenants:
+            with open(args.tenants, newline="") as f:
+                organizations = {row[0].strip().lower(): row[1].strip() for row in csv.reader(f) if len(row) >= 2}
+
+            def tenant_of(email):
+                return organizations.get(email.lower(), email_domain(email))
+
+        counts = split(args.db_path, args.shard_dir, tenant_of)
+        for tenant, users in sorted(counts.items()):
+            print(tenant + ": " + str(users) + " users")
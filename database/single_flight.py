@@ -0,0 +1,88 @@
+import threading
+
+
+class _Call:
+    """
+        An in-flight computation, shared by everyone asking for the same key
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+        Request coalescing for expensive reads.
+
+        While a computation for a key is running, every other caller asking for the same key
+    waits for it and gets its result, instead of running the same query again in parallel.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+        self._stats = dict()
+
+    def do(self, key, label, fn, *args):
+        """
+            Method that runs fn(*args), unless a call with the same key is already in flight,
+        in which case it waits for that one and returns its result (or raises its exception)
+
+        :param key:         The key identifying identical computations
+        :param label:       The name the call is accounted under in the statistics
+        :param fn:          The function doing the computation
+        :param args:        The arguments for fn
+        :return:            The result of the computation
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+            stats = self._stats.get(label)
+            if stats is None:
+                stats = {"calls": 0, "executions": 0, "shared": 0}
+                self._stats[label] = stats
+
+            stats["calls"] += 1
+            if leader:
+                stats["executions"] += 1
+            else:
+                stats["shared"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        <label>: {
+                            "calls": <no_of_calls>,
+                            "executions": <no_of_computations_actually_run>,
+                            "shared": <no_of_calls_that_reused_an_in_flight_computation>
+                        },
+                        ...
+                    }
+        """
+        with self._lock:
+            return {label: dict(stats) for label, stats in self._stats.items()}
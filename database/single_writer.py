@@ -0,0 +1,312 @@
+import collections
+import logging
+import os
+import queue
+import sqlite3 as sql
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Guards the start of the writer threads. Replaced in forked children, where it could be held forever
+_start_lock = threading.Lock()
+
+
+def _reset_start_lock():
+    global _start_lock
+    _start_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_start_lock)
+
+
+class WriterUnavailable(Exception):
+    """
+        Raised to the callers of SingleWriter.execute when the writer thread is dead, or hasn't
+    committed their write within the timeout (it may still be committed later)
+    """
+    pass
+
+
+class _Write:
+    """
+        A queued write: statements that are committed (or rolled back) together
+    """
+
+    def __init__(self, statements, request, check=None):
+        self.statements = statements
+        self.request = request
+        self.check = check
+        self.rowcounts = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class _Backup:
+    """
+        A queued backup: a copy of the database, made by the writer thread from its own connection
+    """
+
+    def __init__(self, target, pages, sleep, progress):
+        self.target = target
+        self.pages = pages
+        self.sleep = sleep
+        self.progress = progress
+        self.done = threading.Event()
+        self.error = None
+
+
+class SingleWriter:
+    """
+        Serializes every write to a database through one thread, with group commit.
+
+        Callers queue their writes and wait. The writer thread takes everything that is queued
+    (up to max_batch writes), applies each write inside its own savepoint and commits them all at
+    once, so concurrent writers never fight over the SQLite lock and pay for one commit between them.
+    A write that fails is rolled back alone, and its error is raised in the caller that queued it.
+
+        The thread is started on the first write of each process, so a writer created before a
+    fork (e.g. by a preloading prefork server) gets a thread and a connection of its own in every worker.
+    """
+
+    def __init__(self, db_path, profiler, on_commit=None, max_batch=64, busy_timeout=5.0, write_timeout=60.0):
+        """
+        :param db_path:         The path of the SQLite database file
+        :param profiler:        The QueryProfiler the statements are accounted with
+        :param on_commit:       Called by the writer thread with the set of tables a batch wrote to,
+                                after it is committed and before the callers are woken up
+        :param max_batch:       The maximum number of writes committed together
+        :param busy_timeout:    How long to wait for locks held by other processes, in seconds
+        :param write_timeout:   How long a caller waits for its write to be committed before giving up, in seconds
+        """
+        self._db_path = db_path
+        self._profiler = profiler
+        self._on_commit = on_commit
+        self._max_batch = max_batch
+        self._busy_timeout = busy_timeout
+        self._write_timeout = write_timeout
+
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "batches": 0,
+            "writes": 0,
+            "failed": 0,
+            "largest_batch": 0
+        }
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+
+        with _start_lock:
+            if self._pid != os.getpid():
+                self._lock = threading.Lock()
+                self._stats = dict.fromkeys(self._stats, 0)
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                                name="sqlite-writer", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def execute(self, statements, check=None):
+        """
+            Method that queues a write and waits until it is committed
+
+        :param statements:      A list of (query, args, table) tuples, where table is the name of the
+                                table the query writes to (None if it doesn't invalidate any cached read)
+        :param check:           Called by the writer thread with the number of rows changed by each statement,
+                                before they are committed. If it raises, the write is rolled back and the
+                                exception raised here
+        :return:                The number of rows changed by each statement, as counted by SQLite
+        :raises:                The exception raised by the failing statement, or by the commit.
+                                WriterUnavailable if the writer thread died or is stuck
+        """
+        self._ensure_started()
+
+        write = _Write(statements, self._profiler.current_request(), check)
+        self._queue.put(write)
+        self._wait(write, self._write_timeout)
+
+        if write.error is not None:
+            raise write.error
+
+        return write.rowcounts
+
+    def _wait(self, job, timeout=None):
+        """
+            Method that waits until a job is done (for at most timeout seconds, if given), checking every
+        second that the writer thread is alive
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        thread = self._thread
+
+        while not job.done.wait(1.0 if deadline is None else min(1.0, max(deadline - time.monotonic(), 0))):
+            if not thread.is_alive():
+                raise WriterUnavailable("The writer thread of " + self._db_path + " is not running")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise WriterUnavailable("No commit on " + self._db_path + " within " + str(timeout) + " s")
+
+    def backup(self, target, pages, sleep, progress=None):
+        """
+            Method that copies the database into another one, with SQLite's online backup API. The copy
+        is made by the writer thread, from its own connection, and waited for.
+
+            Copying from the connection every write goes through means a write made during the
+        copy is applied to the copy as well, instead of making it start over. Each step copies a
+        few pages, and the writes queued in the meantime are committed between two steps, so they
+        are never held up for longer than one step.
+
+        :param target:      A connection to the database to copy into
+        :param pages:       The number of pages copied per step
+        :param sleep:       How long to wait before retrying a step that hit a lock of another process, in seconds
+        :param progress:    Called by the writer thread after each step, as progress(status, remaining, total).
+                            It shouldn't sleep: the writes are held up while it runs
+        :raises:            The exception raised by the copy, or by progress
+        """
+        self._ensure_started()
+
+        backup = _Backup(target, pages, sleep, progress)
+        self._queue.put(backup)
+        self._wait(backup)
+
+        if backup.error is not None:
+            raise backup.error
+
+    def close(self):
+        """
+            Method that stops the writer thread, once every write queued so far is committed
+        """
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+            self._pid = None
+
+    def stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "batches": <no_of_commits>,
+                        "writes": <no_of_writes_committed_or_failed>,
+                        "failed": <no_of_writes_that_failed>,
+                        "largest_batch": <max_no_of_writes_committed_together>
+                    }
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _run(self, jobs):
+        # Only ever used by this thread (backups included). Transactions are managed explicitly, so that
+        # every write gets its own savepoint
+        con = sql.connect(self._db_path, timeout=self._busy_timeout, isolation_level=None)
+
+        # The jobs taken from the queue but not run yet, in their order
+        deferred = collections.deque()
+
+        while True:
+            job = deferred.popleft() if deferred else jobs.get()
+            if job is None:
+                break
+
+            if isinstance(job, _Backup):
+                self._backup(con, job, jobs, deferred)
+            else:
+                self._commit(con, self._batch(job, jobs, deferred))
+
+        con.close()
+
+    def _batch(self, write, jobs, deferred):
+        """
+            Method that gathers the writes queued after a write (up to max_batch of them), stopping at the
+        first job that isn't a write, which is put back in front of the deferred ones
+        """
+        batch = [write]
+        while len(batch) < self._max_batch:
+            try:
+                job = deferred.popleft() if deferred else jobs.get_nowait()
+            except queue.Empty:
+                break
+            if not isinstance(job, _Write):
+                deferred.appendleft(job)
+                break
+            batch.append(job)
+
+        return batch
+
+    def _backup(self, con, backup, jobs, deferred):
+        def progress(status, remaining, total):
+            if backup.progress is not None:
+                backup.progress(status, remaining, total)
+
+            # Once the last step is done, writes wouldn't make it into the copy anymore. The writes
+            # queued behind another job wait for it
+            if remaining == 0 or deferred:
+                return
+
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(job, _Write):
+                self._commit(con, self._batch(job, jobs, deferred))
+            else:
+                deferred.append(job)
+
+        try:
+            con.backup(backup.target, pages=backup.pages, progress=progress, sleep=backup.sleep)
+        except Exception as e:
+            backup.error = e
+        finally:
+            backup.done.set()
+
+    def _commit(self, con, batch):
+        tables = set()
+
+        try:
+            con.execute("BEGIN IMMEDIATE")
+
+            for write in batch:
+                con.execute("SAVEPOINT write")
+                try:
+                    for query, args, table in write.statements:
+                        with self._profiler.profile(con, query, args, write.request):
+                            write.rowcounts.append(con.execute(query, args).rowcount)
+                    if write.check is not None:
+                        write.check(write.rowcounts)
+                    con.execute("RELEASE write")
+                except Exception as e:
+                    con.execute("ROLLBACK TO write")
+                    con.execute("RELEASE write")
+                    write.error = e
+
+            con.execute("COMMIT")
+        except Exception as e:
+            try:
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+            except sql.Error:
+                pass
+            for write in batch:
+                if write.error is None:
+                    write.error = e
+
+        for write in batch:
+            if write.error is None:
+                tables.update(table for _, _, table in write.statements if table is not None)
+
+        if tables and self._on_commit is not None:
+            try:
+                self._on_commit(tables)
+            except Exception:
+                logger.exception("Commit callback failed for tables: %s", sorted(tables))
+
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["writes"] += len(batch)
+            self._stats["failed"] += sum(1 for write in batch if write.error is not None)
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+
+        for write in batch:
+            write.done.set()
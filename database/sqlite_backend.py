@@ -0,0 +1,548 @@
+import os
+import sqlite3 as sql
+import threading
+import time
+from contextlib import contextmanager
+from database.storage_backend import StorageBackend, ConstraintError
+from database.timestamps import to_epoch
+from database.table_generations import TableGenerations, SharedTableGenerations
+from database.query_profiler import QueryProfiler
+from database.single_writer import SingleWriter
+from database.read_snapshot import ReadSnapshot, connect_read_only
+from database.log_partitions import LOG_COLUMNS, partition_paths, attach_limit, attach_partitions, \
+    detach_partitions
+from database.log_retention import DAY_OF_STARTED_AT
+
+
+def _epoch_now():
+    return int(time.time())
+
+
+def _conditions(where):
+    """
+    :param where:   The conditions, as a dictionary of the format {<column>: <value>}
+    :return:        The WHERE clause matching them (an empty string if there's none), and its arguments
+    """
+    if not where:
+        return "", []
+
+    return " WHERE " + " AND ".join(column + "=?" for column in where), list(where.values())
+
+
+class SQLiteBackend(StorageBackend):
+    """
+        The storage of the DatabaseHandler in a SQLite database file.
+
+        Writes are committed by a single writer thread (see SingleWriter), together with the
+    writes of other threads. Reads open their own connection. The analytics reads (logs,
+    history, stats, leaderboard) also read the archive partitions (see LogArchiver) and the
+    rolled up logs (see LogRetention), and can be served from a read snapshot (see ReadSnapshot).
+    """
+
+    def __init__(self, db_path, scan_threshold=1000, write_batch=64, shared_generations=False,
+                 snapshot_staleness=None, profiler=None):
+        """
+        :param db_path:             The path of the SQLite database file
+        :param scan_threshold:      Queries doing full scans of tables bigger than this get flagged
+                                    by the profiler (None disables the check)
+        :param write_batch:         The maximum number of writes the writer thread commits together
+        :param shared_generations:  If True, the table generations are kept in the database (by triggers),
+                                    so that they see the writes of other processes
+        :param snapshot_staleness:  If given, the analytics reads can be served from a copy of the database
+                                    refreshed once it is older than this many seconds
+        :param profiler:            The QueryProfiler to account the queries to, if shared with other backends
+                                    (scan_threshold is then ignored)
+        """
+        self.path = db_path
+        self.profiler = profiler if profiler is not None else QueryProfiler(scan_threshold)
+        self._pending_writes = threading.local()
+        self._writer = SingleWriter(db_path, self.profiler, self._bump_generations, write_batch)
+
+        # Nothing is written here, so that the writer thread is only started by the first write
+        self._check_schema(shared_generations)
+
+        if shared_generations:
+            self._generations = SharedTableGenerations(db_path)
+        else:
+            self._generations = TableGenerations()
+
+        self._snapshot = None
+        if snapshot_staleness is not None:
+            self._snapshot = ReadSnapshot(db_path, self._generations, snapshot_staleness, backup=self.backup_to)
+
+    def _check_schema(self, shared_generations):
+        """
+            Method that makes sure the tables added since the database was created exist. They are created
+        by database_creator, and added to older databases by database_migrator
+
+        :raises:    RuntimeError if some are missing
+        """
+        required = {"revoked_sessions", "log_partitions", "retired_log_partitions", "logs_daily"}
+        if shared_generations:
+            required.add("table_versions")
+
+        con = connect_read_only(self.path)
+        try:
+            existing = {name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+        finally:
+            con.close()
+
+        if not required <= existing:
+            raise RuntimeError(self.path + " has no " + ", ".join(sorted(required - existing)) + " table: run "
+                               "the schema migration of database/database_migrator.py on it first")
+
+    def _execute_query(self, query, *args, table=None):
+        """
+            Function that executes a given query, except SELECT queries.
+            The query is committed by the writer thread, together with the writes of other threads.
+
+        :param query:       the query to be executed
+        :param args:        the arguments to be inserted
+        :param table:       the table the query writes to, whose cached reads are invalidated once committed
+        :return:
+        """
+        pending = getattr(self._pending_writes, "statements", None)
+        if pending is not None:
+            pending.append((query, args, table))
+            return
+
+        try:
+            self._writer.execute([(query, args, table)])
+        except sql.IntegrityError as e:
+            raise ConstraintError(str(e)) from e
+
+    @contextmanager
+    def atomic(self):
+        """
+            Context manager that commits the writes made inside it as one transaction:
+        either all of them are applied or none is. They are only sent to the writer thread
+        when the block exits, so their errors are raised there.
+        """
+        self._pending_writes.statements = list()
+        try:
+            yield
+            statements = self._pending_writes.statements
+        finally:
+            self._pending_writes.statements = None
+
+        if statements:
+            try:
+                self._writer.execute(statements)
+            except sql.IntegrityError as e:
+                raise ConstraintError(str(e)) from e
+
+    def _bump_generations(self, tables):
+        for table in tables:
+            self._generations.bump(table)
+
+    def insert(self, table, values, replace=False):
+        query = "INSERT " + ("OR REPLACE " if replace else "") + "INTO " + table + \
+                " (" + ", ".join(values) + ") VALUES (" + ", ".join("?" for _ in values) + ");"
+        self._execute_query(query, *values.values(), table=table)
+
+    def update(self, table, values, where):
+        conditions, args = _conditions(where)
+        query = "UPDATE " + table + " SET " + ", ".join(column + "=?" for column in values) + conditions + ";"
+        self._execute_query(query, *(list(values.values()) + args), table=table)
+
+    def delete(self, table, where):
+        conditions, args = _conditions(where)
+        self._execute_query("DELETE FROM " + table + conditions + ";", *args, table=table)
+
+    def select(self, table, where=None, columns=None):
+        conditions, args = _conditions(where)
+        query = "SELECT " + (", ".join(columns) if columns else "*") + " FROM " + table + conditions + ";"
+        return self._execute_SELECT_from_query(query, *args)
+
+    def _execute_SELECT_from_query(self, query, *args, distinct=True, from_snapshot=False):
+        """
+                Method that executes complex SELECT statements, from a given query
+
+        :param query:       The query to execute
+        :param args:        The arguments to replace the '?' wildcards from the query
+        :param distinct:    True - duplicate rows are dropped (the order of the rows is lost)
+                            False - the rows are returned as they are, in the order of the query
+        :param from_snapshot:   True - the query runs on the read snapshot, if there is one
+        :return:            The result of the query, as a list of tuples
+        """
+        con = self._connect_for_read(from_snapshot)
+        cur = con.cursor()
+        with self.profiler.profile(con, query, args):
+            cur.execute(query, args)
+            results = cur.fetchall()
+            if distinct:
+                results = list(set(results))
+        con.commit()
+        con.close()
+        return results
+
+    def _execute_SELECT_from_logs(self, query, *args, since=None, until=None, distinct=True, from_snapshot=False):
+        """
+                Method that executes a SELECT statement reading the logs, archived ones included.
+            The '{logs}' placeholder of the query is replaced by the logs table, combined with the
+            archive partitions (see LogArchiver) holding logs started in [since, until), which are
+            attached for the query. If there are more of those than can be attached at once, the
+            query is run once per group of partitions and the results are concatenated: the caller
+            has to merge their aggregates, and to sort them again.
+
+        :param query:       The query to execute, with a '{logs}' placeholder
+        :param args:        The arguments to replace the '?' wildcards from the query
+        :param since:       Only partitions that can hold logs started at or after this epoch are read (optional)
+        :param until:       Only partitions that can hold logs started before this epoch are read (optional)
+        :param distinct:    True - duplicate rows are dropped (the order of the rows is lost)
+                            False - the rows are returned as they are, in the order of the query
+        :param from_snapshot:   True - the query runs on the read snapshot, if there is one
+        :return:            The result of the query, as a list of tuples
+        """
+        con = self._connect_for_read(from_snapshot)
+        try:
+            # Listed from the same connection, so that a snapshot reads the partitions it knows of
+            paths = partition_paths(con, os.path.dirname(os.path.abspath(self.path)), since, until)
+
+            if not paths:
+                statement = query.format(logs="logs")
+                with self.profiler.profile(con, statement, args):
+                    results = con.execute(statement, args).fetchall()
+                return list(set(results)) if distinct else results
+
+            # The logs table itself is read along with the first group
+            limit = attach_limit(con)
+            groups = [paths[:limit - 1]] + [paths[i:i + limit] for i in range(limit - 1, len(paths), limit)]
+
+            results = list()
+            for index, group in enumerate(groups):
+                source = attach_partitions(con, group)
+                if index == 0:
+                    source = "(SELECT " + LOG_COLUMNS + " FROM main.logs UNION ALL " + source[1:]
+                try:
+                    statement = query.format(logs=source)
+                    with self.profiler.profile(con, statement, args):
+                        results += con.execute(statement, args).fetchall()
+                finally:
+                    detach_partitions(con)
+
+            return list(set(results)) if distinct else results
+        finally:
+            con.close()
+
+    def _execute_SELECT_from_daily(self, query, *args, from_snapshot=False):
+        """
+                Method that executes a SELECT statement reading the daily totals of the rolled up logs
+            (see LogRetention). Read snapshots taken before the logs_daily table existed have none.
+
+        :param query:       The query to execute
+        :param args:        The arguments to replace the '?' wildcards from the query
+        :param from_snapshot:   True - the query runs on the read snapshot, if there is one
+        :return:            The result of the query, as a list of tuples
+        """
+        try:
+            return self._execute_SELECT_from_query(query, *args, distinct=False, from_snapshot=from_snapshot)
+        except sql.OperationalError as e:
+            if "no such table" in str(e):
+                return []
+            raise
+
+    def _connect_for_read(self, from_snapshot):
+        """
+        :param from_snapshot:   True - to read from the read snapshot, if there is one
+        :return:                A connection to read from, which partitions can be attached to
+        """
+        if from_snapshot and self._snapshot is not None:
+            return connect_read_only(self._snapshot.current()[0])
+        return sql.connect(self.path, uri=True)
+
+    def working_users(self):
+        query = "SELECT u.full_name, u.email, c.name, w.since, w.time FROM " \
+                "working AS w " \
+                "INNER JOIN users AS u ON w.uid=u.id " \
+                "INNER JOIN courses AS c ON w.cid=c.id "
+
+        return self._execute_SELECT_from_query(query)
+
+    def working_course(self, uid):
+        query = "SELECT c.name, w.time, w.since " \
+                "FROM working AS w " \
+                "INNER JOIN courses AS c " \
+                    "ON w.cid = c.id " \
+                "WHERE w.uid=? AND w.working=1"
+
+        results = self._execute_SELECT_from_query(query, uid)
+        return results[0] if results else None
+
+    def courses_with_details(self):
+        query = "SELECT c.name, c.url, c.syllabus, c.about, c.notes, " \
+                    "c.weekly_commitment_low, c.weekly_commitment_high, c.number_weeks, cc.category_name " \
+                "FROM courses AS c " \
+                "INNER JOIN course_categories AS cc ON c.cid = cc.id;"
+
+        return self._execute_SELECT_from_query(query)
+
+    def revocations(self, since):
+        return self._execute_SELECT_from_query("SELECT uid, revoked_at FROM revoked_sessions WHERE revoked_at > ?;",
+                                               since)
+
+    def logs(self, from_snapshot=False):
+        query = "SELECT u.full_name, u.email, c.name, l.duration, l.started_at, l.logged_at " \
+                "FROM {logs} AS l " \
+                "INNER JOIN users AS u ON l.uid=u.id " \
+                "INNER JOIN courses AS c ON l.cid=c.id"
+
+        return self._execute_SELECT_from_logs(query, from_snapshot=from_snapshot)
+
+    def log_changes(self, since, limit):
+        query = "SELECT id, uid, cid, duration, started_at, logged_at FROM logs WHERE id > ? ORDER BY id LIMIT ?;"
+        base_dir = os.path.dirname(os.path.abspath(self.path))
+
+        con = sql.connect(self.path, isolation_level=None)
+        try:
+            # One read transaction, so that logs moved to an archive partition meanwhile are found in
+            # either the logs table or the partition registered along with their removal
+            con.execute("BEGIN")
+
+            # Served by the primary key: only the logs after the watermark are read
+            with self.profiler.profile(con, query, (since, limit)):
+                rows = con.execute(query, (since, limit)).fetchall()
+
+            # The partitions are only read by consumers that fell behind the archival
+            partitions = con.execute("SELECT path FROM log_partitions WHERE last_id > ? ORDER BY id;",
+                                     (since,)).fetchall()
+            for path, in partitions:
+                partition = connect_read_only(os.path.normpath(os.path.join(base_dir, path)))
+                try:
+                    rows += partition.execute(query, (since, limit)).fetchall()
+                finally:
+                    partition.close()
+
+            if partitions:
+                rows = sorted(rows)[:limit]
+
+            users = self._rows_by_id(con, "SELECT id, full_name, email FROM users", {row[1] for row in rows})
+            courses = self._rows_by_id(con, "SELECT id, name FROM courses", {row[2] for row in rows})
+            con.execute("COMMIT")
+        finally:
+            con.close()
+
+        logs = [(id, users[uid][0], users[uid][1], courses[cid][0], duration, to_epoch(started_at),
+                 to_epoch(logged_at))
+                for id, uid, cid, duration, started_at, logged_at in rows if uid in users and cid in courses]
+        return logs, rows[-1][0] if rows else None, len(rows)
+
+    def _rows_by_id(self, con, query, ids):
+        """
+        :param con:     The connection to read from
+        :param query:   A SELECT statement whose first column is the id, without its WHERE clause
+        :param ids:     The ids of the rows to read
+        :return:        The rows, as a dictionary of the format {<id>: <other_columns>}
+        """
+        if not ids:
+            return dict()
+
+        query += " WHERE id IN (" + ", ".join("?" * len(ids)) + ");"
+        args = list(ids)
+        with self.profiler.profile(con, query, args):
+            return {row[0]: row[1:] for row in con.execute(query, args).fetchall()}
+
+    def history(self, uid, since=None, until=None, from_snapshot=False):
+        query = "SELECT c.name, c.url, l.started_at, l.duration, l.logged_at " \
+                "FROM {logs} AS l " \
+                "INNER JOIN courses AS c ON l.cid = c.id " \
+                "WHERE l.uid=? AND l.started_at IS NOT NULL AND l.logged_at IS NOT NULL"
+        args = [uid]
+
+        if since is not None:
+            query += " AND l.started_at >= ?"
+            args.append(since)
+
+        if until is not None:
+            query += " AND l.started_at < ?"
+            args.append(until)
+
+        # Served by the (uid, started_at) index, already in the right order
+        query += " ORDER BY l.started_at, l.id;"
+
+        # The rolled up logs, one entry per course and day
+        daily_query = "SELECT c.name, c.url, d.day, d.duration, NULL, d.sessions " \
+                      "FROM logs_daily AS d " \
+                      "INNER JOIN courses AS c ON d.cid = c.id " \
+                      "WHERE d.uid=?"
+        daily_args = [uid]
+
+        if since is not None:
+            daily_query += " AND d.day >= ?"
+            daily_args.append(since)
+
+        if until is not None:
+            daily_query += " AND d.day < ?"
+            daily_args.append(until)
+
+        return sorted(self._execute_SELECT_from_logs(query, *args, since=since, until=until, distinct=False,
+                                                     from_snapshot=from_snapshot)
+                      + self._execute_SELECT_from_daily(daily_query + ";", *daily_args, from_snapshot=from_snapshot),
+                      key=lambda result: to_epoch(result[2]))
+
+    def total_duration(self, uid, from_snapshot=False):
+        results = self._execute_SELECT_from_logs("SELECT SUM(l.duration) FROM {logs} AS l WHERE l.uid=?;", uid,
+                                                 distinct=False, from_snapshot=from_snapshot)
+        rolled_up = self._execute_SELECT_from_daily("SELECT SUM(d.duration) FROM logs_daily AS d WHERE d.uid=?;",
+                                                    uid, from_snapshot=from_snapshot)
+
+        # One sum per group of partitions read, and the one of the rolled up logs
+        sums = [result[0] for result in results + rolled_up if result[0] is not None]
+
+        return sum(sums) if sums else None
+
+    def leaderboard(self, since=None, until=None, from_snapshot=False):
+        query = "SELECT u.full_name, u.id, u.email, TOTAL(l.duration) AS tot " \
+                "FROM users AS u " \
+                "LEFT OUTER JOIN {logs} AS l ON u.id = l.uid"
+        args = []
+
+        if since is not None:
+            query += " AND l.started_at >= ?"
+            args.append(since)
+
+        if until is not None:
+            query += " AND l.started_at < ?"
+            args.append(until)
+
+        query += " GROUP BY u.id ORDER BY tot DESC;"
+
+        # The rolled up logs, counted when their day starts within the time range
+        daily_query = "SELECT d.uid, TOTAL(d.duration) FROM logs_daily AS d WHERE 1"
+        daily_args = []
+
+        if since is not None:
+            daily_query += " AND d.day >= ?"
+            daily_args.append(since)
+
+        if until is not None:
+            daily_query += " AND d.day < ?"
+            daily_args.append(until)
+
+        daily_query += " GROUP BY d.uid;"
+
+        # One row per user and group of partitions read
+        totals = dict()
+        for user in self._execute_SELECT_from_logs(query, *args, since=since, until=until, distinct=False,
+                                                   from_snapshot=from_snapshot):
+            if user[1] in totals:
+                totals[user[1]] = totals[user[1]][:3] + (totals[user[1]][3] + user[3],)
+            else:
+                totals[user[1]] = user
+
+        for uid, duration in self._execute_SELECT_from_daily(daily_query, *daily_args, from_snapshot=from_snapshot):
+            if uid in totals:
+                totals[uid] = totals[uid][:3] + (totals[uid][3] + duration,)
+
+        return sorted(totals.values(), key=lambda user: -1.0 * user[3])
+
+    def generations(self, from_snapshot=False):
+        if from_snapshot and self._snapshot is not None:
+            return self._snapshot.current()[1]
+        return self._generations
+
+    def write_stats(self):
+        return self._writer.stats()
+
+    def snapshot_stats(self):
+        return self._snapshot.stats() if self._snapshot is not None else None
+
+    def close(self):
+        self._writer.close()
+        self._generations.close()
+
+    def register_log_partition(self, path, starts_at, ends_at, last_id, rows):
+        """
+            Method that puts an archive file written by LogArchiver in place of the logs it holds:
+        it is registered and the logs are deleted from the logs table, as one transaction
+
+        :param path:        The path of the archive file, relative to the directory of the database
+        :param starts_at:   The logs it holds were started at or after this epoch...
+        :param ends_at:     ... and before this one
+        :param last_id:     The greatest log id it can hold
+        :param rows:        The number of logs it holds
+        :raises:            ConstraintError if the logs deleted aren't those it holds (e.g. some were rolled up
+                            since it was written), in which case nothing is done
+        """
+        def check(rowcounts):
+            if rowcounts[1] != rows:
+                raise ConstraintError(str(rowcounts[1]) + " logs to delete instead of the " + str(rows) +
+                                      " in " + path)
+
+        try:
+            self._writer.execute([
+                ("INSERT INTO log_partitions (path, starts_at, ends_at, last_id, rows, archived_at) "
+                 "VALUES (?, ?, ?, ?, ?, ?);", (path, starts_at, ends_at, last_id, rows, _epoch_now()),
+                 "log_partitions"),
+                ("DELETE FROM logs WHERE started_at >= ? AND started_at < ? AND id <= ?;",
+                 (starts_at, ends_at, last_id), "logs")
+            ], check=check)
+        except sql.IntegrityError as e:
+            raise ConstraintError(str(e)) from e
+
+    def downsample_logs(self, cutoff, batch_size):
+        """
+            Method that rolls the oldest logs started before cutoff up into their daily totals, in
+        logs_daily, and deletes them, as one transaction (see LogRetention)
+
+        :param cutoff:      The epoch before which logs are rolled up
+        :param batch_size:  The maximum number of logs rolled up
+        :return:            The number of logs rolled up
+        """
+        batch = "SELECT id FROM logs WHERE started_at < ? ORDER BY started_at, id LIMIT ?"
+
+        # Counted by the DELETE, in the same transaction, so that the count is that of the logs rolled up
+        rowcounts = self._writer.execute([
+            ("INSERT INTO logs_daily (uid, cid, day, duration, sessions) "
+             "SELECT uid, cid, " + DAY_OF_STARTED_AT + ", SUM(duration), COUNT(*) "
+             "FROM logs WHERE id IN (" + batch + ") GROUP BY 1, 2, 3 "
+             "ON CONFLICT(uid, cid, day) DO UPDATE SET "
+                 "duration = duration + excluded.duration, "
+                 "sessions = sessions + excluded.sessions;", (cutoff, batch_size), "logs_daily"),
+            ("DELETE FROM logs WHERE id IN (" + batch + ");", (cutoff, batch_size), "logs")
+        ])
+
+        return rowcounts[1]
+
+    def downsample_log_partition(self, path, totals):
+        """
+            Method that puts the daily totals of an archive partition in place of it, as one
+        transaction: they are added to logs_daily and the partition is retired (see LogRetention).
+        Nothing is done if the partition was retired already.
+
+        :param path:        The path of the partition, as registered in log_partitions
+        :param totals:      Its daily totals, as a list of (uid, cid, day, duration, sessions) tuples
+        """
+        with self.atomic():
+            for uid, cid, day, duration, sessions in totals:
+                self._execute_query("INSERT INTO logs_daily (uid, cid, day, duration, sessions) "
+                                    "SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM log_partitions WHERE path=?) "
+                                    "ON CONFLICT(uid, cid, day) DO UPDATE SET "
+                                        "duration = duration + excluded.duration, "
+                                        "sessions = sessions + excluded.sessions;",
+                                    uid, cid, day, duration, sessions, path, table="logs_daily")
+            self._execute_query("INSERT OR IGNORE INTO retired_log_partitions (path, retired_at) "
+                                "SELECT path, ? FROM log_partitions WHERE path=?;", _epoch_now(), path)
+            self.delete("log_partitions", {"path": path})
+
+    def run_maintenance(self, statements):
+        """
+            Method that runs maintenance statements (e.g. ANALYZE) through the writer thread, as one
+        transaction (see MaintenanceScheduler)
+
+        :param statements:  The list of statements, which take no arguments
+        """
+        with self.atomic():
+            for query in statements:
+                self._execute_query(query)
+
+    def backup_to(self, target, pages, sleep, progress=None):
+        """
+            Method that copies the database into another one while it is in use (see SingleWriter.backup)
+
+        :param target:      A connection to the database to copy into
+        :param pages:       The number of pages copied per step
+        :param sleep:       How long to wait before retrying a step that hit a lock of another process, in seconds
+        :param progress:    Called by the writer thread after each step, as progress(status, remaining, total)
+        """
+        self._writer.backup(target, pages, sleep, progress)
@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+
+
+class ConstraintError(Exception):
+    """
+        Raised by the writes of a StorageBackend that would break a constraint of a table,
+    e.g. a second row with the same primary key
+    """
+    pass
+
+
+class StorageBackend:
+    """
+        The storage the operations of the DatabaseHandler go through.
+
+        Rows are tuples, whose columns are in the order of the table definitions (see
+    database_creator). Conditions are dictionaries of the format {<column>: <value>}, matched
+    for equality. Every write names the table it changes, so that the backend can bump the
+    table's generation (see TableGenerations) once it is committed, which invalidates the
+    cached reads of that table.
+
+        Implementations: SQLiteBackend (the database file), MemoryBackend (indexed Python
+    data structures, for benchmarks and tests).
+    """
+
+    # Queries that were run, for QueryBudget and /metrics (see QueryProfiler)
+    profiler = None
+
+    # The path of the database file, None if the backend isn't file backed
+    path = None
+
+    @contextmanager
+    def atomic(self):
+        """
+            Context manager that commits the writes made inside it, by the calling thread, as
+        one transaction: either all of them are applied or none is. Their errors may only be
+        raised when the block exits.
+        """
+        raise NotImplementedError()
+
+    def insert(self, table, values, replace=False):
+        """
+        :param table:       The table to insert into
+        :param values:      The values of the new row, as a dictionary of the format {<column>: <value>}.
+                            Missing columns get their default value (the next id, for the id columns)
+        :param replace:     True - a row with the same primary key is replaced
+                            False - a row with the same primary key raises a ConstraintError
+        """
+        raise NotImplementedError()
+
+    def update(self, table, values, where):
+        """
+        :param table:       The table to update
+        :param values:      The new values, as a dictionary of the format {<column>: <value>}
+        :param where:       The conditions the updated rows match
+        """
+        raise NotImplementedError()
+
+    def delete(self, table, where):
+        """
+        :param table:       The table to delete from
+        :param where:       The conditions the deleted rows match
+        """
+        raise NotImplementedError()
+
+    def select(self, table, where=None, columns=None):
+        """
+        :param table:       The table to read
+        :param where:       The conditions the rows match (None for every row)
+        :param columns:     The columns to return, as a list (None for all of them)
+        :return:            The rows, as a list of tuples, in no particular order
+        """
+        raise NotImplementedError()
+
+    def working_users(self):
+        """
+        :return:    The users working, as a list of (full_name, email, course_name, since, time) tuples
+        """
+        raise NotImplementedError()
+
+    def working_course(self, uid):
+        """
+        :param uid:     The id of a user
+        :return:        (course_name, time, since) if the user is working, None otherwise
+        """
+        raise NotImplementedError()
+
+    def courses_with_details(self):
+        """
+        :return:    The courses, as a list of (name, url, syllabus, about, notes, weekly_commitment_low,
+                    weekly_commitment_high, number_weeks, category_name) tuples
+        """
+        raise NotImplementedError()
+
+    def revocations(self, since):
+        """
+        :param since:   The oldest revocation to return (in milliseconds)
+        :return:        The sessions revoked after it, as a list of (uid, revoked_at) tuples
+        """
+        raise NotImplementedError()
+
+    def logs(self, from_snapshot=False):
+        """
+        :param from_snapshot:   True - the logs can be read from a (slightly stale) snapshot, if the backend keeps one
+        :return:                Every log, as a list of (full_name, email, course_name, duration, started_at,
+                                logged_at) tuples, in no particular order
+        """
+        raise NotImplementedError()
+
+    def log_changes(self, since, limit):
+        """
+        :param since:   The id of the last log already read (0 for none)
+        :param limit:   The maximum number of logs to read
+        :return:        - The logs with a greater id, archived ones included, as a list of (id, full_name, email,
+                          course_name, duration, started_at, logged_at) tuples, by increasing id. Ids grow with
+                          every log written, so a log written later never has a smaller id than one already
+                          returned. Logs whose user or course doesn't exist anymore are left out
+                        - The id of the last log read, left out or not (None if none was)
+                        - The number of logs read, left out or not (limit if there may be more)
+        """
+        raise NotImplementedError()
+
+    def history(self, uid, since=None, until=None, from_snapshot=False):
+        """
+        :param uid:             The id of a user
+        :param since:           Only logs started at or after this epoch (optional)
+        :param until:           Only logs started before this epoch (optional)
+        :param from_snapshot:   True - the logs can be read from a snapshot, if the backend keeps one
+        :return:                The logs of the user, as a list of (course_name, course_url, started_at,
+                                duration, logged_at) tuples, oldest first. Days rolled up by the retention
+                                (see LogRetention) come as (course_name, course_url, day, duration, None,
+                                sessions) tuples
+        """
+        raise NotImplementedError()
+
+    def total_duration(self, uid, from_snapshot=False):
+        """
+        :param uid:             The id of a user
+        :param from_snapshot:   True - the logs can be read from a snapshot, if the backend keeps one
+        :return:                The number of seconds the user worked, None if there's no log of the user
+        """
+        raise NotImplementedError()
+
+    def leaderboard(self, since=None, until=None, from_snapshot=False):
+        """
+        :param since:           Only count work started at or after this epoch (optional)
+        :param until:           Only count work started before this epoch (optional)
+        :param from_snapshot:   True - the logs can be read from a snapshot, if the backend keeps one
+        :return:                Every user, as a list of (full_name, uid, email, seconds_worked) tuples,
+                                the ones who worked the most first
+        """
+        raise NotImplementedError()
+
+    def generations(self, from_snapshot=False):
+        """
+        :param from_snapshot:   Whether the reads are served from the snapshot
+        :return:                The generations of the tables those reads are versioned by
+        """
+        raise NotImplementedError()
+
+    def write_stats(self):
+        """
+        :return:    A dictionary of the format:
+                    {
+                        "batches": <no_of_commits>,
+                        "writes": <no_of_writes_committed_or_failed>,
+                        "failed": <no_of_writes_that_failed>,
+                        "largest_batch": <max_no_of_writes_committed_together>
+                    }
+        """
+        raise NotImplementedError()
+
+    def snapshot_stats(self):
+        """
+        :return:    The refresh statistics of the snapshot (see ReadSnapshot.stats), or None if there's none
+        """
+        return None
+
+    def close(self):
+        """
+            Method that releases what the backend holds (threads, connections), once the pending writes
+        are committed. They are opened again on their next use
+        """
+        pass
@@ -0,0 +1,203 @@
+import os
+import secrets
+import sqlite3 as sql
+import threading
+
+# The tables whose reads are cached, and whose writes therefore need to be visible to every process
+VERSIONED_TABLES = ("users", "logged_in", "working", "course_categories", "courses", "logs", "logs_daily")
+
+_EPOCH_ROW = "@epoch"
+
+
+def version_table_statements(tables=VERSIONED_TABLES):
+    """
+        Function that returns the statements creating the table_versions table, and the triggers
+    that bump a table's version on every INSERT, UPDATE and DELETE - whichever process runs it.
+    Every statement can safely be run again.
+
+    :param tables:      The names of the tables to version
+    :return:            The list of statements
+    """
+    statements = ["CREATE TABLE IF NOT EXISTS "
+                  "table_versions ("
+                      "name TEXT PRIMARY KEY, "
+                      "version INTEGER NOT NULL DEFAULT 0"
+                  ");",
+                  # Random prefix of the version tokens, so that tokens handed out before the database
+                  # was restored from a backup can't match its (older) versions
+                  "INSERT OR IGNORE INTO table_versions (name, version) "
+                  "VALUES ('" + _EPOCH_ROW + "', abs(random() % 4294967296));"]
+
+    for table in tables:
+        statements.append("INSERT OR IGNORE INTO table_versions (name, version) VALUES ('" + table + "', 0);")
+        for operation in ("INSERT", "UPDATE", "DELETE"):
+            statements.append("CREATE TRIGGER IF NOT EXISTS "
+                              "table_versions_" + table + "_" + operation.lower() + " "
+                              "AFTER " + operation + " ON " + table + " "
+                              "BEGIN "
+                                  "UPDATE table_versions SET version = version + 1 WHERE name = '" + table + "'; "
+                              "END;")
+
+    return statements
+
+
+class TableGenerations:
+    """
+        Per-table generation counters.
+
+        Every write that goes through the DatabaseHandler write helpers bumps the
+    counter of the table it touched, so "has anything in these tables changed?"
+    becomes a couple of dictionary lookups instead of a query.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict()
+
+        # Random per-instance prefix, so that version tokens handed out before a
+        # restart can never match the (reset) counters of the new process
+        self._epoch = secrets.token_hex(4)
+
+    def bump(self, table):
+        """
+            Method that marks a table as changed
+
+        :param table:       The name of the table that was written to
+        :return:            The new generation of the table
+        """
+        with self._lock:
+            generation = self._counters.get(table, 0) + 1
+            self._counters[table] = generation
+
+        return generation
+
+    def get(self, table):
+        """
+        :param table:       The name of the table
+        :return:            The current generation of the table (0 if it was never written to)
+        """
+        return self._counters.get(table, 0)
+
+    def snapshot(self, tables):
+        """
+        :param tables:      An iterable of table names
+        :return:            A tuple with the current generation of each of the tables, in order
+        """
+        return tuple(self.get(table) for table in tables)
+
+    def token(self, tables):
+        """
+            Method that builds a version token for a set of tables.
+            The token changes whenever any of the tables is written to.
+
+        :param tables:      An iterable of table names
+        :return:            The version token, as a string
+        """
+        return self._epoch + "-" + "-".join(str(gen) for gen in self.snapshot(tables))
+
+    def freeze(self):
+        """
+        :return:    A FrozenTableGenerations with the current generation of every table
+        """
+        with self._lock:
+            return FrozenTableGenerations(self._epoch, dict(self._counters))
+
+    def close(self):
+        """
+            Nothing to release: the counters are in memory
+        """
+        pass
+
+
+class FrozenTableGenerations:
+    """
+        The generations of the tables at a point in time, e.g. when a snapshot of the database was taken.
+        Same interface as TableGenerations, minus bump.
+    """
+
+    def __init__(self, epoch, counters):
+        """
+        :param epoch:       The prefix of the version tokens
+        :param counters:    A dictionary of the format {<table>: <generation>}
+        """
+        self.epoch = epoch
+        self.counters = counters
+
+    def get(self, table):
+        return self.counters.get(table, 0)
+
+    def snapshot(self, tables):
+        return tuple(self.get(table) for table in tables)
+
+    def token(self, tables):
+        return self.epoch + "-" + "-".join(str(gen) for gen in self.snapshot(tables))
+
+
+def read_table_versions(con):
+    """
+        Function that reads the generations kept in the table_versions table of a database
+
+    :param con:     A connection to the database
+    :return:        A FrozenTableGenerations, whose tokens match the ones of SharedTableGenerations
+    """
+    versions = dict(con.execute("SELECT name, version FROM table_versions").fetchall())
+    return FrozenTableGenerations("%08x" % versions.pop(_EPOCH_ROW, 0), versions)
+
+
+class SharedTableGenerations:
+    """
+        Per-table generation counters kept in the database itself, in the table_versions table
+    maintained by triggers (see version_table_statements).
+
+        Unlike TableGenerations, the counters see the writes of every process using the database,
+    so each worker of a prefork server can keep its own cache (and hand out ETags) without serving
+    results another worker made stale. Reading them is a single query over a handful of rows, on a
+    connection kept per thread (and per process, so that none is shared across a fork).
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path:     The path of the SQLite database file, where version_table_statements were run
+        """
+        self._db_path = db_path
+        self._local = threading.local()
+
+    def _connection(self):
+        con = getattr(self._local, "con", None)
+        if con is None or self._local.pid != os.getpid():
+            con = sql.connect(self._db_path)
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def close(self):
+        """
+            Method that closes the connection of the calling thread, which is opened again on its next read
+        """
+        con = getattr(self._local, "con", None)
+        if con is not None and self._local.pid == os.getpid():
+            con.close()
+        self._local.con = None
+
+    def _read(self):
+        return dict(self._connection().execute("SELECT name, version FROM table_versions").fetchall())
+
+    def freeze(self):
+        return read_table_versions(self._connection())
+
+    def bump(self, table):
+        """
+            Nothing to do: the triggers bumped the table as part of the write itself
+        """
+        pass
+
+    def get(self, table):
+        return self._read().get(table, 0)
+
+    def snapshot(self, tables):
+        versions = self._read()
+        return tuple(versions.get(table, 0) for table in tables)
+
+    def token(self, tables):
+        versions = self._read()
+        return "%08x-" % versions.get(_EPOCH_ROW, 0) + "-".join(str(versions.get(table, 0)) for table in tables)
@@ -0,0 +1,87 @@
+"""
+    Checks that a database from before the tables added since (revoked sessions, archive partitions, daily
+    log totals, table versions) is refused as it is, untouched, and served once database_migrator migrated it.
+
+    Usage (from the repository root):
+
+        python -m pytest database/test_database_migrator.py
+"""
+import hashlib
+import sqlite3 as sql
+import threading
+
+import pytest
+
+from database import database_migrator
+from database.database_handler import DatabaseHandler
+from database.dataset_generator import generate
+from database.sqlite_backend import SQLiteBackend
+
+_ADDED_TABLES = ["revoked_sessions", "log_partitions", "retired_log_partitions", "logs_daily", "table_versions"]
+
+
+@pytest.fixture
+def legacy_database(tmp_path):
+    db_path = str(tmp_path / "legacy.db")
+    generate(db_path, users=20, courses=4, months=2, working=2, admins=1, logged_in=5)
+
+    con = sql.connect(db_path)
+    try:
+        for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'trigger';").fetchall():
+            con.execute("DROP TRIGGER " + name + ";")
+        for table in _ADDED_TABLES:
+            con.execute("DROP TABLE " + table + ";")
+        con.commit()
+    finally:
+        con.close()
+
+    return db_path
+
+
+def _read(db_path, query):
+    con = sql.connect(db_path)
+    try:
+        return con.execute(query).fetchall()
+    finally:
+        con.close()
+
+
+@pytest.mark.parametrize("shared_generations", [False, True])
+def test_legacy_database_is_refused_untouched(legacy_database, shared_generations):
+    with open(legacy_database, "rb") as f:
+        before = f.read()
+    threads = threading.active_count()
+
+    with pytest.raises(RuntimeError, match="database_migrator"):
+        DatabaseHandler(legacy_database, backend=SQLiteBackend(legacy_database,
+                                                               shared_generations=shared_generations))
+
+    with open(legacy_database, "rb") as f:
+        assert f.read() == before
+    assert threading.active_count() == threads
+
+
+def test_migrated_database_is_served(legacy_database):
+    logs = _read(legacy_database, "SELECT COUNT(*), SUM(duration) FROM logs;")
+
+    database_migrator.migrate_schema(legacy_database)
+    # Safe to run again
+    database_migrator.migrate_schema(legacy_database)
+
+    tables = {name for name, in _read(legacy_database, "SELECT name FROM sqlite_master WHERE type = 'table';")}
+    assert set(_ADDED_TABLES) <= tables
+
+    handler = DatabaseHandler(legacy_database, backend=SQLiteBackend(legacy_database, shared_generations=True))
+    try:
+        assert sum(user[3] for user in handler.get_leaderboard_totals(None, None)) == logs[0][1]
+
+        email, = _read(legacy_database, "SELECT email FROM users WHERE id NOT IN (SELECT uid FROM working) "
+                                        "LIMIT 1;")[0]
+        course, = _read(legacy_database, "SELECT name FROM courses LIMIT 1;")[0]
+        email_hash = hashlib.sha256(email.encode("utf-8")).hexdigest()
+        assert handler.start_work(email_hash, course) == (True, "")
+        assert handler.stop_work(email_hash, 60) == (True, "")
+    finally:
+        handler.close()
+
+    assert _read(legacy_database, "SELECT COUNT(*) FROM logs;")[0][0] == logs[0][0] + 1
@@ -0,0 +1,186 @@
+"""
+    Checks that the event journal (see EventJournal) holds the work sessions the database has, so that
+    replaying it gives them back, and that its callers never wait on it forever.
+
+    Usage (from the repository root):
+
+        python -m pytest database/test_event_journal.py
+"""
+import hashlib
+import multiprocessing
+import shutil
+import sqlite3 as sql
+import time
+
+import pytest
+
+from database import event_journal
+from database.database_handler import DatabaseHandler
+from database.dataset_generator import generate
+from database.event_journal import EventJournal, JournalUnavailable
+
+
+@pytest.fixture
+def database(tmp_path):
+    db_path = str(tmp_path / "journal.db")
+    generate(db_path, users=20, courses=4, months=1, working=3, admins=1, logged_in=5)
+    return db_path
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "journal" / "events.jsonl")
+
+
+@pytest.fixture
+def handler(database, journal_path):
+    handler = DatabaseHandler(database, journal_path=journal_path)
+    yield handler
+    handler.close()
+
+
+def _users_and_course(db_path):
+    """
+    :return:    The email hashes of the users who aren't working, and the name of a course
+    """
+    con = sql.connect(db_path)
+    try:
+        emails = [email for email, in con.execute("SELECT email FROM users WHERE id NOT IN (SELECT uid FROM working) "
+                                                  "ORDER BY id;")]
+        course = con.execute("SELECT name FROM courses ORDER BY id LIMIT 1;").fetchone()[0]
+    finally:
+        con.close()
+
+    return [hashlib.sha256(email.encode("utf-8")).hexdigest() for email in emails], course
+
+
+def _sessions(db_path):
+    """
+    :return:    The working table, and the logs, of a database
+    """
+    con = sql.connect(db_path)
+    try:
+        return (con.execute("SELECT uid, cid, since, time FROM working ORDER BY uid;").fetchall(),
+                con.execute("SELECT uid, cid, duration, started_at, logged_at FROM logs ORDER BY id;").fetchall())
+    finally:
+        con.close()
+
+
+def _fold(journal_path):
+    return event_journal.fold_events(event_journal.read_events(journal_path))
+
+
+def test_replay_rebuilds_the_sessions(database, journal_path, handler, tmp_path):
+    backup = str(tmp_path / "backup.db")
+    shutil.copy(database, backup)
+    users, course = _users_and_course(database)
+
+    for user in users[:6]:
+        assert handler.start_work(user, course) == (True, "")
+    for user in users[:6]:
+        assert handler.update_time(user, 60) == (True, "")
+    for user in users[:3]:
+        assert handler.stop_work(user, 60) == (True, "")
+
+    restored = DatabaseHandler(backup)
+    try:
+        stats = event_journal.replay(restored, journal_path)
+    finally:
+        restored.close()
+
+    assert stats["restored"] == 3
+    assert _sessions(backup) == _sessions(database)
+
+
+def test_failed_writes_are_undone_by_replay(journal_path, handler, monkeypatch):
+    users, course = _users_and_course(handler.get_database_path())
+    assert handler.start_work(users[0], course) == (True, "")
+    assert handler.update_time(users[0], 30) == (True, "")
+    working, logs, _ = _fold(journal_path)
+
+    def fail(*args, **kwargs):
+        raise sql.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(handler._storage, "insert", fail)
+    assert handler.start_work(users[1], course) == (False, "Server error")
+    assert handler.stop_work(users[0], 60) == (False, "Server error!")
+    monkeypatch.setattr(handler._storage, "update", fail)
+    assert handler.update_time(users[0], 90) == (False, "User not working")
+    monkeypatch.undo()
+
+    assert _fold(journal_path)[:2] == (working, logs)
+
+
+def test_writes_that_cant_apply_arent_journaled(journal_path, handler):
+    users, course = _users_and_course(handler.get_database_path())
+    assert handler.start_work(users[0], course) == (True, "")
+    _, _, events = _fold(journal_path)
+
+    assert handler.start_work(users[0], course) == (False, "Email already in use!")
+    assert handler.update_time(users[1], 30) == (False, "User not working")
+    assert handler.stop_work(users[1], 30) == (False, "Not working!")
+
+    assert _fold(journal_path)[2] == events
+
+
+def test_append_fails_once_the_flusher_is_gone(tmp_path):
+    journal = EventJournal(str(tmp_path / "events.jsonl"))
+    journal.append({"event": "update_time", "uid": 1, "time": 1})
+
+    # Stops the thread, as if it died, without the journal knowing
+    journal._queue.put(None)
+    journal._thread.join()
+
+    with pytest.raises(JournalUnavailable):
+        journal.append({"event": "update_time", "uid": 1, "time": 2})
+
+
+def test_append_times_out(tmp_path):
+    journal = EventJournal(str(tmp_path / "events.jsonl"), write_timeout=0.5)
+    write = journal._write
+    journal._write = lambda fd, lock_fd, batch: time.sleep(2) or write(fd, lock_fd, batch)
+
+    start = time.monotonic()
+    with pytest.raises(JournalUnavailable):
+        journal.append({"event": "update_time", "uid": 1, "time": 1})
+    assert time.monotonic() - start < 1.5
+
+    journal.close()
+
+
+def _start(path):
+    EventJournal(path).start(lambda: time.sleep(0.2) or [(1, 1, 0, 0)])
+
+
+def test_one_checkpoint_per_journal(tmp_path):
+    path = str(tmp_path / "events.jsonl")
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_start, args=(path,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(10)
+
+    assert [event["event"] for event in event_journal.read_events(path)] == ["checkpoint"]
+
+
+def test_rotated_journal_gives_the_same_sessions(tmp_path):
+    path = str(tmp_path / "events.jsonl")
+    journal = EventJournal(path, max_bytes=2048, keep=100)
+    journal.start(lambda: [])
+
+    for uid in range(200):
+        journal.append({"event": "start_work", "uid": uid, "cid": 1, "since": uid})
+        if uid % 2:
+            journal.append({"event": "stop_work", "uid": uid, "cid": 1, "duration": 5, "since": uid,
+                            "logged_at": uid + 5})
+    journal.close()
+
+    files = event_journal.journal_files(path)
+    assert len(files) > 2
+
+    events = [event for file in files for event in event_journal.read_events(file)]
+    working, logs, _ = event_journal.fold_events(events)
+    assert sorted(working) == list(range(0, 200, 2))
+    assert len(logs) == 100
+    assert event_journal.fold_events(event_journal.read_events(path))[0] == working
@@ -0,0 +1,132 @@
+"""
+    Checks that following the watermark of DatabaseHandler.get_log_changes (the incremental export of
+    the logs, see database/log_export.py) gives every log exactly once, from a database or from its shards.
+
+    Usage (from the repository root):
+
+        python -m pytest database/test_log_changes.py
+"""
+import io
+import json
+import sqlite3 as sql
+
+import pytest
+
+from database import log_export, sharding
+from database.database_handler import DatabaseHandler
+from database.dataset_generator import generate
+from database.memory_backend import MemoryBackend
+from database.sharding import ShardedHandler
+
+
+@pytest.fixture
+def database(tmp_path):
+    db_path = str(tmp_path / "changes.db")
+    generate(db_path, users=20, courses=4, months=1, working=2, admins=1, logged_in=5)
+    return db_path
+
+
+def _logs(db_path):
+    con = sql.connect(db_path)
+    try:
+        return con.execute("SELECT COUNT(*), MAX(id) FROM logs;").fetchone()
+    finally:
+        con.close()
+
+
+def _export(fetch, limit):
+    """
+    :return:    The ids of the logs returned by fetch, following its watermark, and the last watermark
+    """
+    ids, since = [], None
+    while True:
+        result = fetch(since, limit)
+        assert result["success"]
+        ids += [log["id"] for log in result["users"]]
+        since = result["watermark"]
+        if not result["more"]:
+            return ids, since
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "memory"])
+def test_orphaned_logs_move_the_watermark(database, backend):
+    count, last_id = _logs(database)
+
+    # Logs of a user who doesn't exist anymore, which aren't returned
+    con = sql.connect(database)
+    try:
+        con.executemany("INSERT INTO logs (uid, cid, duration, started_at, logged_at) VALUES (99999, 1, 5, 1, 2);",
+                        [()] * 7)
+        con.commit()
+    finally:
+        con.close()
+
+    handler = DatabaseHandler(database, backend=MemoryBackend(database) if backend == "memory" else None)
+    try:
+        result = handler.get_log_changes(str(last_id - 3), 10)
+        assert (len(result["users"]), result["watermark"], result["more"]) == (3, str(last_id + 7), True)
+
+        result = handler.get_log_changes(str(last_id + 2), 5)
+        assert (len(result["users"]), result["watermark"], result["more"]) == (0, str(last_id + 7), True)
+
+        ids, watermark = _export(handler.get_log_changes, 100)
+        assert len(ids) == len(set(ids)) == count
+        assert watermark == str(last_id + 7)
+    finally:
+        handler.close()
+
+
+def test_invalid_watermarks_are_refused(database):
+    handler = DatabaseHandler(database)
+    try:
+        for since in ["abc", "-1", "1:2"]:
+            with pytest.raises(ValueError):
+                handler.parse_watermark(since)
+            assert handler.get_log_changes(since, 10) == {"success": False, "message": "Invalid watermark"}
+    finally:
+        handler.close()
+
+
+def test_sharded_watermark_covers_every_shard(database, tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    sharding.split(database, shard_dir, lambda email: "first" if len(email) % 2 else "second")
+
+    handler = ShardedHandler(shard_dir)
+    try:
+        ids, watermark = _export(handler.get_log_changes, 7)
+        assert len(ids) == len(set(ids)) == _logs(database)[0]
+        assert sorted(handler.parse_watermark(watermark)) == ["first", "second"]
+        assert handler.get_log_changes(watermark, 7)["users"] == []
+
+        for since in ["first", "first:abc", "first:1,second"]:
+            with pytest.raises(ValueError):
+                handler.parse_watermark(since)
+    finally:
+        handler.close()
+
+
+def test_export_is_on_disk_before_the_watermark_moves(database, tmp_path, monkeypatch):
+    calls = []
+    fsync = log_export.os.fsync
+    monkeypatch.setattr(log_export.os, "fsync", lambda fd: calls.append("fsync") or fsync(fd))
+
+    handler = DatabaseHandler(database)
+    try:
+        with open(str(tmp_path / "logs.jsonl"), "a") as output:
+            count, since = log_export.export(handler.get_log_changes, output, batch_size=50,
+                                             on_batch=lambda watermark: calls.append(watermark))
+
+        # Not backed by a file: written without an fsync
+        buffer = io.StringIO()
+        assert log_export.export(handler.get_log_changes, buffer, batch_size=50)[0] == count
+    finally:
+        handler.close()
+
+    assert count == _logs(database)[0]
+    watermarks = [call for call in calls if call != "fsync"]
+    assert watermarks[-1] == since
+    for watermark in watermarks:
+        assert calls[calls.index(watermark) - 1] == "fsync"
+
+    with open(str(tmp_path / "logs.jsonl")) as output:
+        assert len([json.loads(line) for line in output]) == count
@@ -0,0 +1,153 @@
+"""
+    Checks that the logs moved out of the live database, into archive partitions (LogArchiver) or daily
+    totals (LogRetention), are neither lost nor counted twice.
+
+    Usage (from the repository root):
+
+        python -m pytest database/test_log_partitions.py
+"""
+import os
+import sqlite3 as sql
+import threading
+import time
+
+import pytest
+
+from database import log_partitions
+from database.database_handler import DatabaseHandler
+from database.dataset_generator import generate
+from database.log_partitions import LogArchiver, partition_paths
+from database.log_retention import LogRetention
+from database.storage_backend import ConstraintError
+
+
+@pytest.fixture
+def handler(tmp_path):
+    db_path = str(tmp_path / "logs.db")
+    generate(db_path, users=30, courses=6, months=4, working=5, admins=1, logged_in=5)
+
+    handler = DatabaseHandler(db_path)
+    yield handler
+    handler.close()
+
+
+def _total(db_path):
+    """
+    :return:    The number of seconds worked, over the live logs, the archive partitions and the daily totals
+    """
+    con = sql.connect(db_path)
+    try:
+        total = con.execute("SELECT (SELECT IFNULL(SUM(duration), 0) FROM logs) + "
+                            "(SELECT IFNULL(SUM(duration), 0) FROM logs_daily);").fetchone()[0]
+        paths = partition_paths(con, os.path.dirname(os.path.abspath(db_path)))
+    finally:
+        con.close()
+
+    for path in paths:
+        con = sql.connect(path)
+        try:
+            total += con.execute("SELECT IFNULL(SUM(duration), 0) FROM logs;").fetchone()[0]
+        finally:
+            con.close()
+
+    return total
+
+
+def _count(db_path, query):
+    con = sql.connect(db_path)
+    try:
+        return con.execute(query).fetchone()[0]
+    finally:
+        con.close()
+
+
+def test_archive_keeps_every_log(handler, tmp_path):
+    db_path = handler.get_database_path()
+    before = _total(db_path)
+
+    archived = LogArchiver(handler, str(tmp_path / "archive"), keep_months=1).run()
+
+    assert archived
+    assert _count(db_path, "SELECT COUNT(*) FROM log_partitions;") == len(archived)
+    assert _total(db_path) == before
+
+
+def test_register_refuses_logs_gone_since_the_copy(handler):
+    db_path = handler.get_database_path()
+    starts_at = log_partitions.month_start(_count(db_path, "SELECT MIN(started_at) FROM logs;"))
+    ends_at = log_partitions.next_month_start(starts_at)
+    last_id = _count(db_path, "SELECT MAX(id) FROM logs;")
+
+    con = sql.connect(db_path)
+    try:
+        rows = con.execute("SELECT COUNT(*) FROM logs WHERE started_at >= ? AND started_at < ?;",
+                           (starts_at, ends_at)).fetchone()[0]
+    finally:
+        con.close()
+
+    # Rolled up behind the archiver's back, between the copy and the registration
+    handler.downsample_logs(ends_at, 10)
+    logs = _count(db_path, "SELECT COUNT(*) FROM logs;")
+
+    with pytest.raises(ConstraintError):
+        handler.register_log_partition("archive/partial.db", starts_at, ends_at, last_id, rows)
+
+    assert _count(db_path, "SELECT COUNT(*) FROM log_partitions;") == 0
+    assert _count(db_path, "SELECT COUNT(*) FROM logs;") == logs
+
+
+def test_archiver_removes_the_file_it_cant_register(handler, tmp_path, monkeypatch):
+    db_path = handler.get_database_path()
+    archive_dir = tmp_path / "archive"
+    before = _total(db_path)
+    write_partition = log_partitions._write_partition
+
+    def write_and_roll_up(path, rows):
+        write_partition(path, rows)
+        handler.downsample_logs(max(row[4] for row in rows) + 1, 10)
+
+    monkeypatch.setattr(log_partitions, "_write_partition", write_and_roll_up)
+
+    with pytest.raises(ConstraintError):
+        LogArchiver(handler, str(archive_dir), keep_months=1).run()
+
+    assert [name for name in os.listdir(archive_dir) if name.endswith(".db")] == []
+    assert _count(db_path, "SELECT COUNT(*) FROM log_partitions;") == 0
+    assert _total(db_path) == before
+
+
+def test_retention_waits_for_the_archiver(handler, tmp_path, monkeypatch):
+    db_path = handler.get_database_path()
+    before = _total(db_path)
+    copied = threading.Event()
+    resume = threading.Event()
+    write_partition = log_partitions._write_partition
+
+    def write_and_pause(path, rows):
+        write_partition(path, rows)
+        copied.set()
+        resume.wait(10)
+
+    monkeypatch.setattr(log_partitions, "_write_partition", write_and_pause)
+
+    archiver = LogArchiver(handler, str(tmp_path / "archive"), keep_months=1)
+    retention = LogRetention(handler, retention_days=30, batch_sleep=0)
+    results = {}
+
+    threads = [threading.Thread(target=lambda: results.update(archived=archiver.run())),
+               threading.Thread(target=lambda: results.update(rolled_up=retention.run()))]
+    threads[0].start()
+    assert copied.wait(10)
+    threads[1].start()
+
+    time.sleep(1.5)
+    assert threads[1].is_alive()
+    assert _count(db_path, "SELECT COUNT(*) FROM logs_daily;") == 0
+
+    monkeypatch.setattr(log_partitions, "_write_partition", write_partition)
+    resume.set()
+    for thread in threads:
+        thread.join(30)
+
+    assert results["archived"] and results["rolled_up"] > 0
+    assert _total(db_path) == before
@@ -0,0 +1,98 @@
+"""
+    Checks that the MemoryBackend answers the public reads of the DatabaseHandler like the SQLite one does,
+    from the same database file.
+
+    Usage (from the repository root):
+
+        python -m pytest database/test_memory_backend.py
+"""
+import hashlib
+import sqlite3 as sql
+
+import pytest
+
+from database.database_handler import DatabaseHandler
+from database.dataset_generator import generate
+from database.memory_backend import MemoryBackend
+
+
+@pytest.fixture(scope="module")
+def handlers(tmp_path_factory):
+    db_path = str(tmp_path_factory.mktemp("parity") / "parity.db")
+    generate(db_path, users=60, courses=12, months=3, working=10, admins=2, logged_in=20)
+
+    sqlite_handler = DatabaseHandler(db_path)
+    memory_handler = DatabaseHandler(db_path, backend=MemoryBackend(db_path))
+    yield sqlite_handler, memory_handler
+    sqlite_handler.close()
+    memory_handler.close()
+
+
+@pytest.fixture(scope="module")
+def users(handlers):
+    """
+    :return:    The email hash of an admin, that of a user who isn't one, and a start time halfway through the logs
+    """
+    con = sql.connect(handlers[0].get_database_path())
+    try:
+        admin = con.execute("SELECT email FROM users WHERE admin = 1 ORDER BY id LIMIT 1;").fetchone()[0]
+        user = con.execute("SELECT email FROM users WHERE admin = 0 ORDER BY id LIMIT 1;").fetchone()[0]
+        started_at = con.execute("SELECT started_at FROM logs ORDER BY started_at "
+                                 "LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM logs);").fetchone()[0]
+    finally:
+        con.close()
+
+    def email_hash(email):
+        return hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+    return email_hash(admin), email_hash(user), started_at
+
+
+def _unordered(result):
+    """
+    :return:    The result, with the lists it holds sorted and the positions ("id") of their entries dropped,
+                for the reads whose order isn't specified
+    """
+    if isinstance(result, tuple):
+        return tuple(_unordered(value) for value in result)
+    if isinstance(result, dict):
+        return {key: _unordered(value) for key, value in result.items()}
+    if isinstance(result, list):
+        return sorted(({key: _unordered(value) for key, value in entry.items() if key != "id"}
+                       if isinstance(entry, dict) else _unordered(entry) for entry in result), key=repr)
+    return result
+
+
+READS = [
+    ("get_courses_list", lambda admin, user, started_at: (), True),
+    ("get_courses_list_with_details", lambda admin, user, started_at: (), True),
+    ("get_working_users", lambda admin, user, started_at: (), True),
+    ("get_logs", lambda admin, user, started_at: (), True),
+    ("get_log_changes", lambda admin, user, started_at: (None, 50), False),
+    ("get_leaderboard", lambda admin, user, started_at: (), False),
+    ("get_leaderboard", lambda admin, user, started_at: (started_at, None), False),
+    ("get_leaderboard_totals", lambda admin, user, started_at: (), False),
+    ("get_history_for_user", lambda admin, user, started_at: (admin, user), False),
+    ("get_history_for_user", lambda admin, user, started_at: (user, user, None, started_at), False),
+    ("get_history_for_user", lambda admin, user, started_at: (user, admin), False),
+    ("get_stats_for_user", lambda admin, user, started_at: (admin, user), False),
+    ("get_user_details", lambda admin, user, started_at: (admin, user), False),
+    ("get_user_details", lambda admin, user, started_at: (user, admin), False),
+    ("is_admin", lambda admin, user, started_at: (admin,), False),
+    ("is_admin", lambda admin, user, started_at: (user,), False),
+    ("user_is_working", lambda admin, user, started_at: (user,), False),
+]
+
+
+@pytest.mark.parametrize("method, arguments, unordered", READS)
+def test_reads_match_sqlite(handlers, users, method, arguments, unordered):
+    sqlite_handler, memory_handler = handlers
+    args = arguments(*users)
+
+    expected = getattr(sqlite_handler, method)(*args)
+    result = getattr(memory_handler, method)(*args)
+    assert expected not in (None, {}, [])
+
+    if unordered:
+        expected, result = _unordered(expected), _unordered(result)
+    assert result == expected
@@ -0,0 +1,59 @@
+"""
+    Checks that the cached reads of the DatabaseHandler (see database/query_cache.py) are served from the
+    cache warmed up before the first request, and never once a write changed their tables.
+
+    Usage (from the repository root):
+
+        python -m pytest database/test_query_cache.py
+"""
+import hashlib
+import sqlite3 as sql
+
+import pytest
+
+from database.database_handler import DatabaseHandler
+from database.dataset_generator import generate
+
+
+@pytest.fixture
+def handler(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    generate(db_path, users=20, courses=4, months=1, working=2, admins=1, logged_in=5)
+
+    handler = DatabaseHandler(db_path)
+    yield handler
+    handler.close()
+
+
+def test_warm_up_caches_the_reads_of_the_requests(handler):
+    handler.warm_up()
+    misses = handler.get_cache_stats()["misses"]
+
+    # As the server calls them
+    handler.get_leaderboard(None, None)
+    handler.get_courses_list()
+    handler.get_working_users()
+
+    stats = handler.get_cache_stats()
+    assert stats["misses"] == misses
+    assert stats["hits"] >= 3
+
+
+def test_writes_invalidate_the_reads_of_their_tables(handler):
+    con = sql.connect(handler.get_database_path())
+    try:
+        email = con.execute("SELECT email FROM users WHERE id NOT IN (SELECT uid FROM working) LIMIT 1;").fetchone()[0]
+        course = con.execute("SELECT name FROM courses LIMIT 1;").fetchone()[0]
+    finally:
+        con.close()
+    email_hash = hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+    working = len(handler.get_working_users()["users"])
+    courses = handler.get_courses_list()
+
+    assert handler.start_work(email_hash, course) == (True, "")
+    assert len(handler.get_working_users()["users"]) == working + 1
+    assert handler.get_courses_list() is courses
+
+    assert handler.stop_work(email_hash, 60) == (True, "")
+    assert len(handler.get_working_users()["users"]) == working
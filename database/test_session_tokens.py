@@ -0,0 +1,62 @@
+"""
+    Checks that the signed session tokens (see database/session_tokens.py) stop being valid once their user
+    logs out, in every handler serving the database, and only for the tokens issued before.
+
+    Usage (from the repository root):
+
+        python -m pytest database/test_session_tokens.py
+"""
+import hashlib
+import sqlite3 as sql
+import time
+
+import pytest
+
+from database.database_handler import DatabaseHandler
+from database.dataset_generator import DEFAULT_PASSWORD, generate
+
+
+@pytest.fixture
+def handlers(tmp_path):
+    db_path = str(tmp_path / "sessions.db")
+    generate(db_path, users=10, courses=2, months=1, working=0, admins=1, logged_in=0)
+
+    # As two workers would
+    handlers = [DatabaseHandler(db_path, session_secret="secret", revocation_refresh=0) for _ in range(2)]
+    yield handlers
+    for handler in handlers:
+        handler.close()
+
+
+def _email(db_path):
+    con = sql.connect(db_path)
+    try:
+        return con.execute("SELECT email FROM users WHERE password IS NOT NULL LIMIT 1;").fetchone()[0]
+    finally:
+        con.close()
+
+
+def _valid(handler, token):
+    result = handler.is_token_still_valid(token)
+    assert result["success"]
+    return result["valid"]
+
+
+def test_logout_revokes_the_tokens_issued_before(handlers):
+    email = _email(handlers[0].get_database_path())
+    email_hash = hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+    login = handlers[0].verify_user(email, DEFAULT_PASSWORD)
+    assert login["success"]
+    token = login["token"]
+    assert [_valid(handler, token) for handler in handlers] == [True, True]
+    parts = token.split(".")
+    parts[-2] = ("0" if parts[-2][0] != "0" else "1") + parts[-2][1:]
+    assert not _valid(handlers[0], ".".join(parts))
+
+    assert handlers[1].logout_user(email_hash)["success"]
+    assert [_valid(handler, token) for handler in handlers] == [False, False]
+
+    time.sleep(0.01)
+    token = handlers[1].verify_user(email, DEFAULT_PASSWORD)["token"]
+    assert [_valid(handler, token) for handler in handlers] == [True, True]
@@ -0,0 +1,84 @@
+"""
+    Checks that splitting a database into shards (see database/sharding.py) routes every user to the
+    shard holding their rows, and that it writes nothing for tenant names that aren't valid.
+
+    Usage (from the repository root):
+
+        python -m pytest database/test_sharding.py
+"""
+import hashlib
+import os
+import sqlite3 as sql
+
+import pytest
+
+from database import sharding
+from database.dataset_generator import generate
+from database.sharding import ROUTING_DATABASE, ShardedHandler, ShardRouter
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    db_path = str(tmp_path_factory.mktemp("sharding") / "source.db")
+    generate(db_path, users=40, courses=6, months=2, working=8, admins=2, logged_in=10)
+    return db_path
+
+
+def _tenant_of(email):
+    return "first" if len(email) % 2 else "second"
+
+
+def _rows(db_path, query):
+    con = sql.connect(db_path)
+    try:
+        return con.execute(query).fetchall()
+    finally:
+        con.close()
+
+
+def test_split_routes_every_user_to_their_shard(database, tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    counts = sharding.split(database, shard_dir, _tenant_of)
+
+    users = _rows(database, "SELECT email FROM users;")
+    assert sum(counts.values()) == len(users)
+
+    router = ShardRouter(os.path.join(shard_dir, ROUTING_DATABASE))
+    shards = router.tenants()
+    assert sorted(shards) == ["first", "second"]
+
+    for email, in users:
+        tenant = router.tenant_of(hashlib.sha256(email.encode("utf-8")).hexdigest())
+        assert tenant == _tenant_of(email)
+        assert _rows(shards[tenant], "SELECT COUNT(*) FROM users WHERE email = '" + email + "';") == [(1,)]
+
+    for query in ["SELECT COUNT(*), SUM(duration) FROM logs;", "SELECT COUNT(*) FROM working;"]:
+        totals = [_rows(path, query)[0] for path in shards.values()]
+        assert tuple(map(sum, zip(*totals))) == _rows(database, query)[0]
+
+    handler = ShardedHandler(shard_dir)
+    try:
+        assert len(handler.get_working_users()["users"]) == len(_rows(database, "SELECT uid FROM working;"))
+    finally:
+        handler.close()
+
+
+@pytest.mark.parametrize("name", ["../outside", "a/b", "routing", "new\nline", ""])
+def test_split_writes_nothing_for_an_invalid_tenant(database, tmp_path, name):
+    with pytest.raises(ValueError):
+        sharding.split(database, str(tmp_path / "shards"), lambda email: name if len(email) % 2 else "valid")
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize("name", ["../outside", "routing"])
+def test_add_tenant_refuses_an_invalid_name(database, tmp_path, name):
+    shard_dir = str(tmp_path / "shards")
+    sharding.split(database, shard_dir, _tenant_of)
+    before = sorted(os.listdir(shard_dir))
+
+    with pytest.raises(ValueError):
+        sharding.add_tenant(shard_dir, name)
+
+    assert sorted(os.listdir(shard_dir)) == before
+    assert not os.path.exists(os.path.join(str(tmp_path), "outside.db"))
@@ -0,0 +1,32 @@
+from datetime import datetime as dt
+from dateutil import parser as dt_parse
+
+
+def to_epoch(value):
+    """
+        Function that converts a timestamp read from the database to a Unix epoch.
+        Rows written before the epoch migration hold str(datetime.now()) text instead of integers.
+
+    :param value:       The value of a timestamp column
+    :return:            The timestamp as an integer number of seconds since the epoch (None stays None)
+    """
+    if value is None or isinstance(value, int):
+        return value
+
+    return int(dt_parse.parse(value).timestamp())
+
+
+def format_timestamp(value):
+    """
+        Function that formats a timestamp read from the database for display, in local time
+
+    :param value:       The value of a timestamp column (an epoch, or legacy text)
+    :return:            The timestamp as a "YYYY-MM-DD HH:MM:SS" string (None stays None)
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, str):
+        return value[:19]
+
+    return dt.fromtimestamp(value).strftime("%Y-%m-%d %H:%M:%S")
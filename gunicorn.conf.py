@@ -0,0 +1,33 @@
+"""
+    gunicorn settings for the production entry point (wsgi.py):
+
+        gunicorn -c gunicorn.conf.py
+
+    Overridable from the environment:
+
+        BIND                -   the address to listen on (default: 0.0.0.0:5000)
+        WEB_CONCURRENCY     -   the number of worker processes (default: one per core)
+        WEB_THREADS         -   the number of threads per worker (default: 4)
+        WEB_TIMEOUT         -   seconds before a silent worker is restarted (default: 30)
+"""
+import multiprocessing
+import os
+
+wsgi_app = "wsgi:application"
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("WEB_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.environ.get("WEB_TIMEOUT", 30))
+
+# The app (and its warmed caches) is created once, before forking the workers
+preload_app = True
+
+
+def post_fork(arbiter, worker):
+    """
+        Starts the background jobs of the app in the first worker to get there (see server.start_jobs)
+    """
+    import server
+    server.start_jobs()
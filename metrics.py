@@ -0,0 +1,296 @@
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request
+
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _ShardedMetric:
+    """
+        Base class for metrics whose values are split in per-thread shards.
+
+        Every thread only ever writes to its own shard, so recording a value needs no lock.
+    The shards are only summed up when the metrics are scraped. Shards are keyed by thread
+    ident, and idents of finished threads get reused, so the number of shards stays bounded
+    by the number of threads alive at the same time.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._shards = dict()
+
+    def _shard(self):
+        ident = threading.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            shard = dict()
+            self._shards[ident] = shard
+        return shard
+
+    def _all_shards(self):
+        # Taking the copy is a single C call, so it can't race with a thread adding its shard
+        return tuple(self._shards.values())
+
+    def _format_labels(self, labelvalues, extra=None):
+        pairs = list(zip(self.labelnames, labelvalues))
+        if extra is not None:
+            pairs.append(extra)
+
+        if not pairs:
+            return ""
+
+        return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self):
+        raise NotImplementedError
+
+
+class Counter(_ShardedMetric):
+
+    TYPE = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        """
+        :param labelvalues:     The values of the labels, in the order of labelnames
+        :param amount:          How much to increment by
+        """
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    def values(self):
+        """
+        :return:    A dictionary mapping each tuple of label values to the total count
+        """
+        totals = dict()
+        for shard in self._all_shards():
+            for labelvalues, value in tuple(shard.items()):
+                totals[labelvalues] = totals.get(labelvalues, 0) + value
+        return totals
+
+    def _render_samples(self):
+        return ["%s%s %s" % (self.name, self._format_labels(labelvalues), _format_value(value))
+                for labelvalues, value in sorted(self.values().items())]
+
+
+class Histogram(_ShardedMetric):
+
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        """
+        :param value:           The observed value
+        :param labelvalues:     The values of the labels, in the order of labelnames
+        """
+        shard = self._shard()
+        data = shard.get(labelvalues)
+        if data is None:
+            # One slot per bucket, one for +Inf, then the sum and the count
+            data = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            shard[labelvalues] = data
+
+        data[bisect_left(self.buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def values(self):
+        """
+        :return:    A dictionary mapping each tuple of label values to a list of the format
+                    [<count_per_bucket>..., <count_above_the_last_bucket>, <sum>, <count>]
+        """
+        totals = dict()
+        for shard in self._all_shards():
+            for labelvalues, data in tuple(shard.items()):
+                total = totals.get(labelvalues)
+                if total is None:
+                    totals[labelvalues] = list(data)
+                else:
+                    for i in range(len(data)):
+                        total[i] += data[i]
+        return totals
+
+    def _render_samples(self):
+        lines = list()
+
+        for labelvalues, data in sorted(self.values().items()):
+            cumulative = 0
+            for i, bound in enumerate(self.buckets + (float("inf"),)):
+                cumulative += data[i]
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append("%s_bucket%s %d" % (self.name, self._format_labels(labelvalues, ("le", le)), cumulative))
+
+            lines.append("%s_sum%s %s" % (self.name, self._format_labels(labelvalues), _format_value(data[-2])))
+            lines.append("%s_count%s %d" % (self.name, self._format_labels(labelvalues), data[-1]))
+
+        return lines
+
+
+class Registry:
+    """
+        A set of metrics, rendered together in the Prometheus text format (version 0.0.4)
+    """
+
+    def __init__(self):
+        self._metrics = list()
+        self._collectors = list()
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+            Method that registers a function producing values computed at scrape time
+
+        :param collector:   A function returning a list of tuples of the format:
+                                (<name>, <type>, <help>, [(<labels_dict>, <value>), ...])
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = list()
+
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append("# HELP %s %s" % (name, documentation))
+                lines.append("# TYPE %s %s" % (name, metric_type))
+                for labels, value in samples:
+                    label_string = ""
+                    if labels:
+                        label_string = "{" + ",".join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items())) + "}"
+                    lines.append("%s%s %s" % (name, label_string, _format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    """
+        Per-route request instrumentation for the Flask app.
+
+        Records, for every route: a latency histogram, request counts by status code and the
+    time spent in each phase of the request (database, serialization, template rendering).
+    """
+
+    def __init__(self, registry, app=None):
+        self._local = threading.local()
+
+        self.latency = registry.histogram("http_request_duration_seconds",
+                                          "Time spent handling a request",
+                                          ["route", "method"])
+        self.requests = registry.counter("http_requests_total",
+                                         "Number of requests handled",
+                                         ["route", "method", "status"])
+        self.phases = registry.histogram("http_request_phase_seconds",
+                                         "Time spent in each phase of a request",
+                                         ["route", "phase"])
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        self._local.phases = dict()
+        g.metrics_start = time.perf_counter()
+
+    def _after_request(self, response):
+        start = g.get("metrics_start")
+        if start is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+        self.latency.observe(time.perf_counter() - start, route, request.method)
+        self.requests.inc(route, request.method, str(response.status_code))
+
+        for phase, seconds in self._local.phases.items():
+            self.phases.observe(seconds, route, phase)
+        self._local.phases = dict()
+
+        return response
+
+    def timed(self, phase, function):
+        """
+            Method that wraps a function so the time spent in it is accounted to the given phase
+        of the current request
+
+        :param phase:       The name of the phase (e.g. "database", "serialization", "template")
+        :param function:    The function to wrap
+        :return:            The wrapped function
+        """
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._add_phase_time(phase, time.perf_counter() - start)
+
+        wrapped.__name__ = function.__name__
+        wrapped.__doc__ = function.__doc__
+        return wrapped
+
+    def instrument(self, obj, phase):
+        """
+        :param obj:         An object (e.g. the DatabaseHandler)
+        :param phase:       The phase its public methods are accounted to
+        :return:            A proxy timing every call to a public method of obj
+        """
+        return _TimedProxy(self, obj, phase)
+
+    def _add_phase_time(self, phase, seconds):
+        phases = getattr(self._local, "phases", None)
+        if phases is None:
+            # Called outside of a request
+            return
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+class _TimedProxy:
+
+    def __init__(self, request_metrics, obj, phase):
+        self._request_metrics = request_metrics
+        self._obj = obj
+        self._phase = phase
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        return self._request_metrics.timed(self._phase, attr)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
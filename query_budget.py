@@ -0,0 +1,77 @@
+from flask import request
+
+
+class QueryBudget:
+    """
+        Per-request accounting of database round trips.
+
+        Uses the per-request statement counts of the DatabaseHandler's QueryProfiler to spot
+    requests that run more queries than their route's budget, and statements that are repeated
+    within the same request (N+1 patterns, or the same user being resolved more than once).
+    Every breach is counted in the metrics registry; in debug mode it is also logged as a warning.
+
+        Configuration (read from app.config):
+
+            QUERY_BUDGET_DEFAULT    -   the maximum number of queries a request is expected to run
+            QUERY_BUDGETS           -   a dictionary of {<route>: <budget>} overriding the default
+            QUERY_REPEAT_THRESHOLD  -   a statement executed this many times in one request gets reported
+    """
+
+    def __init__(self, profiler, registry, app=None):
+        self._profiler = profiler
+
+        self.queries = registry.histogram("db_queries_per_request",
+                                          "Number of SQL statements executed per request",
+                                          ["route"],
+                                          buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50, 100))
+        self.breaches = registry.counter("db_query_budget_breaches_total",
+                                         "Requests that executed more statements than their route's budget",
+                                         ["route"])
+        self.repeats = registry.counter("db_repeated_statements_total",
+                                        "Statements executed repeatedly within a single request",
+                                        ["route"])
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("QUERY_BUDGET_DEFAULT", 5)
+        app.config.setdefault("QUERY_BUDGETS", dict())
+        app.config.setdefault("QUERY_REPEAT_THRESHOLD", 2)
+
+        self._app = app
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        self._profiler.begin_request()
+
+    def _after_request(self, response):
+        profile = self._profiler.end_request()
+        if profile is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        config = self._app.config
+        logger = self._app.logger
+
+        self.queries.observe(profile["queries"], route)
+
+        if profile["queries"] > 0:
+            logger.debug("%s %s: %d queries in %.1f ms",
+                         request.method, request.path, profile["queries"], profile["seconds"] * 1000)
+
+        budget = config["QUERY_BUDGETS"].get(route, config["QUERY_BUDGET_DEFAULT"])
+        if profile["queries"] > budget:
+            self.breaches.inc(route)
+            if self._app.debug:
+                logger.warning("%s ran %d queries (budget: %d)", route, profile["queries"], budget)
+
+        for statement, count in profile["statements"].items():
+            if count >= config["QUERY_REPEAT_THRESHOLD"]:
+                self.repeats.inc(route)
+                if self._app.debug:
+                    logger.warning("%s ran the same statement %d times: %s", route, count, statement)
+
+        return response
@@ -0,0 +1,176 @@
+import threading
+import zlib
+from collections import OrderedDict
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compressor:
+    """
+        Content-negotiated response compression for the Flask app.
+
+        Usage:
+                compressor = Compressor(app)
+
+        Configuration (read from app.config):
+
+            COMPRESS_MIN_SIZE       -   responses smaller than this (in bytes) are sent as they are
+            COMPRESS_LEVEL          -   the gzip compression level (1 - 9)
+            COMPRESS_BROTLI_QUALITY -   the brotli quality (0 - 11), only used if brotli is installed
+            COMPRESS_CACHE_SIZE     -   how many compressed bodies to keep for responses that carry an ETag
+    """
+
+    COMPRESSIBLE_MIMETYPES = {
+        "text/html",
+        "text/plain",
+        "text/css",
+        "application/json",
+        "application/javascript",
+    }
+
+    def __init__(self, app=None):
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_size = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+        app.config.setdefault("COMPRESS_LEVEL", 6)
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", 4)
+        app.config.setdefault("COMPRESS_CACHE_SIZE", 128)
+
+        self._config = app.config
+        self._cache_size = app.config["COMPRESS_CACHE_SIZE"]
+
+        app.after_request(self._after_request)
+
+    def _choose_encoding(self):
+        """
+            Method that picks the encoding to use, based on the Accept-Encoding header of the request
+
+        :return:    "br", "gzip" or None if the client doesn't accept any of them
+        """
+        accepted = request.accept_encodings
+
+        if brotli is not None and accepted["br"] > 0:
+            return "br"
+
+        if accepted["gzip"] > 0:
+            return "gzip"
+
+        return None
+
+    def _new_compressor(self, encoding):
+        """
+        :param encoding:    "br" or "gzip"
+        :return:            A streaming compressor object exposing compress(data) and flush()
+        """
+        if encoding == "br":
+            return _BrotliStream(self._config["COMPRESS_BROTLI_QUALITY"])
+
+        # wbits = 31 makes zlib write a gzip header and trailer
+        return zlib.compressobj(self._config["COMPRESS_LEVEL"], zlib.DEFLATED, 31)
+
+    def _compress(self, data, encoding):
+        compressor = self._new_compressor(encoding)
+        return compressor.compress(data) + compressor.flush()
+
+    def _compress_stream(self, chunks, encoding):
+        """
+            Generator that compresses a streamed response chunk by chunk.
+            Every chunk is sync-flushed, so the client receives data as soon as the view yields it.
+        """
+        compressor = self._new_compressor(encoding)
+
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+
+        yield compressor.flush()
+
+    def _get_cached(self, key):
+        with self._cache_lock:
+            body = self._cache.get(key)
+            if body is not None:
+                self._cache.move_to_end(key)
+            return body
+
+    def _store_cached(self, key, body):
+        if self._cache_size <= 0:
+            return
+
+        with self._cache_lock:
+            self._cache[key] = body
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _after_request(self, response):
+        if response.status_code != 200 or \
+                response.direct_passthrough or \
+                "Content-Encoding" in response.headers or \
+                response.mimetype not in self.COMPRESSIBLE_MIMETYPES:
+            return response
+
+        response.vary.add("Accept-Encoding")
+
+        encoding = self._choose_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self._compress_stream(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            body = response.get_data()
+            if len(body) < self._config["COMPRESS_MIN_SIZE"]:
+                return response
+
+            etag, weak = response.get_etag()
+
+            if etag is not None:
+                # The ETag only changes when the underlying data does, and the arguments of the request
+                # select the representation, so together they are a safe cache key
+                key = (request.path, tuple(sorted(request.args.items(multi=True))), etag, encoding)
+                compressed = self._get_cached(key)
+                if compressed is None:
+                    compressed = self._compress(body, encoding)
+                    self._store_cached(key, compressed)
+
+                # A compressed body is a different representation, so the ETag can only stay weak
+                response.set_etag(etag, weak=True)
+            else:
+                compressed = self._compress(body, encoding)
+
+            response.set_data(compressed)
+
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+
+class _BrotliStream:
+    """
+        Small adapter giving brotli.Compressor the same interface as a zlib compressor object
+    """
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self, mode=None):
+        if mode is None:
+            return self._compressor.finish()
+        return self._compressor.flush()
@@ -1,11 +1,372 @@
-from flask import Flask, request, jsonify, Response, render_template
-from database.database_handler import DatabaseHandler as DH
+import fcntl
+import hashlib
+import os
+from functools import wraps
+from flask import Flask, request, jsonify, Response, render_template, make_response
+from database.database_handler import DatabaseHandler as DH, format_timestamp
+from database.memory_backend import MemoryBackend
+from database.sharding import ShardedHandler
 from flask_cors import CORS, cross_origin
+from metrics import Registry, RequestMetrics
+from query_budget import QueryBudget
+from response_compression import Compressor
+from database.backup_manager import BackupManager
+from database.log_partitions import LogArchiver
+from database.log_retention import LogRetention
+from database.maintenance import MaintenanceScheduler
 
-dh = DH("database/SMU-logs.db")
 app = Flask(__name__)
 CORS(app)
 
+# Timestamps are stored as epochs, and only formatted when a template renders them
+app.add_template_filter(format_timestamp, "timestamp")
+
+registry = Registry()
+request_metrics = RequestMetrics(registry, app)
+
+# Registered after the metrics, so that compression time counts towards the request latency
+Compressor(app)
+
+# With SESSION_SECRET set, login tokens are signed and checked without a database hit.
+# DATABASE_SHARED_GENERATIONS=1 is needed when several processes serve the database (see wsgi.py).
+# PASSWORD_HASH_PROCESSES moves password hashing to a pool of processes (see asgi.py).
+# READ_SNAPSHOT_STALENESS (in seconds) serves the analytics reads from a periodically refreshed copy.
+_handler_options = dict(session_secret=os.environ.get("SESSION_SECRET"),
+                        shared_generations=os.environ.get("DATABASE_SHARED_GENERATIONS") == "1",
+                        password_processes=int(os.environ.get("PASSWORD_HASH_PROCESSES", 0)),
+                        snapshot_staleness=float(os.environ["READ_SNAPSHOT_STALENESS"])
+                        if os.environ.get("READ_SNAPSHOT_STALENESS") else None)
+
+# Nothing is written back from memory: the jobs below would work on a file the server doesn't write to, and the
+# journal would replay events the database file never saw
+if os.environ.get("DATABASE_BACKEND") == "memory" and any(os.environ.get(name) for name in
+                                                          ["BACKUP_DIR", "LOG_ARCHIVE_DIR", "LOG_RETENTION_DAYS",
+                                                           "MAINTENANCE_INTERVAL", "EVENT_JOURNAL_DIR"]):
+    raise RuntimeError("BACKUP_DIR, LOG_ARCHIVE_DIR, LOG_RETENTION_DAYS, MAINTENANCE_INTERVAL and EVENT_JOURNAL_DIR "
+                       "can't be used with DATABASE_BACKEND=memory")
+
+# SHARD_DIRECTORY serves one database per organization instead (see database/sharding.py), users signing up
+# without an organization going to SHARD_DEFAULT_TENANT.
+# DATABASE_BACKEND=memory serves DATABASE_PATH from memory instead (for benchmarks: nothing is written back)
+# EVENT_JOURNAL_DIR journals the work session events there, to events.jsonl (<tenant>.jsonl with shards), before
+# applying them (see database/event_journal.py). Each of them then waits for an fsync of the journal (shared with
+# the events written along with it) on top of the commit, which makes them slower but recoverable from a backup
+# and the journal
+if os.environ.get("SHARD_DIRECTORY"):
+    dh = request_metrics.instrument(ShardedHandler(os.environ["SHARD_DIRECTORY"],
+                                                   os.environ.get("SHARD_DEFAULT_TENANT"),
+                                                   journal_dir=os.environ.get("EVENT_JOURNAL_DIR"),
+                                                   **_handler_options),
+                                    "database")
+else:
+    dh = request_metrics.instrument(DH(os.environ.get("DATABASE_PATH", "database/SMU-logs.db"),
+                                       backend=MemoryBackend(os.environ.get("DATABASE_PATH", "database/SMU-logs.db"))
+                                       if os.environ.get("DATABASE_BACKEND") == "memory" else None,
+                                       journal_path=os.path.join(os.environ["EVENT_JOURNAL_DIR"], "events.jsonl")
+                                       if os.environ.get("EVENT_JOURNAL_DIR") else None,
+                                       **_handler_options),
+                                    "database")
+
+# The jobs below work on a single database file: with shards, they are run on each one with their command line tools
+if os.environ.get("SHARD_DIRECTORY") and any(os.environ.get(name) for name in
+                                             ["BACKUP_DIR", "LOG_ARCHIVE_DIR", "LOG_RETENTION_DAYS",
+                                              "MAINTENANCE_INTERVAL"]):
+    raise RuntimeError("BACKUP_DIR, LOG_ARCHIVE_DIR, LOG_RETENTION_DAYS and MAINTENANCE_INTERVAL can't be "
+                       "used with SHARD_DIRECTORY")
+
+# The jobs are created here but only run once start_jobs() is called, by a single process (see below)
+_jobs = []
+_jobs_lock = None
+
+# BACKUP_DIR enables periodic online backups, every BACKUP_INTERVAL seconds, keeping the BACKUP_KEEP newest
+backups = None
+if os.environ.get("BACKUP_DIR"):
+    backups = BackupManager(os.environ.get("DATABASE_PATH", "database/SMU-logs.db"), os.environ["BACKUP_DIR"],
+                            keep=int(os.environ.get("BACKUP_KEEP", 7)), handler=dh)
+    _jobs.append((backups, float(os.environ.get("BACKUP_INTERVAL", 3600))))
+
+# LOG_ARCHIVE_DIR enables the monthly archival of the logs (checked every LOG_ARCHIVE_INTERVAL seconds),
+# keeping the LOG_ARCHIVE_KEEP_MONTHS latest months, the current one included, in the database
+archiver = None
+if os.environ.get("LOG_ARCHIVE_DIR"):
+    archiver = LogArchiver(dh, os.environ["LOG_ARCHIVE_DIR"],
+                           keep_months=int(os.environ.get("LOG_ARCHIVE_KEEP_MONTHS", 1)))
+    _jobs.append((archiver, float(os.environ.get("LOG_ARCHIVE_INTERVAL", 86400))))
+
+# LOG_RETENTION_DAYS enables the rolling up of older logs into daily totals (every LOG_RETENTION_INTERVAL seconds)
+retention = None
+if os.environ.get("LOG_RETENTION_DAYS"):
+    retention = LogRetention(dh, int(os.environ["LOG_RETENTION_DAYS"]))
+    _jobs.append((retention, float(os.environ.get("LOG_RETENTION_INTERVAL", 86400))))
+
+# MAINTENANCE_INTERVAL enables the vacuum and analysis of the database (checked every that many seconds), when the
+# writes are quiet and, if MAINTENANCE_QUIET_HOURS is given (e.g. "2-5"), only within those hours
+maintenance = None
+if os.environ.get("MAINTENANCE_INTERVAL"):
+    maintenance = MaintenanceScheduler(dh, quiet_hours=tuple(int(hour) for hour in
+                                                                  os.environ["MAINTENANCE_QUIET_HOURS"].split("-"))
+                                       if os.environ.get("MAINTENANCE_QUIET_HOURS") else None)
+    _jobs.append((maintenance, float(os.environ["MAINTENANCE_INTERVAL"])))
+
+
+def start_jobs():
+    """
+        Function that starts the background jobs enabled above (backups, log archival and retention,
+    maintenance), unless another process serving the database already runs them. It must be called
+    after forking (e.g. from the post_fork hook of gunicorn.conf.py), as threads don't survive a fork.
+
+        The first process to call it takes a lock file next to the database and holds it until it exits,
+    so that exactly one process runs the jobs, and the next one to call it takes over once it is gone.
+    POSIX only, as the lock is taken with fcntl.
+
+    :return:    True if this process runs the jobs
+    """
+    global _jobs_lock
+
+    if not _jobs or _jobs_lock is not None:
+        return _jobs_lock is not None
+
+    lock_file = open(os.environ.get("DATABASE_PATH", "database/SMU-logs.db") + ".jobs.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+
+    _jobs_lock = lock_file
+    for job, interval in _jobs:
+        job.start(interval)
+    return True
+
+jsonify = request_metrics.timed("serialization", jsonify)
+render_template = request_metrics.timed("template", render_template)
+
+
+def _handler_stats():
+    """
+        Collector exposing the DatabaseHandler cache and request coalescing statistics on /metrics
+    """
+    cache = dh.get_cache_stats()
+    single_flight = dh.get_single_flight_stats()
+    writes = dh.get_write_stats()
+
+    def per_method(field):
+        return [({"method": method}, stats[field]) for method, stats in sorted(single_flight.items())]
+
+    return [
+        ("dh_query_cache_entries", "gauge", "Results currently held in the query cache",
+            [({}, cache["entries"])]),
+        ("dh_query_cache_hits_total", "counter", "Query cache hits", [({}, cache["hits"])]),
+        ("dh_query_cache_misses_total", "counter", "Query cache misses", [({}, cache["misses"])]),
+        ("dh_query_cache_stale_total", "counter", "Query cache misses caused by a write",
+            [({}, cache["stale"])]),
+        ("dh_query_cache_evictions_total", "counter", "Query cache LRU evictions", [({}, cache["evictions"])]),
+        ("dh_single_flight_calls_total", "counter", "Coalesced read calls", per_method("calls")),
+        ("dh_single_flight_executions_total", "counter", "Coalesced read computations actually run",
+            per_method("executions")),
+        ("dh_single_flight_shared_total", "counter", "Coalesced read calls served by an in-flight computation",
+            per_method("shared")),
+        ("dh_write_batches_total", "counter", "Group commits done by the writer thread", [({}, writes["batches"])]),
+        ("dh_write_operations_total", "counter", "Writes committed or rolled back by the writer thread",
+            [({}, writes["writes"])]),
+        ("dh_write_failures_total", "counter", "Writes that failed and were rolled back", [({}, writes["failed"])]),
+        ("dh_write_largest_batch", "gauge", "Most writes committed together so far",
+            [({}, writes["largest_batch"])]),
+    ] + _snapshot_stats() + _journal_stats() + _backup_stats() + _archive_stats() + _retention_stats() \
+        + _maintenance_stats()
+
+
+def _snapshot_stats():
+    snapshot = dh.get_snapshot_stats()
+    if snapshot is None:
+        return []
+
+    return [
+        ("dh_read_snapshot_age_seconds", "gauge", "Age of the read snapshot",
+            [({}, snapshot["age_s"] or 0)]),
+        ("dh_read_snapshot_refreshes_total", "counter", "Read snapshot refreshes", [({}, snapshot["refreshes"])]),
+        ("dh_read_snapshot_failures_total", "counter", "Read snapshot refreshes that failed",
+            [({}, snapshot["failures"])]),
+        ("dh_read_snapshot_refresh_seconds", "gauge", "Duration of the last read snapshot refresh",
+            [({}, snapshot["last_duration_s"])]),
+    ]
+
+
+def _journal_stats():
+    journal = dh.get_journal_stats()
+    if journal is None:
+        return []
+
+    return [
+        ("dh_journal_batches_total", "counter", "Event journal fsyncs", [({}, journal["batches"])]),
+        ("dh_journal_events_total", "counter", "Work session events written to the journal",
+            [({}, journal["events"])]),
+        ("dh_journal_failures_total", "counter", "Events that could not be written to the journal",
+            [({}, journal["failed"])]),
+        ("dh_journal_largest_batch", "gauge", "Most events written per fsync so far",
+            [({}, journal["largest_batch"])]),
+        ("dh_journal_bytes_total", "counter", "Bytes written to the journal", [({}, journal["bytes"])]),
+        ("dh_journal_fsync_seconds_total", "counter", "Time spent writing and fsyncing the journal",
+            [({}, journal["fsync_s"])]),
+        ("dh_journal_rotations_total", "counter", "Journal files rotated", [({}, journal["rotations"])]),
+    ]
+
+
+def _backup_stats():
+    if backups is None:
+        return []
+
+    stats = backups.stats()
+    return [
+        ("db_backups_total", "counter", "Backups taken", [({}, stats["backups"])]),
+        ("db_backup_failures_total", "counter", "Backups that failed", [({}, stats["failures"])]),
+        ("db_backup_seconds_total", "counter", "Time spent taking backups", [({}, stats["seconds_total"])]),
+        ("db_backup_bytes_total", "counter", "Bytes written by backups", [({}, stats["bytes_total"])]),
+        ("db_backup_last_duration_seconds", "gauge", "Duration of the last backup",
+            [({}, stats["last_duration_s"])]),
+        ("db_backup_last_bytes", "gauge", "Size of the last backup", [({}, stats["last_bytes"])]),
+        ("db_backup_last_success_timestamp", "gauge", "When the last backup finished",
+            [({}, stats["last_success"] or 0)]),
+    ]
+
+
+def _archive_stats():
+    if archiver is None:
+        return []
+
+    stats = archiver.stats()
+    return [
+        ("db_log_archive_runs_total", "counter", "Log archival runs", [({}, stats["runs"])]),
+        ("db_log_archive_failures_total", "counter", "Log archival runs that failed", [({}, stats["failures"])]),
+        ("db_log_archive_partitions_total", "counter", "Archive partitions written", [({}, stats["partitions"])]),
+        ("db_log_archive_rows_total", "counter", "Logs moved to archive partitions", [({}, stats["rows"])]),
+        ("db_log_archive_last_duration_seconds", "gauge", "Duration of the last log archival",
+            [({}, stats["last_duration_s"])]),
+    ]
+
+
+def _retention_stats():
+    if retention is None:
+        return []
+
+    stats = retention.stats()
+    return [
+        ("db_log_retention_runs_total", "counter", "Log retention runs", [({}, stats["runs"])]),
+        ("db_log_retention_failures_total", "counter", "Log retention runs that failed", [({}, stats["failures"])]),
+        ("db_log_retention_rows_total", "counter", "Logs rolled up into daily totals", [({}, stats["rows"])]),
+        ("db_log_retention_partitions_total", "counter", "Archive partitions rolled up",
+            [({}, stats["partitions"])]),
+        ("db_log_retention_last_duration_seconds", "gauge", "Duration of the last log retention run",
+            [({}, stats["last_duration_s"])]),
+    ]
+
+
+def _maintenance_stats():
+    if maintenance is None:
+        return []
+
+    stats = maintenance.stats()
+    return [
+        ("db_maintenance_passes_total", "counter", "Maintenance passes done", [({}, stats["passes"])]),
+        ("db_maintenance_skipped_total", "counter", "Maintenance checks outside of a quiet window",
+            [({}, stats["skipped"])]),
+        ("db_maintenance_failures_total", "counter", "Maintenance passes that failed", [({}, stats["failures"])]),
+        ("db_maintenance_seconds_total", "counter", "Time spent on maintenance", [({}, stats["seconds_total"])]),
+        ("db_maintenance_pages_freed_total", "counter", "Pages freed by incremental vacuum",
+            [({}, stats["pages_freed"])]),
+        ("db_maintenance_analyzes_total", "counter", "Tables analyzed", [({}, stats["analyzes"])]),
+        ("db_file_bytes", "gauge", "Size of the database file", [({}, stats["file_bytes"])]),
+        ("db_freelist_ratio", "gauge", "Fraction of free pages in the database file",
+            [({}, stats["freelist_ratio"])]),
+        ("db_table_rows", "gauge", "Rows per table, as of their last analysis",
+            [({"table": table}, rows) for table, rows in sorted(stats["tables"].items())]),
+    ]
+
+
+registry.add_collector(_handler_stats)
+
+QueryBudget(dh.profiler, registry, app)
+
+# The keys the caller of a request is identified by, in JSON bodies and in query strings
+_CALLER_JSON_KEYS = ("asking", "id_asker", "id_admin", "id_updater", "id")
+_CALLER_ARGS_KEYS = ("id_asker", "id")
+
+
+@app.before_request
+def _resolve_caller():
+    """
+        Opens the request scope and resolves the caller of the request into it, at the start of the
+    request. Every later lookup of the same user during the request (by the route, through identity(),
+    or by the DatabaseHandler) reuses it.
+    """
+    dh.begin_request_scope()
+
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict):
+        keys, source = _CALLER_JSON_KEYS, data
+    else:
+        keys, source = _CALLER_ARGS_KEYS, request.args
+
+    for key in keys:
+        if isinstance(source.get(key), str):
+            dh.resolve_identity(source[key])
+            break
+
+
+@app.teardown_request
+def _end_request_scope(exception=None):
+    dh.end_request_scope()
+
+
+def identity(email_hash):
+    """
+        Function that turns an email hash from a request into the Identity of the user,
+    resolved at most once per request
+
+    :param email_hash:      The email hash
+    :return:                -> The Identity of the user
+                            -> The email hash itself, if there is no such user (so that the
+                               DatabaseHandler reports the error as usual)
+    """
+    resolved = dh.resolve_identity(email_hash)
+    return resolved if resolved is not None else email_hash
+
+
+def conditional_get(*tables, from_snapshot=False):
+    """
+        Decorator for GET endpoints whose response is built only from the given tables.
+
+        The ETag is derived from the tables' generation counters, so a client that sends
+    a matching If-None-Match header gets a 304 before any query or template render happens.
+    The token is read *before* the view runs: if a write lands in between, the body is newer
+    than the ETag and the next request simply misses, instead of caching stale data. The arguments
+    of the query string (e.g. a time range) are part of the ETag, since they select what is returned.
+
+    :param tables:          The names of the tables the endpoint reads from
+    :param from_snapshot:   True - if the endpoint reads them from the read snapshot
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            etag = dh.get_version_token(*tables, from_snapshot=from_snapshot)
+            if request.args:
+                arguments = repr(sorted(request.args.items(multi=True))).encode("utf-8")
+                etag += "-" + hashlib.sha1(arguments).hexdigest()[:12]
+
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return wrapped
+
+    return decorator
+
 
 @app.route("/user-validate", methods=["POST", "OPTIONS"])
 @cross_origin()
@@ -16,7 +377,7 @@ def validate_user():
             if "id" in data and "pass" in data:
                 if isinstance(data["id"], str) and isinstance(data["pass"], str):
 
-                    status, msg = dh.validate_user(data["id"], data["pass"])
+                    status, msg = dh.validate_user(identity(data["id"]), data["pass"])
 
                     if status:
                         return Response(status=200, response="Success")
@@ -51,7 +412,7 @@ def start_work():
         data = request.get_json(force=True)
         if "id" in data and "course" in data:
             if isinstance(data["id"], str) and isinstance(data["course"], str):
-                status, response = dh.start_work(data["id"], data["course"])
+                status, response = dh.start_work(identity(data["id"]), data["course"])
                 if status:
                     return Response(response="All good!",
                                     status=200)
@@ -95,7 +456,7 @@ def stop_work():
         data = request.json
         if "id" in data and "time" in data:
             if isinstance(data["id"], str) and isinstance(data["time"], int):
-                status, response = dh.stop_work(data["id"], data["time"])
+                status, response = dh.stop_work(identity(data["id"]), data["time"])
                 if status:
                     return Response(response="All good!",
                                     status=200)
@@ -256,6 +617,7 @@ def check_session():
 
 @app.route("/working-users", methods=["GET", "OPTIONS"])
 @cross_origin()
+@conditional_get("working", "users", "courses")
 def working_users():
 
     return jsonify(dh.get_working_users())
@@ -263,10 +625,51 @@ def working_users():
 
 @app.route("/logs", methods=["GET", "OPTIONS"])
 @cross_origin()
+@conditional_get("logs", "users", "courses", from_snapshot=True)
 def get_logs():
     return jsonify(dh.get_logs())
 
 
+@app.route("/logs/changes", methods=["GET", "OPTIONS"])
+@cross_origin()
+def get_log_changes():
+    """
+        Function that handles a request for the logs written after a watermark, so that a copy of the
+    logs can be kept up to date without downloading all of them. The request URL has to have the format:
+
+                https://www.neural-guide.me/logs/changes?since=<watermark>&limit=<max_no_of_logs>
+
+        Both arguments are optional: without a watermark, the logs are returned from the first one on.
+
+    :return:        A JSON of the format:
+
+                {
+                    "success": <True/ False>,
+                    "users": [<log>, ...],                  (only if successful, in the format of /logs)
+                    "watermark": <watermark_for_the_next_request>,  (only if successful)
+                    "more": <True if the next request can be made right away>,  (only if successful)
+                    "message": <ERROR_message>              (only if not successful)
+                }
+    """
+    since = request.args.get("since")
+    # get(type=int) gives the default for a limit that isn't a number: it is refused, not ignored
+    limit = request.args.get("limit", type=int)
+    if limit is None and "limit" in request.args:
+        return Response(status=400, response="Invalid request arguments")
+    if limit is None:
+        limit = 1000
+
+    if not 0 < limit <= 10000:
+        return Response(status=400, response="Invalid request arguments")
+
+    try:
+        dh.parse_watermark(since)
+    except ValueError:
+        return Response(status=400, response="Invalid request arguments")
+
+    return jsonify(dh.get_log_changes(since, limit))
+
+
 @app.route("/user/logout", methods=["POST", "OPTIONS"])
 @cross_origin()
 def logout():
@@ -290,7 +693,7 @@ def logout():
     if request.is_json:
         data = request.json
         if "id" in data and isinstance(data["id"], str):
-            result = dh.logout_user(data["id"])
+            result = dh.logout_user(identity(data["id"]))
             return jsonify(result)
         else:
             return Response(status=400, response="Wrong request format")
@@ -323,7 +726,7 @@ def user_stats():
         data = request.json
         if "asking" in data and "user" in data:
             if isinstance(data["asking"], str) and isinstance(data["user"], str):
-                return jsonify(dh.get_stats_for_user(data["asking"], data["user"]))
+                return jsonify(dh.get_stats_for_user(identity(data["asking"]), identity(data["user"])))
             else:
                 return Response(status=400, response="Wrong format")
         else:
@@ -342,7 +745,9 @@ def user_history():
 
             {
                 "asking": <id_of_the_user_asking_for_the_data>,
-                "user": <id_of_the_user_we_ask_for>
+                "user": <id_of_the_user_we_ask_for>,
+                "since": <epoch>,           (optional)
+                "until": <epoch>            (optional)
             }
     :return:    A rendered template with the user's history (if the asking user has enough rights)
     """
@@ -350,10 +755,11 @@ def user_history():
     if request.is_json:
         data = request.json
         if "asking" in data and "user" in data:
-            if isinstance(data["asking"], str) and isinstance(data["user"], str):
-                resp = dh.get_history_for_user(data["asking"], data["user"])
-                resp["working"] = dh.user_is_working(data["user"])
-                print(resp["working"])
+            if isinstance(data["asking"], str) and isinstance(data["user"], str) and \
+                    isinstance(data.get("since", 0), int) and isinstance(data.get("until", 0), int):
+                user = identity(data["user"])
+                resp = dh.get_history_for_user(identity(data["asking"]), user, data.get("since"), data.get("until"))
+                resp["working"] = dh.user_is_working(user)
                 return render_template("html/stats/history.html", data=resp)
             else:
                 return Response(status=400, response="Wrong format")
@@ -365,8 +771,22 @@ def user_history():
 
 @app.route("/stats/leaderboard", methods=["GET", "OPTIONS"])
 @cross_origin()
+@conditional_get("users", "logs", "logs_daily", from_snapshot=True)
 def get_leaderboard():
-    data = dh.get_leaderboard()
+    """
+        Function that renders the leaderboard. The request URL can optionally restrict it to a time range:
+
+                https://www.neural-guide.me/stats/leaderboard?since=<epoch>&until=<epoch>
+
+    :return:    A rendered template with the leaderboard
+    """
+    # get(type=int) gives None for an argument that isn't a number: those are refused, not ignored
+    since = request.args.get("since", type=int)
+    until = request.args.get("until", type=int)
+    if (since is None and "since" in request.args) or (until is None and "until" in request.args):
+        return Response(status=400, response="Invalid request arguments")
+
+    data = dh.get_leaderboard(since, until)
     return render_template("html/stats/leaderboard.html", data=data)
 
 
@@ -395,7 +815,7 @@ def is_working():
     except:
         return Response(status=400, response="Invalid request arguments")
 
-    return jsonify(dh.user_is_working(user_id))
+    return jsonify(dh.user_is_working(identity(user_id)))
 
 
 @app.route("/working/update-time", methods=["PUT", "OPTIONS"])
@@ -416,7 +836,7 @@ def update_time():
     except:
         return Response(status=400, response="Invalid request arguments")
 
-    status, msg = dh.update_time(id, time)
+    status, msg = dh.update_time(identity(id), time)
 
     if status:
         return Response(status=200, response="All good")
@@ -446,7 +866,7 @@ def account_info():
 
     id_asker = request.args.get("id_asker")
     id_user = request.args.get("id_user")
-    data = dh.get_user_details(id_asker, id_user)
+    data = dh.get_user_details(identity(id_asker), identity(id_user))
 
     return render_template("html/user-info.html", data=data)
 
@@ -477,10 +897,11 @@ def update_user_password():
 
     if request.is_json:
         data = request.json
-        if ("id_user", "id_admin", "new_pass").issubset(data):
-            return jsonify(dh.update_user_password_as_admin(data["id_admin"], data["id_user"], data["new_pass"]))
-        elif ("id_user", "old_pass", "new_pass").issubset(data):
-            return jsonify(dh.update_user_password(data["id_user"], data["old_pass"], data["new_pass"]))
+        if {"id_user", "id_admin", "new_pass"}.issubset(data):
+            return jsonify(dh.update_user_password_as_admin(identity(data["id_admin"]), identity(data["id_user"]),
+                                                           data["new_pass"]))
+        elif {"id_user", "old_pass", "new_pass"}.issubset(data):
+            return jsonify(dh.update_user_password(identity(data["id_user"]), data["old_pass"], data["new_pass"]))
         else:
             return Response(status="500", response="invalid JSON format")
     else:
@@ -510,12 +931,47 @@ def update_user_name():
     """
     if request.is_json:
         data = request.json
-        if ("id_updater", "id_user", "new_name").issubset(data):
-            return jsonify(dh.update_user_name(data["id_updater"], data["id_user"], data["new_name"]))
+        if {"id_updater", "id_user", "new_name"}.issubset(data):
+            return jsonify(dh.update_user_name(identity(data["id_updater"]), identity(data["id_user"]), data["new_name"]))
         else:
             return Response(status="500", response="invalid JSON format")
     else:
         return Response(status="500", response="Request not a JSON")
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+        Function that exposes the server metrics in the Prometheus text format
+
+    :return:    A text/plain response with all the metrics
+    """
+    return Response(status=200, response=registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/debug/queries", methods=["GET"])
+def debug_queries():
+    """
+        Function that returns the slowest and most frequent SQL statements, and the ones flagged for
+    doing full table scans. Only available when the app runs in debug mode, or with
+    QUERY_PROFILE_ENDPOINT set in the config.
+
+        The request URL can have the format:
+
+                https://www.neural-guide.me/debug/queries?limit=<no_of_statements>
+
+    :return:    A JSON of the format described in QueryProfiler.summary
+    """
+    if not (app.debug or app.config.get("QUERY_PROFILE_ENDPOINT")):
+        return Response(status=404, response="Not found")
+
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        return Response(status=400, response="Invalid request arguments")
+
+    return jsonify(dh.profiler.summary(limit))
+
+
 if __name__ == "__main__":
+    start_jobs()
     app.run(port=5000, debug=True)
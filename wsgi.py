@@ -0,0 +1,49 @@
+"""
+    Production entry point, for prefork WSGI servers (see gunicorn.conf.py):
+
+        gunicorn -c gunicorn.conf.py
+
+    The app is created once in the master process and then forked into the workers. Once the caches
+    are warmed up, the DatabaseHandler is closed: the threads it started (the writer, the journal
+    flusher) are stopped and its connections closed, so that no thread and no SQLite handle crosses
+    the fork. Each worker opens its own again, on first use. The background jobs (backups, log archival
+    and retention, maintenance) aren't started in the master either, but in one of the workers, after
+    the fork (see server.start_jobs and gunicorn.conf.py). The table generations live in the
+    database, so a write made by one worker invalidates the cached reads (and the ETags) of all the
+    others.
+
+    Configuration, from the environment:
+
+        DATABASE_PATH       -   the database to serve (default: database/SMU-logs.db)
+        SESSION_SECRET      -   enables signed session tokens (see server.py)
+        WARM_UP             -   "0" to skip filling the caches before forking
+"""
+import gc
+import os
+
+
+def create_app():
+    """
+        Function that creates the app for a multi-process deployment, with the caches pre-warmed
+
+    :return:    The Flask app
+    """
+    os.environ.setdefault("DATABASE_SHARED_GENERATIONS", "1")
+
+    import server
+
+    if os.environ.get("WARM_UP", "1") != "0":
+        server.dh.warm_up()
+
+    # Nothing opened so far may be shared with the workers: they reopen it all lazily
+    server.dh.close()
+
+    # Everything allocated so far is kept out of the garbage collector's reach, so that collections
+    # in the workers don't touch (and copy) the pages they share with the master
+    gc.collect()
+    gc.freeze()
+
+    return server.app
+
+
+application = create_app()